@@ -1,11 +1,24 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_from_directory, send_file, stream_with_context
+import json
+import hashlib
+import threading
+import time
 from pathlib import Path
 import os
+import shutil
+import uuid
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
-import cv2
-import numpy as np
-from process import save_masks_for_image
+import sam_pool
+from jobs import JobQueue, QueueFull, RemoteJobQueue, parse_address
+import mask_store
+import bg_writer
+import image_index
+import assets
+import font_recognizer
+import metrics
+import profiler
+import uploads
 ROOT = Path(__file__).resolve().parent
 UPLOAD_DIR = ROOT / "images"
 DOWNSCALE_DIR = ROOT / "images" / "input" / "downscaled"
@@ -19,19 +32,45 @@ ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
 app = Flask(__name__)
 app.config["UPLOAD_FOLDER"] = str(UPLOAD_DIR)
 app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50MB
+# only /bulk_upload (many files or a zip, staged on disk) may send more
+BULK_DIR = UPLOAD_DIR / "input" / "bulk"
+BULK_MAX_BYTES = int(os.environ.get("BULK_MAX_BYTES", str(2 * 1024 ** 3)))
+
+# serve.py runs the queue in a separate inference process and points us at it
+JOB_SERVER = os.environ.get("JOB_SERVER")
+if JOB_SERVER:
+    job_queue = RemoteJobQueue(parse_address(JOB_SERVER), os.environ["JOB_SERVER_AUTHKEY"].encode())
+else:
+    job_queue = JobQueue()
 
 CORS(app, origins=["http://localhost:5173", "http://10.253.30.117:5173"])
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def downscale_image(img, max_dim=1600):
-    height, width = img.shape[:2]
-    if max(height, width) > max_dim:
-        scale = max_dim / max(height, width)
-        new_size = (int(width * scale), int(height * scale))
-        img = cv2.resize(img, new_size, interpolation=cv2.INTER_AREA)
-    return img
+
+@app.before_request
+def _start_request():
+    g.started = time.perf_counter()
+    g.sampler = None
+    # an upload's work happens in the job worker, which profiles the job instead
+    if profiler.requested(request) and request.endpoint != "upload_image":
+        g.sampler = profiler.Sampler(threading.get_ident()).start()
+
+
+@app.after_request
+def _finish_request(resp):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    seconds = time.perf_counter() - g.get("started", time.perf_counter())
+    metrics.inc("http_requests_total", endpoint=endpoint, method=request.method, status=resp.status_code)
+    metrics.observe("http_request_seconds", seconds, endpoint=endpoint)
+    metrics.log("request", endpoint=endpoint, method=request.method, status=resp.status_code,
+                seconds=round(seconds, 4))
+    sampler = g.get("sampler")
+    if sampler is not None:
+        resp.headers["X-Profile-File"] = sampler.stop().save(request.endpoint or "request").name
+    return resp
+
 
 @app.route("/upload", methods=["POST"])
 def upload_image():
@@ -41,54 +80,301 @@ def upload_image():
     if file.filename == "":
         return jsonify({"error": "no selected file"}), 400
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-
-        #1: WRITE REGULAR IMAGE
-        out_dir = UPLOAD_DIR / "input" / "original"
-        out_dir.mkdir(parents=True, exist_ok=True)
-        out_path = out_dir / filename
         file_bytes = file.read()
         if not file_bytes:
             return jsonify({"error": "empty file"}), 400
-        with open(out_path, "wb") as f:
-            f.write(file_bytes)
 
-        #2: WRITE DOWNSCALED IMAGE
-        arr = np.frombuffer(file_bytes, np.uint8)
-        img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-        if img is None:
-            return jsonify({"error": "could not decode image"}), 400
-        DOWNSCALE_DIR.mkdir(parents=True, exist_ok=True)
-        img_small = downscale_image(img)
-        cv2.imwrite(str(DOWNSCALE_DIR / filename), img_small)
+        # optional per-request backend and generator settings
+        backend = request.form.get("backend") or None
+        try:
+            overrides = json.loads(request.form.get("generator") or "{}")
+            if not isinstance(overrides, dict):
+                raise ValueError("generator must be a JSON object")
+            sam_pool.generator_kwargs(backend, overrides)
+        except (KeyError, ValueError) as e:
+            return jsonify({"error": f"bad segmentation settings: {e}"}), 400
 
-        #3: START PROCESS_FILE
-        save_masks_for_image(str(DOWNSCALE_DIR / filename))
+        #1: NAME THE ORIGINAL
+        # reserved now; a different image under a taken name gets its own name
+        # (and output folder). The bytes are written in the background meanwhile.
+        filename = uploads.claim_name(file.filename, file_bytes)
+        out_path = uploads.ORIGINAL_DIR / filename
+        written = bg_writer.write_bytes(out_path, file_bytes)
+
+        #2: ENQUEUE SEGMENTATION (decode, downscale, masks, OCR, grouping, write)
+        # the worker decodes these bytes once; nothing is re-read from disk
+        try:
+            job_id = job_queue.submit(file_bytes, filename, backend, overrides,
+                                      profile=profiler.requested(request))
+        except QueueFull:
+            resp = jsonify({"error": "too many pending jobs, retry later"})
+            resp.headers["Retry-After"] = "10"
+            return resp, 429
+        # overlapped with the submit above; `url` must resolve once we answer
+        written.result()
 
         rel_url = f"/images/input/original/{filename}"
-        return jsonify({"filename": filename, "url": rel_url})
+        return jsonify({
+            "filename": filename,
+            "url": rel_url,
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}",
+        }), 202
     return jsonify({"error": "invalid file type"}), 400
 
+@app.route("/bulk_upload", methods=["POST"])
+def bulk_upload():
+    """Ingest many images in one job: any number of `files` parts (images or zip
+    archives). Images that already have outputs are skipped unless force=1.
+    The job's stage_info reports progress and images per minute."""
+    # raise the limit for this request only, before the body is parsed
+    request.max_content_length = BULK_MAX_BYTES
+    files = [f for f in request.files.getlist("files") if f.filename]
+    if not files:
+        return jsonify({"error": "no files"}), 400
+    staging = BULK_DIR / uuid.uuid4().hex
+    staging.mkdir(parents=True)
+    saved = 0
+    for i, f in enumerate(files):
+        name = secure_filename(f.filename)
+        if not name.lower().endswith(".zip") and not allowed_file(name):
+            continue
+        if (staging / name).exists():
+            name = f"{Path(name).stem}-{i}{Path(name).suffix}"
+        f.save(staging / name)
+        saved += 1
+    if not saved:
+        shutil.rmtree(staging, ignore_errors=True)
+        return jsonify({"error": "no images or zip archives"}), 400
+    backend = request.form.get("backend") or None
+    try:
+        overrides = json.loads(request.form.get("generator") or "{}")
+        if not isinstance(overrides, dict):
+            raise ValueError("generator must be a JSON object")
+        sam_pool.generator_kwargs(backend, overrides)
+    except (KeyError, ValueError) as e:
+        shutil.rmtree(staging, ignore_errors=True)
+        return jsonify({"error": f"bad segmentation settings: {e}"}), 400
+    try:
+        job_id = job_queue.submit_bulk(str(staging), backend, overrides or None,
+                                       force=request.form.get("force") == "1")
+    except QueueFull:
+        shutil.rmtree(staging, ignore_errors=True)
+        resp = jsonify({"error": "too many pending jobs, retry later"})
+        resp.headers["Retry-After"] = "10"
+        return resp, 429
+    return jsonify({"job_id": job_id, "files": saved, "status_url": f"/jobs/{job_id}"}), 202
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    job.pop("result", None)
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    if job["state"] == "error":
+        return jsonify({"error": job["error"]}), 500
+    if job["state"] != "done":
+        return jsonify({"state": job["state"], "stage": job["stage"]}), 409
+    if job.get("kind") == "bulk":
+        return jsonify(job["result"]["bulk"])
+    stem = Path(job["filename"]).stem
+    return jsonify({
+        "filename": job["filename"],
+        "groups": job["result"]["groups"],
+        "masks_url": f"/images/sam_shapes/{stem}/",
+    })
+
+@app.route("/segment/<filename>", methods=["POST"])
+def segment_prompt(filename):
+    """Refine one element of an uploaded image from point/box prompts.
+
+    Body: {"points": [[x, y], ...], "labels": [1|0, ...], "box": [x0, y0, x1, y1],
+    "multimask": bool}. Only the mask decoder runs; the image embedding is cached.
+    """
+    body = request.get_json(silent=True) or {}
+    points, labels, box = body.get("points"), body.get("labels"), body.get("box")
+    if not points and not box:
+        return jsonify({"error": "need points or box"}), 400
+    if points and labels is None:
+        labels = [1] * len(points)
+    src = DOWNSCALE_DIR / secure_filename(filename)
+    if not src.is_file():
+        return jsonify({"error": "unknown image"}), 404
+    # decoded where the model lives: this process for the dev server, the
+    # inference process under serve.py, so HTTP workers never load SAM
+    return jsonify(job_queue.prompt(str(src), points, labels, box, bool(body.get("multimask", True))))
+
 @app.route("/images/<path:filename>")
 def serve_image(filename):
-    return send_from_directory(str(UPLOAD_DIR), filename)
+    # masks of cropped/packed images are rebuilt to full frame on demand
+    parts = Path(filename).parts
+    if len(parts) >= 3 and parts[0] == "sam_shapes" and ".." not in parts:
+        image_dir = UPLOAD_DIR / "sam_shapes" / parts[1]
+        if mask_store.is_rendered(image_dir, parts[-1]):
+            return assets.send_rendered(image_dir, parts[-1])
+    return assets.send_asset(UPLOAD_DIR, filename)
 
 @app.route("/rgba/<path:filename>")
 def serve_rgba(filename):
-    return send_from_directory(str(RGBA_DIR), filename)
+    return assets.send_asset(RGBA_DIR, filename)
+
+@app.route("/bundle/<stem>", defaults={"group": None})
+@app.route("/bundle/<stem>/<group>")
+def serve_bundle(stem, group):
+    """All full-frame masks of an image (or one text-box group) as a single zip."""
+    stem = secure_filename(stem)
+    image_dir = UPLOAD_DIR / "sam_shapes" / stem
+    if not stem or not image_dir.is_dir():
+        return jsonify({"error": "unknown image"}), 404
+    if group is not None:
+        group = secure_filename(group)
+    names = assets.bundle_names(image_dir, group)
+    if not names:
+        return jsonify({"error": "no masks"}), 404
+    tag = assets.bundle_token(image_dir, names)
+    if request.if_none_match.contains(tag):
+        resp = app.response_class(status=304)
+        resp.set_etag(tag)
+        return resp
+    resp = app.response_class(assets.bundle(image_dir, names), mimetype="application/zip")
+    resp.set_etag(tag)
+    resp.headers["Cache-Control"] = assets.REVALIDATE
+    # secure_filename leaves ASCII only; werkzeug quotes the parameter
+    resp.headers.set("Content-Disposition", "attachment", filename=f"{stem}{'-' + group if group else ''}.zip")
+    return resp
+
+
+@app.route("/fonts/<stem>", methods=["GET"])
+def image_fonts(stem):
+    """Font ranking of each text-box group of an image, from the local glyph index."""
+    image_dir = UPLOAD_DIR / "sam_shapes" / secure_filename(stem)
+    if not (image_dir / "groups.json").exists():
+        return jsonify({"error": "unknown image or no text groups"}), 404
+    try:
+        return jsonify(font_recognizer.fonts_for_image(image_dir))
+    except RuntimeError as e:
+        # the index is still being built at startup, or there are no fonts to build it from
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "30"}
+
+
+@app.route("/model_status", methods=["GET"])
+def model_status():
+    """Model pools of the job workers and of the process decoding prompts (not
+    this one, which never loads a model under serve.py)."""
+    try:
+        pools = job_queue.pool_stats()
+    except Exception:  # inference process unreachable; /readyz reports that
+        return jsonify({"error": "inference process unavailable"}), 503
+    return jsonify({"default_backend": sam_pool.DEFAULT_BACKEND,
+                    "backends": sorted(sam_pool.BACKENDS),
+                    "pools": pools})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus text exposition of request and pipeline metrics from all processes."""
+    gauges = {}
+    try:
+        gauges["job_queue_depth"] = ("Jobs queued or running.", job_queue.depth())
+    except Exception:  # inference process unreachable; /readyz reports that
+        pass
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """Liveness: the HTTP worker is up."""
+    return jsonify({"ok": True, "pid": os.getpid()})
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """Readiness: 200 once a segmentation worker has a warm model, else 503."""
+    try:
+        status = job_queue.status()
+    except Exception as e:  # inference process not up (yet)
+        return jsonify({"ready": False, "error": str(e)}), 503
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+def _image_entries(rows):
+    """Plain paths (the tree view splits them on '/') and, apart, each file's
+    content version for cache-busting URLs."""
+    return {"images": [r[1] for r in rows], "versions": {r[1]: r[4] for r in rows if r[4]}}
 
 
 @app.route("/all_images", methods=["GET"])
 def list_images():
-    # Return only images located under the 'sam_shapes' directory (recursive).
-    target_dir = UPLOAD_DIR / "sam_shapes"
-    files = []
-    for f in target_dir.rglob("*"):
-        if f.is_file() and allowed_file(f.name):
-            rel = f.relative_to(UPLOAD_DIR).as_posix()
-            files.append(f"/images/{rel}")
-    # print("Here are the sam_shapes image URLs:", files)
-    return jsonify({"images": files})
+    """Images under 'sam_shapes', served from the persistent index.
+
+    Optional query args: image=<stem>, group=<x_y>, after=<seq cursor>, limit=<n>.
+    Responses carry an ETag/Last-Modified tied to the index version.
+    """
+    ver, updated = image_index.version()
+    tag = f"idx-{ver}-{hashlib.sha1(request.query_string).hexdigest()[:8]}"
+    if request.if_none_match.contains(tag):
+        resp = app.response_class(status=304)
+        resp.set_etag(tag)
+        return resp
+    try:
+        after = int(request.args.get("after", 0))
+        limit = int(request.args.get("limit", 0)) or None
+    except ValueError:
+        return jsonify({"error": "after and limit must be integers"}), 400
+    rows = image_index.list_files(request.args.get("image"), request.args.get("group"), after, limit)
+    next_cursor = rows[-1][0] if limit and len(rows) == limit else None
+    resp = jsonify({**_image_entries(rows), "next": next_cursor, "version": ver})
+    resp.set_etag(tag)
+    resp.last_modified = updated
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+# a stream holds a server thread, so it ends after this long and the browser's
+# EventSource reconnects, resuming from the Last-Event-ID it last received
+SSE_MAX_SECONDS = int(os.environ.get("SSE_MAX_SECONDS", "30"))
+
+
+@app.route("/all_images/stream", methods=["GET"])
+def stream_images():
+    """Server-sent events: one 'images' event per batch of newly indexed files."""
+    try:
+        after = int(request.headers.get("Last-Event-ID") or request.args.get("after", -1))
+    except ValueError:
+        return jsonify({"error": "after must be an integer"}), 400
+    if after < 0:
+        rows = image_index.list_files()
+        after = rows[-1][0] if rows else 0
+
+    def events():
+        last_seq, last_ver = after, None
+        idle = 0
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        yield "retry: 1000\n\n"
+        while time.monotonic() < deadline:
+            ver, _ = image_index.version()
+            if ver != last_ver:
+                last_ver = ver
+                rows = image_index.list_files(after=last_seq)
+                if rows:
+                    last_seq = rows[-1][0]
+                    payload = json.dumps({**_image_entries(rows), "next": last_seq})
+                    yield f"id: {last_seq}\nevent: images\ndata: {payload}\n\n"
+                    idle = 0
+            idle += 1
+            if idle >= 15:
+                yield ": keep-alive\n\n"
+                idle = 0
+            time.sleep(1)
+
+    return app.response_class(stream_with_context(events()), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache"})
 
 # @app.route("/all_images", methods=["GET"])
 # def list_images():
@@ -105,4 +391,10 @@ def list_images():
 #     return jsonify({"images": files})
 
 if __name__ == "__main__":
+    # segmentation runs in the job workers, which warm their own models
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        metrics.reset_dir()
+        job_queue.start()
+        if font_recognizer.FONT_INDEX_AUTOBUILD:
+            threading.Thread(target=font_recognizer.ensure_index, name="font-index", daemon=True).start()
     app.run(debug=True, host="0.0.0.0", port=5054)
@@ -0,0 +1,147 @@
+"""
+Static asset serving for images/ and rgba_sam_outputs/.
+
+URLs handed out by the index carry a version token (`?v=`), a hash of the
+file's content; a request whose token matches the file on disk is served as
+immutable for a year, anything else must revalidate (ETag/Last-Modified, so
+unchanged files cost a 304). Masks are PNGs, already deflated, so there are no
+gzip variants. `bundle` streams every mask of an image or group as one zip
+(/bundle, a download; the editor still loads masks one URL at a time, but
+those hit its cache once versioned).
+"""
+import hashlib
+import io
+import zipfile
+from functools import lru_cache
+from pathlib import Path
+
+from flask import Response, abort, request, send_file, send_from_directory
+from werkzeug.security import safe_join
+
+import mask_store
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+@lru_cache(maxsize=4096)
+def _content_token(path, mtime_ns, size):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()[:12]
+
+
+def version_token(path):
+    """Hash of a file's content; hashed once per (mtime, size) of the file."""
+    st = Path(path).stat()
+    return _content_token(str(path), st.st_mtime_ns, st.st_size)
+
+
+def mask_token(image_dir, name):
+    """Token for a mask URL: its own file if it has one, else the manifest it's rebuilt from."""
+    image_dir = Path(image_dir)
+    for candidate in (image_dir / name, image_dir / mask_store.MANIFEST):
+        if candidate.is_file():
+            return version_token(candidate)
+    return None
+
+
+def _cache_control(resp, current_token):
+    requested = request.args.get("v")
+    resp.headers["Cache-Control"] = IMMUTABLE if requested and requested == current_token else REVALIDATE
+    return resp
+
+
+def send_asset(root, filename):
+    """send_from_directory with version-aware cache headers."""
+    root = str(root)
+    path = safe_join(root, filename)
+    if path is None or not Path(path).is_file():
+        return send_from_directory(root, filename)  # raises the usual 404
+    token = version_token(path)
+    resp = send_from_directory(root, filename, conditional=True, etag=token)
+    return _cache_control(resp, token)
+
+
+def send_rendered(image_dir, name):
+    """Send a full-frame mask rebuilt by mask_store, conditional on the source token.
+    The token is checked first, so a revalidation never renders the PNG."""
+    token = mask_token(image_dir, name)
+    if token and request.if_none_match.contains(token):
+        resp = Response(status=304)
+        resp.set_etag(token)
+        return _cache_control(resp, token)
+    data = mask_store.render_full(image_dir, name)
+    if data is None:
+        abort(404)
+    resp = send_file(io.BytesIO(data), mimetype="image/png", etag=token or False,
+                     last_modified=(Path(image_dir) / mask_store.MANIFEST).stat().st_mtime)
+    return _cache_control(resp, token)
+
+
+def _mask_png(image_dir, name):
+    data = mask_store.render_full(image_dir, name)
+    if data is not None:
+        return data
+    path = Path(image_dir) / name
+    return path.read_bytes() if path.is_file() else None
+
+
+def bundle_names(image_dir, group=None):
+    """Mask file names of an image, or of one "{x}_{y}" group."""
+    image_dir = Path(image_dir)
+    if group is None:
+        manifest = mask_store.load_manifest(image_dir)
+        if manifest and manifest["masks"]:
+            return sorted(n for n, e in manifest["masks"].items() if e["w"])
+        return sorted(p.name for p in image_dir.glob("mask_*_rgba.png"))
+    names = set()
+    for rel in mask_store.virtual_files(image_dir):
+        if rel.startswith(f"{group}/"):
+            names.add(rel.split("/", 1)[1])
+    group_dir = image_dir / group
+    if group_dir.is_dir():
+        names.update(p.name for p in group_dir.glob("mask_*_rgba.png"))
+    return sorted(names)
+
+
+class _Sink(io.RawIOBase):
+    """Write-only buffer that zipfile streams into; drained between members."""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buf.extend(b)
+        return len(b)
+
+    def drain(self):
+        out = bytes(self.buf)
+        self.buf.clear()
+        return out
+
+
+def bundle_token(image_dir, names):
+    """ETag for a bundle: changes whenever any member or the manifest does."""
+    h = hashlib.sha1()
+    for name in names:
+        h.update(f"{name}:{mask_token(image_dir, name)};".encode())
+    return h.hexdigest()[:16]
+
+
+def bundle(image_dir, names):
+    """Yield a zip (stored, PNGs are already deflated) of full-frame mask PNGs."""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as zf:
+        for name in names:
+            data = _mask_png(image_dir, name)
+            if data is None:
+                continue
+            zf.writestr(name, data)
+            yield sink.drain()
+    yield sink.drain()
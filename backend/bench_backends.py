@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark segmentation backends on the images in images/input/downscaled.
+
+Each backend runs in its own subprocess so peak RSS is per backend. Results are
+printed as a table and written as JSON.
+
+    python bench_backends.py --backends vit_h vit_b vit_b_int8 --out bench_backends.json
+"""
+import argparse
+import json
+import multiprocessing as mp
+import resource
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import sam_pool
+
+ROOT = Path(__file__).resolve().parent
+IMAGES_DIR = ROOT / "images" / "input" / "downscaled"
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _run_backend(backend, images, overrides, out_q):
+    try:
+        pool = sam_pool.get_pool(backend)
+        t0 = time.perf_counter()
+        pool.warm()
+        load_s = time.perf_counter() - t0
+        rows = []
+        for path in images:
+            img = np.array(Image.open(path).convert("RGB"))
+            with pool.borrow(overrides=overrides) as gen:
+                t0 = time.perf_counter()
+                masks = gen.generate(img)
+                elapsed = time.perf_counter() - t0
+            rows.append({"image": path.name, "shape": list(img.shape[:2]),
+                         "seconds": round(elapsed, 3), "masks": len(masks)})
+            print(f"  {backend:12s} {path.name:24s} {elapsed:7.2f}s {len(masks):4d} masks", flush=True)
+        out_q.put({"backend": backend, "load_seconds": round(load_s, 3),
+                   "peak_rss_mb": round(_peak_rss_mb(), 1), "images": rows})
+    except Exception as e:
+        out_q.put({"backend": backend, "error": repr(e)})
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--backends", nargs="+", default=["vit_h", "vit_l", "vit_b", "vit_b_int8"],
+                    choices=sorted(sam_pool.BACKENDS))
+    ap.add_argument("--images", type=Path, default=IMAGES_DIR)
+    ap.add_argument("--limit", type=int, default=0, help="only the first N images")
+    ap.add_argument("--generator", default="{}", help="JSON generator overrides, e.g. '{\"points_per_side\": 16}'")
+    ap.add_argument("--out", type=Path, default=ROOT / "bench_backends.json")
+    args = ap.parse_args()
+
+    images = sorted(p for p in args.images.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+    if args.limit:
+        images = images[:args.limit]
+    overrides = json.loads(args.generator)
+
+    ctx = mp.get_context("spawn")
+    results = []
+    for backend in args.backends:
+        ckpt = sam_pool.SamPool(backend).checkpoint
+        if not ckpt.exists():
+            print(f"skipping {backend}: checkpoint {ckpt.name} not found")
+            results.append({"backend": backend, "error": f"missing {ckpt.name}"})
+            continue
+        q = ctx.Queue()
+        proc = ctx.Process(target=_run_backend, args=(backend, images, overrides, q))
+        proc.start()
+        results.append(q.get())
+        proc.join()
+
+    print(f"\n{'backend':12s} {'load s':>8s} {'mean s':>8s} {'p50 s':>8s} {'masks':>7s} {'peak MB':>9s}")
+    for r in results:
+        if "error" in r:
+            print(f"{r['backend']:12s} error: {r['error']}")
+            continue
+        secs = [row["seconds"] for row in r["images"]] or [0.0]
+        masks = [row["masks"] for row in r["images"]] or [0]
+        r["mean_seconds"] = round(float(np.mean(secs)), 3)
+        r["mean_masks"] = round(float(np.mean(masks)), 1)
+        print(f"{r['backend']:12s} {r['load_seconds']:8.2f} {r['mean_seconds']:8.2f} "
+              f"{float(np.median(secs)):8.2f} {r['mean_masks']:7.1f} {r['peak_rss_mb']:9.0f}")
+
+    with open(args.out, "w") as f:
+        json.dump({"generator": overrides, "results": results}, f, indent=2)
+    print(f"wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the local font recognizer over the samples in images/fonts.
+
+A sample is an image directory (groups.json, or x_y group folders of masks) or
+an image file. Labels come from images/fonts/labels.json ({"<sample>" or
+"<sample>/<x>_<y>": font name}) and, for image files, from the file name
+(Times-New-Roman2.jpg -> Times New Roman). Reports index load time, ink
+extraction, uncached classification per image batch and per single group (the
+old one-call-per-group pattern), cached lookups, and top-1/top-k accuracy on
+the labelled groups.
+
+    python bench_fonts.py --out bench_fonts.json
+"""
+import argparse
+import json
+import re
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import font_recognizer
+
+ROOT = Path(__file__).resolve().parent
+SAMPLES_DIR = ROOT / "images" / "fonts"
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+MASK_RE = re.compile(r"mask_(\d+)_rgba\.png$")
+
+
+def label_from_name(path):
+    return re.sub(r"[\d_]+$", "", path.stem).replace("-", " ").strip() or None
+
+
+def _norm(name):
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def image_groups(image_dir):
+    """groups.json of a sample, or groups rebuilt from its x_y folders (no text box)."""
+    path = image_dir / "groups.json"
+    if path.exists():
+        with open(path) as f:
+            return json.load(f).get("groups", [])
+    groups = []
+    for d in sorted(image_dir.iterdir()):
+        if d.is_dir() and re.fullmatch(r"\d+_\d+", d.name):
+            idx = sorted(int(m.group(1)) for m in map(MASK_RE.match, (p.name for p in d.iterdir())) if m)
+            if idx:
+                groups.append({"text_box": None, "mask_indices": idx, "folder": d.name})
+    return groups
+
+
+def load_samples(root, labels):
+    """[(sample name, [(group id, ink or None, label)])], one entry per image batch."""
+    samples = []
+    for p in sorted(root.iterdir()):
+        if p.is_dir():
+            items = []
+            for g in image_groups(p):
+                gid = g.get("folder") or f"{g['text_box'][0]}_{g['text_box'][1]}"
+                rgba = font_recognizer.group_rgba(p, g)
+                ink = None if rgba is None else font_recognizer.ink_bitmap(rgba)
+                items.append((gid, ink, labels.get(f"{p.name}/{gid}", labels.get(p.name))))
+            if items:
+                samples.append((p.name, items))
+            else:
+                print(f"  {p.name}: no groups, skipped")
+        elif p.suffix.lower() in IMAGE_SUFFIXES:
+            img = np.array(Image.open(p).convert("RGB"))
+            rgba = np.dstack([img, np.full(img.shape[:2], 255, np.uint8)])
+            samples.append((p.name, [(p.stem, font_recognizer.ink_bitmap(rgba),
+                                      labels.get(p.name, label_from_name(p)))]))
+    return samples
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--samples", type=Path, default=SAMPLES_DIR)
+    ap.add_argument("--repeat", type=int, default=3, help="timed passes; the best one is reported")
+    ap.add_argument("--top-k", type=int, default=font_recognizer.FONT_TOP_K)
+    ap.add_argument("--out", type=Path, default=ROOT / "bench_fonts.json")
+    args = ap.parse_args()
+
+    labels = {}
+    if (args.samples / "labels.json").exists():
+        with open(args.samples / "labels.json") as f:
+            labels = json.load(f)
+    if not font_recognizer.ensure_index():
+        raise SystemExit("no font index")
+    rec = font_recognizer.get_recognizer()
+
+    t0 = time.perf_counter()
+    index = rec.index()
+    index_seconds = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    samples = load_samples(args.samples, labels)
+    ink_seconds = time.perf_counter() - t0
+    n_groups = sum(len(items) for _, items in samples)
+    if not n_groups:
+        raise SystemExit(f"no samples in {args.samples}")
+
+    def best_of(fn):
+        times = []
+        for _ in range(max(1, args.repeat)):
+            t = time.perf_counter()
+            out = fn()
+            times.append(time.perf_counter() - t)
+        return min(times), out
+
+    batched_s, results = best_of(lambda: [rec.classify([ink for _, ink, _ in items], args.top_k, use_cache=False)
+                                          for _, items in samples])
+    single_s, _ = best_of(lambda: [rec.classify([ink], args.top_k, use_cache=False)
+                                   for _, items in samples for _, ink, _ in items])
+    for _, items in samples:  # fill the cache
+        rec.classify([ink for _, ink, _ in items], args.top_k)
+    cached_s, _ = best_of(lambda: [rec.classify([ink for _, ink, _ in items], args.top_k)
+                                   for _, items in samples])
+
+    glyphs, top1, topk, labelled, rows = 0, 0, 0, 0, []
+    for (name, items), res in zip(samples, results):
+        for (gid, _, label), r in zip(items, res):
+            fonts = [f["font"] for f in r["fonts"]] if r else []
+            glyphs += r["glyphs"] if r else 0
+            if label:
+                labelled += 1
+                hits = [_norm(label) in _norm(f) for f in fonts]
+                top1 += bool(hits[:1] and hits[0])
+                topk += any(hits)
+            rows.append({"sample": name, "group": gid, "label": label, "glyphs": r["glyphs"] if r else 0,
+                         "fonts": r["fonts"] if r else []})
+            print(f"  {name}/{gid:12s} {label or '-':20s} " + (", ".join(fonts[:3]) or "no glyphs"))
+
+    summary = {
+        "fonts_in_index": len(index.fonts),
+        "index_glyphs": len(index.labels),
+        "index_load_seconds": round(index_seconds, 4),
+        "groups": n_groups,
+        "glyphs": glyphs,
+        "ink_seconds": round(ink_seconds, 4),
+        "batched_ms_per_group": round(1000 * batched_s / n_groups, 3),
+        "single_ms_per_group": round(1000 * single_s / n_groups, 3),
+        "cached_ms_per_group": round(1000 * cached_s / n_groups, 3),
+        "glyphs_per_second": round(glyphs / batched_s, 1) if batched_s else None,
+        "labelled": labelled,
+        "top1_accuracy": round(top1 / labelled, 3) if labelled else None,
+        f"top{args.top_k}_accuracy": round(topk / labelled, 3) if labelled else None,
+    }
+    print(json.dumps(summary, indent=2))
+    with open(args.out, "w") as f:
+        json.dump({"summary": summary, "groups": rows}, f, indent=2)
+    print(f"wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for process.group_masks_by_text against the original
+full-frame implementation, on synthetic masks shaped like SAM output.
+
+    python bench_grouping.py --width 1200 --height 1600 --masks 140 --boxes 40
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from process import group_masks_by_text
+
+
+def group_masks_by_text_reference(masks, text_boxes):
+    # the original O(boxes x masks x H x W) implementation
+    groups = []
+    for text_box in text_boxes:
+        x, y, w, h = text_box
+        group_masks = []
+        for i, mask in enumerate(masks):
+            seg = mask["segmentation"]
+            text_mask = np.zeros_like(seg, dtype=bool)
+            text_mask[y:y+h, x:x+w] = True
+            mask_in_text = np.logical_and(seg, text_mask)
+            mask_area = np.sum(seg)
+            overlap_area = np.sum(mask_in_text)
+            if mask_area > 0 and overlap_area / mask_area > 0.5:
+                group_masks.append(i)
+        if group_masks:
+            groups.append({"text_box": text_box, "mask_indices": group_masks})
+    return groups
+
+
+def synthetic_masks(width, height, n_masks, n_boxes, seed=0):
+    rng = np.random.default_rng(seed)
+    masks = []
+    for _ in range(n_masks):
+        seg = np.zeros((height, width), dtype=np.uint8)
+        cx, cy = int(rng.integers(0, width)), int(rng.integers(0, height))
+        # mostly glyph-sized blobs, a few large regions
+        scale = 400 if rng.random() < 0.1 else 40
+        ax, ay = int(rng.integers(3, scale)), int(rng.integers(3, scale))
+        cv2.ellipse(seg, (cx, cy), (ax, ay), 0, 0, 360, 1, -1)
+        seg = seg.astype(bool)
+        ys, xs = np.nonzero(seg)
+        if len(xs) == 0:
+            continue
+        masks.append({
+            "segmentation": seg,
+            "area": int(seg.sum()),
+            "bbox": [int(xs.min()), int(ys.min()), int(xs.max() - xs.min()), int(ys.max() - ys.min())],
+        })
+    text_boxes = []
+    for _ in range(n_boxes):
+        x, y = int(rng.integers(0, width - 50)), int(rng.integers(0, height - 30))
+        w, h = int(rng.integers(20, 300)), int(rng.integers(15, 120))
+        text_boxes.append((x, y, w, h))
+    return masks, text_boxes
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--width", type=int, default=1200)
+    ap.add_argument("--height", type=int, default=1600)
+    ap.add_argument("--masks", type=int, default=140)
+    ap.add_argument("--boxes", type=int, default=40)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    masks, text_boxes = synthetic_masks(args.width, args.height, args.masks, args.boxes, args.seed)
+    print(f"{len(masks)} masks, {len(text_boxes)} text boxes, {args.width}x{args.height}")
+
+    t0 = time.perf_counter()
+    expected = group_masks_by_text_reference(masks, text_boxes)
+    t_ref = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    got = group_masks_by_text(None, masks, text_boxes)
+    t_new = time.perf_counter() - t0
+
+    assert got == expected, "grouping output differs from reference"
+    print(f"reference: {t_ref * 1000:.1f} ms")
+    print(f"prefiltered: {t_new * 1000:.1f} ms ({t_ref / max(t_new, 1e-9):.0f}x)")
+    print(f"{len(got)} groups, identical output")
+
+
+if __name__ == "__main__":
+    main()
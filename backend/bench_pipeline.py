@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+End-to-end pipeline benchmark over the images in images/input/downscaled.
+
+Runs the stages of `segment_image` one by one (decode, downscale, model load,
+masks, OCR, grouping, style, mask write, group links) on every image, bypassing the
+result cache and the image index, and records per stage wall time, CPU time
+(all threads), peak RSS and bytes written. Outputs go to a scratch directory,
+never to images/sam_shapes.
+
+--stub replaces SAM with a deterministic connected-components mask generator,
+so the non-ML stages can be measured without the checkpoint. --compare checks
+a run against an earlier JSON and exits non-zero on regressions.
+
+    python bench_pipeline.py --out bench_pipeline.json
+    python bench_pipeline.py --stub --out stub_run.json --compare bench_pipeline.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import mask_store
+import ocr
+import process
+import sam_pool
+import style
+import tiling
+
+ROOT = Path(__file__).resolve().parent
+IMAGES_DIR = ROOT / "images" / "input" / "downscaled"
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+STAGES = ("decode", "downscale", "masks", "ocr", "grouping", "style", "write", "group_links")
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+@contextmanager
+def timed(record, name):
+    """Record wall/CPU seconds and peak RSS of the block into record[name]."""
+    t0, c0 = time.perf_counter(), time.process_time()
+    entry = {}
+    try:
+        yield entry
+    finally:
+        entry.update(wall_seconds=round(time.perf_counter() - t0, 4),
+                     cpu_seconds=round(time.process_time() - c0, 4),
+                     peak_rss_mb=round(_peak_rss_mb(), 1))
+        record[name] = entry
+
+
+class StubGenerator:
+    """Deterministic stand-in for SamAutomaticMaskGenerator.
+
+    Dark and light connected components of an adaptive threshold become masks in
+    SAM's output format, largest first; glyphs come out glyph-sized, so OCR region
+    selection and grouping see realistic input.
+    """
+
+    def __init__(self, max_masks=150, min_area=30):
+        self.max_masks = max_masks
+        self.min_area = min_area
+
+    def generate(self, img):
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        binary = cv2.adaptiveThreshold(gray, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 31, 5)
+        found = []
+        for fg in (binary, 1 - binary):
+            n, labels, stats, _ = cv2.connectedComponentsWithStats(fg, connectivity=8)
+            for i in range(1, n):
+                x, y, w, h, area = (int(v) for v in stats[i])
+                if area >= self.min_area:
+                    found.append((area, x, y, w, h, labels, i))
+        found.sort(key=lambda f: -f[0])
+        masks = []
+        for area, x, y, w, h, labels, i in found[:self.max_masks]:
+            masks.append({
+                "segmentation": labels == i,
+                "area": area,
+                "bbox": [x, y, w - 1, h - 1],
+                "predicted_iou": 1.0,
+                "stability_score": 1.0,
+            })
+        return masks
+
+
+def load_model(args, record):
+    if args.stub:
+        with timed(record, "model_load"):
+            return StubGenerator(args.stub_masks)
+    pool = sam_pool.get_pool(args.backend)
+    with timed(record, "model_load"):
+        pool.warm()
+    return pool
+
+
+def generate(model, img):
+    if isinstance(model, StubGenerator):
+        return model.generate(img)
+    if tiling.TILED:
+        return tiling.generate_tiled(img, model)
+    with model.borrow() as gen:
+        return gen.generate(img)
+
+
+def run_image(path, model, scratch):
+    stages = {}
+    data = path.read_bytes()
+    with timed(stages, "decode"):
+        img = process.decode_image(data, max_dim=process.MAX_DIM)
+    with timed(stages, "downscale"):
+        img = process.downscale_image(img)
+    with timed(stages, "masks") as e:
+        masks = generate(model, img)
+        e["count"] = len(masks)
+    with timed(stages, "ocr") as e:
+        ocr_stats = {}
+        text_boxes = process.detect_text_boxes(img, masks, ocr_stats)
+        e.update(count=len(text_boxes), regions=ocr_stats.get("regions"), engine=ocr_stats.get("engine"))
+    with timed(stages, "grouping") as e:
+        groups = process.group_masks_by_text(img, masks, text_boxes)
+        e["count"] = len(groups)
+    with timed(stages, "style"):
+        style_info = style.extract_style(img, masks, groups, *process.mask_extents(masks))
+    out_dir = scratch / path.stem
+    with timed(stages, "write") as e:
+        st = mask_store.write_masks(masks, out_dir, img)
+        with open(out_dir / "groups.json", "w") as f:
+            json.dump({"groups": groups}, f, indent=2)
+        style.write_style(out_dir, style_info)
+        e.update(files=st["files"] + 2,
+                 bytes_written=st["bytes_written"] + (out_dir / "groups.json").stat().st_size
+                 + (out_dir / style.STYLE_JSON).stat().st_size)
+    with timed(stages, "group_links") as e:
+        e["files"] = mask_store.link_groups(out_dir, groups)
+        # hardlinks and symlinks cost no data blocks; copies do
+        e["bytes_written"] = 0 if mask_store.GROUP_LINKS in ("hardlink", "symlink", "manifest") else sum(
+            p.stat().st_size for p in out_dir.glob("*_*/mask_*_rgba.png"))
+    return {"image": path.name, "input_bytes": len(data), "shape": list(img.shape[:2]), "stages": stages}
+
+
+def summarize(results):
+    summary = {}
+    for stage in STAGES:
+        walls = [r["stages"][stage]["wall_seconds"] for r in results]
+        cpus = [r["stages"][stage]["cpu_seconds"] for r in results]
+        if not walls:
+            continue
+        summary[stage] = {
+            "mean_wall_seconds": round(float(np.mean(walls)), 4),
+            "p50_wall_seconds": round(float(np.percentile(walls, 50)), 4),
+            "p95_wall_seconds": round(float(np.percentile(walls, 95)), 4),
+            "total_cpu_seconds": round(float(np.sum(cpus)), 4),
+            "bytes_written": int(sum(r["stages"][stage].get("bytes_written", 0) for r in results)),
+        }
+    summary["peak_rss_mb"] = max((r["stages"][s]["peak_rss_mb"] for r in results for s in STAGES), default=0)
+    return summary
+
+
+def compare(summary, baseline, tolerance):
+    """Print per-stage mean wall deltas; return the stages slower than baseline by > tolerance."""
+    regressions = []
+    print(f"\n{'stage':12s} {'base s':>9s} {'now s':>9s} {'change':>8s}")
+    for stage in STAGES:
+        if stage not in summary or stage not in baseline:
+            continue
+        base, now = baseline[stage]["mean_wall_seconds"], summary[stage]["mean_wall_seconds"]
+        change = (now - base) / base if base else 0.0
+        # sub-millisecond stages are all noise
+        flag = change > tolerance and now - base > 0.001
+        if flag:
+            regressions.append(stage)
+        print(f"{stage:12s} {base:9.4f} {now:9.4f} {change:+7.0%}{'  REGRESSION' if flag else ''}")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--images", type=Path, default=IMAGES_DIR)
+    ap.add_argument("--limit", type=int, default=0, help="only the first N images")
+    ap.add_argument("--backend", default=None, choices=sorted(sam_pool.BACKENDS))
+    ap.add_argument("--stub", action="store_true", help="replace SAM with a deterministic stub")
+    ap.add_argument("--stub-masks", type=int, default=150, help="masks per image from the stub")
+    ap.add_argument("--out", type=Path, default=ROOT / "bench_pipeline.json")
+    ap.add_argument("--compare", type=Path, help="baseline JSON from an earlier run")
+    ap.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown per stage")
+    ap.add_argument("--keep", action="store_true", help="keep the scratch output directory")
+    args = ap.parse_args()
+
+    images = sorted(p for p in args.images.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+    if args.limit:
+        images = images[:args.limit]
+    if not images:
+        raise SystemExit(f"no images in {args.images}")
+
+    startup = {}
+    model = load_model(args, startup)
+    scratch = Path(tempfile.mkdtemp(prefix="bench_pipeline_"))
+    results = []
+    try:
+        for path in images:
+            r = run_image(path, model, scratch)
+            results.append(r)
+            s = r["stages"]
+            print(f"  {path.name:24s} " + " ".join(f"{k}={s[k]['wall_seconds']:.3f}" for k in STAGES), flush=True)
+    finally:
+        if args.keep:
+            print(f"outputs kept in {scratch}")
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    summary = summarize(results)
+    report = {
+        "config": {
+            "backend": "stub" if args.stub else (args.backend or sam_pool.DEFAULT_BACKEND),
+            "pipeline": process.pipeline_params(args.backend),
+            "ocr_mode": ocr.OCR_MODE,
+            "ocr_engine": ocr.engine_name(),
+            "group_links": mask_store.GROUP_LINKS,
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "started_at": time.time(),
+        },
+        "model_load": startup["model_load"],
+        "images": results,
+        "summary": summary,
+    }
+    print(f"\n{'stage':12s} {'mean s':>9s} {'p95 s':>9s} {'cpu s':>9s} {'bytes':>12s}")
+    for stage in STAGES:
+        row = summary[stage]
+        print(f"{stage:12s} {row['mean_wall_seconds']:9.4f} {row['p95_wall_seconds']:9.4f} "
+              f"{row['total_cpu_seconds']:9.3f} {row['bytes_written']:12d}")
+    print(f"model load {startup['model_load']['wall_seconds']:.2f}s, peak RSS {summary['peak_rss_mb']:.0f} MB")
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(summary, json.load(f)["summary"], args.tolerance)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.out}")
+    if regressions:
+        raise SystemExit(f"regressed stages: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
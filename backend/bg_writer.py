@@ -0,0 +1,54 @@
+"""
+Background disk writer for files that aren't needed on the latency path
+(uploaded originals, downscaled copies). Writes run in order on one thread.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bg-writer")
+
+
+def _write_bytes(path, data):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def encode_rgb(path, img_rgb):
+    """The bytes `write_rgb` would write for an RGB array (format by path suffix)."""
+    ok, buf = cv2.imencode(Path(path).suffix or ".jpg", cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR))
+    if not ok:
+        raise ValueError(f"could not encode {path}")
+    return buf.tobytes()
+
+
+def _write_rgb(path, img_rgb):
+    _write_bytes(path, encode_rgb(path, img_rgb))
+
+
+def _logged(fn, path, *args):
+    try:
+        fn(path, *args)
+    except Exception as e:
+        print(f"Background write of {path} failed: {e}")
+
+
+def write_bytes(path, data):
+    """Queue raw bytes to be written to path; returns a Future."""
+    return _executor.submit(_logged, _write_bytes, path, data)
+
+
+def write_rgb(path, img_rgb):
+    """Queue an RGB array to be encoded (by path suffix) and written; returns a Future."""
+    return _executor.submit(_logged, _write_rgb, path, img_rgb)
+
+
+def flush():
+    """Block until everything queued so far has been written."""
+    _executor.submit(lambda: None).result()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Bulk ingestion of many images: a directory, a zip, or a folder of both.
+
+Three stages overlap:
+  * a producer thread reads, decodes and downscales images ahead of the model,
+    keeping up to BULK_PREFETCH of them ready;
+  * the model stage encodes up to BULK_BATCH images in one image-encoder forward
+    pass, then generates each image's masks from its precomputed embedding;
+  * OCR, grouping, mask PNG writing and publishing of one image run on a
+    post-processing thread while the model decodes the masks of the next one;
+    each image's masks are handed over as soon as they are generated, so at
+    most two images' full-frame masks are held at a time.
+
+Images whose outputs already exist (sam_shapes/<stem>/masks.json) are skipped, so
+an interrupted run is resumed by running it again; result cache hits skip the
+model as well. Progress and throughput (images per minute) are reported per image.
+
+    python bulk.py ~/shoots/flyers/          # or flyers.zip
+    python bulk.py flyers.zip --batch 2 --force
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import bg_writer
+import embeddings
+import mask_store
+import metrics
+import process
+import sam_pool
+import tiling
+import uploads
+
+ROOT = Path(__file__).resolve().parent
+DOWNSCALE_DIR = ROOT / "images" / "input" / "downscaled"
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif"}
+
+BULK_BATCH = int(os.environ.get("BULK_BATCH", "4"))
+BULK_PREFETCH = int(os.environ.get("BULK_PREFETCH", "8"))
+
+_DONE = object()
+
+
+def iter_sources(source):
+    """(filename, bytes) for every image in a directory (recursively, zips
+    included) or a zip archive, in name order."""
+    source = Path(source)
+    if source.is_dir():
+        for p in sorted(source.rglob("*")):
+            if p.is_file() and p.suffix.lower() == ".zip":
+                yield from iter_sources(p)
+            elif p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES and not p.name.startswith("."):
+                yield p.name, p.read_bytes()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zf:
+            for info in sorted(zf.infolist(), key=lambda i: i.filename):
+                name = Path(info.filename).name
+                # skip folders and macOS resource forks (__MACOSX/._name)
+                if info.is_dir() or name.startswith(".") or Path(name).suffix.lower() not in IMAGE_SUFFIXES:
+                    continue
+                yield name, zf.read(info)
+    else:
+        raise ValueError(f"{source} is neither a directory nor a zip archive")
+
+
+def is_processed(filename):
+    # the manifest is the last file write_masks writes
+    return (process.output_dir(filename) / mask_store.MANIFEST).exists()
+
+
+def generate_batch(pool, images, overrides=None):
+    """Yield masks and full-frame embedding for each image in turn; one encoder
+    pass per batch."""
+    if tiling.TILED:
+        for img in images:
+            yield tiling.generate_tiled(img, pool, overrides), None
+        return
+    with pool.borrow(overrides=overrides) as gen, \
+            metrics.span("masks", backend=pool.backend, size=len(images)):
+        yield from embeddings.generate_batch(gen, images)
+
+
+def _take_batch(q, size):
+    """Block for one item, then take whatever else is ready up to `size`."""
+    item = q.get()
+    if item is _DONE:
+        return [], True
+    items = [item]
+    while len(items) < size:
+        try:
+            item = q.get_nowait()
+        except queue.Empty:
+            break
+        if item is _DONE:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+def ingest(source, backend=None, overrides=None, batch=BULK_BATCH, force=False, progress=None):
+    """Segment every image of `source`. Returns a stats dict; `progress(stats)` is
+    called after every image."""
+    stats = {"total": 0, "done": 0, "cached": 0, "skipped": 0, "failed": 0, "errors": [],
+             "seconds": 0.0, "images_per_minute": 0.0}
+    lock = threading.Lock()
+    t0 = time.perf_counter()
+
+    def report(name, outcome, error=None):
+        with lock:
+            stats[outcome] += 1
+            if error:
+                stats["errors"].append({"image": name, "error": error})
+            elapsed = time.perf_counter() - t0
+            stats["seconds"] = round(elapsed, 1)
+            # throughput counts images that went through the pipeline, not skips
+            stats["images_per_minute"] = round(60 * (stats["done"] + stats["cached"]) / max(elapsed, 1e-9), 2)
+            snapshot = dict(stats, errors=list(stats["errors"]))
+        print(f"[{snapshot['done'] + snapshot['cached'] + snapshot['skipped'] + snapshot['failed']}"
+              f"/{snapshot['total']}] {name}: {outcome} ({snapshot['images_per_minute']:.1f} img/min)")
+        metrics.log("bulk_image", image=name, outcome=outcome, error=error)
+        if progress is not None:
+            progress(snapshot)
+
+    ready = queue.Queue(maxsize=max(1, BULK_PREFETCH))
+
+    def produce():
+        try:
+            for name, data in iter_sources(source):
+                with lock:
+                    stats["total"] += 1
+                # the same rule as /upload
+                filename = uploads.claim_name(name, data)
+                if not force and is_processed(filename):
+                    report(filename, "skipped")
+                    continue
+                try:
+                    img = process.downscale_image(process.decode_image(data, max_dim=process.MAX_DIM))
+                except Exception as e:
+                    report(filename, "failed", f"decode: {e}")
+                    continue
+                bg_writer.write_bytes(uploads.ORIGINAL_DIR / filename, data)
+                down_bytes = bg_writer.encode_rgb(DOWNSCALE_DIR / filename, img)
+                bg_writer.write_bytes(DOWNSCALE_DIR / filename, down_bytes)
+                ready.put((filename, img, embeddings.source_token(down_bytes)))
+        except Exception as e:
+            traceback.print_exc()
+            with lock:
+                stats["errors"].append({"image": None, "error": f"reading {source}: {e}"})
+        finally:
+            ready.put(_DONE)
+
+    def finish(filename, img, masks, key):
+        try:
+            process.finish_segmentation(img, masks, process.output_dir(filename), key)
+            report(filename, "done")
+        except Exception as e:
+            traceback.print_exc()
+            report(filename, "failed", str(e))
+
+    pool = sam_pool.get_pool(backend)
+    pool.warm()
+    producer = threading.Thread(target=produce, name="bulk-producer", daemon=True)
+    producer.start()
+    # one post-processing thread: OCR and PNG encoding fan out over their own pools
+    post = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bulk-post")
+    pending = []
+    finished = False
+    try:
+        while not finished:
+            items, finished = _take_batch(ready, max(1, batch))
+            todo = []
+            for filename, img, source in items:
+                try:
+                    key, groups = process.restore_cached(img, process.output_dir(filename), backend, overrides)
+                except Exception as e:
+                    report(filename, "failed", f"cache: {e}")
+                    continue
+                if groups is not None:
+                    report(filename, "cached")
+                else:
+                    todo.append((filename, img, key, source))
+            if not todo:
+                continue
+            results = generate_batch(pool, [img for _, img, _, _ in todo], overrides)
+            done = 0
+            try:
+                for masks, emb in results:
+                    filename, img, key, source = todo[done]
+                    done += 1
+                    if emb is not None and pool.backend == sam_pool.DEFAULT_BACKEND:
+                        emb.source = source
+                        embeddings.get_cache().put(Path(filename).stem, emb)
+                    # let post-processing lag at most one image behind, bounding memory
+                    while pending:
+                        pending.pop(0).result()
+                    pending.append(post.submit(finish, filename, img, masks, key))
+                    masks = emb = None
+            except Exception as e:
+                traceback.print_exc()
+                for filename, *_ in todo[done:]:
+                    report(filename, "failed", f"masks: {e}")
+    finally:
+        for fut in pending:
+            fut.result()
+        post.shutdown(wait=True)
+        producer.join()
+        bg_writer.flush()
+        metrics.flush()
+    stats["seconds"] = round(time.perf_counter() - t0, 1)
+    return stats
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("source", type=Path, help="directory of images and/or zips, or a zip")
+    ap.add_argument("--backend", default=None, choices=sorted(sam_pool.BACKENDS))
+    ap.add_argument("--generator", default="{}", help="JSON generator overrides")
+    ap.add_argument("--batch", type=int, default=BULK_BATCH, help="images per encoder forward pass")
+    ap.add_argument("--force", action="store_true", help="re-process images that already have outputs")
+    args = ap.parse_args()
+
+    overrides = json.loads(args.generator) or None
+    sam_pool.generator_kwargs(args.backend, overrides)
+    stats = ingest(args.source, args.backend, overrides, args.batch, args.force)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
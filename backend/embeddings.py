@@ -0,0 +1,309 @@
+"""
+Cached SAM image embeddings for interactive point/box re-segmentation.
+
+The image encoder is the expensive half of SAM; once an image's embedding is
+known, each point/box prompt only needs the small mask decoder. Embeddings are
+kept in an in-memory LRU keyed by image stem and spilled to EMBED_DIR as .npy so
+they survive restarts and can be shared between the job workers (which capture
+them for free while generating masks) and the process that answers prompts.
+At most EMBED_DISK_SIZE embeddings are kept on disk (about 4 MB each for
+vit_h); the least recently used go first.
+
+Each embedding records the `source_token` of the downscaled file it belongs to
+(a hash of its bytes), and one whose file has changed since is not used.
+"""
+import base64
+import hashlib
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import mask_store
+import metrics
+import sam_pool
+
+ROOT = Path(__file__).resolve().parent
+EMBED_DIR = Path(os.environ.get("EMBED_DIR", ROOT / "cache" / "embeddings"))
+EMBED_CACHE_SIZE = int(os.environ.get("EMBED_CACHE_SIZE", "8"))
+EMBED_DISK_SIZE = int(os.environ.get("EMBED_DISK_SIZE", "64"))
+
+
+def source_token(data):
+    """Identity of an image file's content, for telling a stale embedding apart."""
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+class Embedding:
+    def __init__(self, features, original_size, input_size, source=None):
+        self.features = features  # float32 (1, C, h, w)
+        self.original_size = tuple(original_size)
+        self.input_size = tuple(input_size)
+        self.source = source  # source_token of the image file, if known
+
+
+@contextmanager
+def capture(mask_generator):
+    """Record the full-image embedding that `mask_generator.generate` computes anyway.
+
+    Yields a list that holds one Embedding afterwards (empty if the generator never
+    encoded the whole frame, e.g. with crop layers that skip it).
+    """
+    predictor = mask_generator.predictor
+    captured = []
+    original_reset = predictor.reset_image
+
+    def reset_image():
+        if predictor.is_image_set and not captured:
+            captured.append(Embedding(
+                predictor.features.detach().cpu().numpy(),
+                predictor.original_size,
+                predictor.input_size,
+            ))
+        original_reset()
+
+    predictor.reset_image = reset_image
+    try:
+        yield captured
+    finally:
+        del predictor.reset_image
+
+
+@contextmanager
+def inject(mask_generator, emb):
+    """The reverse of `capture`: make `mask_generator.generate` use a precomputed
+    full-frame embedding instead of running the encoder on that frame again.
+    Crops of other sizes (crop_n_layers > 0) are still encoded as usual.
+    """
+    import torch
+
+    predictor = mask_generator.predictor
+    original_set_image = predictor.set_image
+    used = []
+
+    def set_image(image, image_format="RGB"):
+        if not used and tuple(image.shape[:2]) == tuple(emb.original_size):
+            used.append(True)
+            predictor.reset_image()
+            predictor.features = torch.from_numpy(emb.features).to(predictor.device)
+            predictor.original_size = emb.original_size
+            predictor.input_size = emb.input_size
+            predictor.is_image_set = True
+            return
+        original_set_image(image, image_format)
+
+    predictor.set_image = set_image
+    try:
+        yield
+    finally:
+        del predictor.set_image
+
+
+def encode_batch(model, images):
+    """Embeddings of several RGB images from one image-encoder forward pass.
+
+    Every image is resized and padded to the encoder's square input exactly as
+    SamPredictor.set_image does, so the results are interchangeable with it.
+    """
+    import torch
+    from segment_anything.utils.transforms import ResizeLongestSide
+
+    transform = ResizeLongestSide(model.image_encoder.img_size)
+    batch, sizes = [], []
+    for img in images:
+        x = torch.as_tensor(transform.apply_image(img), device=model.device)
+        x = x.permute(2, 0, 1).contiguous()[None, :, :, :]
+        sizes.append((img.shape[:2], tuple(x.shape[-2:])))
+        batch.append(model.preprocess(x))
+    with torch.no_grad():
+        features = model.image_encoder(torch.cat(batch)).cpu().numpy()
+    return [Embedding(features[i:i + 1], original, input_size)
+            for i, (original, input_size) in enumerate(sizes)]
+
+
+# set once an encoder has rejected a batch, so later batches don't retry
+_batch_unsupported = False
+
+
+def generate_batch(mask_generator, images):
+    """Yield (masks, Embedding or None) for each image, encoding all of them in
+    one image-encoder forward pass and decoding masks image by image. Falls back
+    to encoding one image at a time if the encoder rejects a batch (e.g. a
+    TorchScript encoder traced for batch size 1).
+
+    A generator, so callers can reduce one image's masks before the next is decoded.
+    """
+    global _batch_unsupported
+    embs = None
+    if len(images) > 1 and not _batch_unsupported:
+        try:
+            with metrics.span("encode_batch", size=len(images)):
+                embs = encode_batch(mask_generator.predictor.model, images)
+        except Exception as e:
+            _batch_unsupported = True
+            print(f"Batched encoding failed ({e}); encoding images one at a time")
+    for i, img in enumerate(images):
+        if embs is not None:
+            with inject(mask_generator, embs[i]):
+                masks = mask_generator.generate(img)
+            emb = embs[i]
+        else:
+            with capture(mask_generator) as captured:
+                masks = mask_generator.generate(img)
+            emb = captured[0] if captured else None
+        yield masks, emb
+        # don't hold on to this image's masks while the next one is decoded
+        masks = None
+
+
+class EmbeddingCache:
+    def __init__(self, root=EMBED_DIR, capacity=EMBED_CACHE_SIZE, disk_capacity=EMBED_DISK_SIZE):
+        self.root = Path(root)
+        self.capacity = max(1, capacity)
+        self.disk_capacity = max(1, disk_capacity)
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self._predictor = None
+        self._predict_lock = threading.Lock()
+
+    def _paths(self, key):
+        return self.root / f"{key}.npy", self.root / f"{key}.json"
+
+    def put(self, key, emb):
+        with self._lock:
+            self._mem[key] = emb
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.capacity:
+                self._mem.popitem(last=False)
+        self.root.mkdir(parents=True, exist_ok=True)
+        npy, meta = self._paths(key)
+        tmp = npy.with_name(f".{npy.name}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, emb.features)
+        os.replace(tmp, npy)
+        tmp = meta.with_name(f".{meta.name}.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"original_size": emb.original_size, "input_size": emb.input_size,
+                       "source": emb.source}, f)
+        os.replace(tmp, meta)
+        self._trim()
+
+    def _trim(self):
+        """Drop the least recently used spilled embeddings beyond disk_capacity."""
+        files = []
+        for p in self.root.glob("*.npy"):
+            try:
+                files.append((p.stat().st_mtime, p))
+            except FileNotFoundError:  # trimmed by another process
+                continue
+        files.sort()
+        for _, p in files[:max(0, len(files) - self.disk_capacity)]:
+            p.unlink(missing_ok=True)
+            p.with_suffix(".json").unlink(missing_ok=True)
+
+    def get(self, key, source=None):
+        """Embedding for key from memory or disk; None if missing or, when
+        `source` is given, made from another version of the image."""
+        with self._lock:
+            emb = self._mem.get(key)
+            if emb is not None:
+                self._mem.move_to_end(key)
+        if emb is None:
+            npy, meta = self._paths(key)
+            try:
+                with open(meta) as f:
+                    info = json.load(f)
+                emb = Embedding(np.load(npy), info["original_size"], info["input_size"], info.get("source"))
+                os.utime(npy)  # recency for _trim
+            except (FileNotFoundError, KeyError, ValueError):
+                return None
+            with self._lock:
+                self._mem[key] = emb
+                while len(self._mem) > self.capacity:
+                    self._mem.popitem(last=False)
+        if source is not None and emb.source != source:
+            return None
+        return emb
+
+    def predictor(self):
+        if self._predictor is None:
+            from segment_anything import SamPredictor
+            self._predictor = SamPredictor(sam_pool.get_pool().warm().model)
+        return self._predictor
+
+    def embed(self, key, img_rgb, source=None):
+        """Run the image encoder once and cache the result."""
+        with self._predict_lock:
+            p = self.predictor()
+            p.set_image(img_rgb)
+            emb = Embedding(p.features.detach().cpu().numpy(), p.original_size, p.input_size, source)
+            p.reset_image()
+        self.put(key, emb)
+        return emb
+
+    def predict(self, emb, points=None, labels=None, box=None, multimask=True):
+        """Run only the mask decoder on a cached embedding.
+
+        Returns (masks bool (K, H, W), scores (K,)) best first.
+        """
+        import torch
+
+        with self._predict_lock:
+            p = self.predictor()
+            p.reset_image()
+            p.features = torch.from_numpy(emb.features).to(p.device)
+            p.original_size = emb.original_size
+            p.input_size = emb.input_size
+            p.is_image_set = True
+            try:
+                masks, scores, _ = p.predict(
+                    point_coords=None if points is None else np.asarray(points, dtype=np.float32),
+                    point_labels=None if labels is None else np.asarray(labels, dtype=np.int32),
+                    box=None if box is None else np.asarray(box, dtype=np.float32),
+                    multimask_output=multimask,
+                )
+            finally:
+                p.reset_image()
+        order = np.argsort(-scores)
+        return masks[order], scores[order]
+
+
+def prompt_masks(src, points=None, labels=None, box=None, multimask=True):
+    """Masks for point/box prompts on the image at `src`, embedding it first if
+    its cached embedding is missing or stale. Returns {"width", "height",
+    "masks": [{"score", "x", "y", "w", "h", "png" (base64 RGBA crop)}, ...]}."""
+    src = Path(src)
+    data = src.read_bytes()
+    img_rgb = np.array(Image.open(io.BytesIO(data)).convert("RGB"))
+    token = source_token(data)
+    cache = get_cache()
+    emb = cache.get(src.stem, token)
+    if emb is None or emb.original_size != img_rgb.shape[:2]:
+        emb = cache.embed(src.stem, img_rgb, token)
+    masks, scores = cache.predict(emb, points, labels, box, multimask)
+    out = []
+    for seg, score in zip(masks, scores):
+        (x, y, w, h), rgba = mask_store.crop_rgba({"segmentation": seg}, img_rgb)
+        if rgba is None:
+            continue
+        buf = io.BytesIO()
+        Image.fromarray(rgba).save(buf, format="PNG")
+        out.append({"score": float(score), "x": x, "y": y, "w": w, "h": h,
+                    "png": base64.b64encode(buf.getvalue()).decode()})
+    return {"width": img_rgb.shape[1], "height": img_rgb.shape[0], "masks": out}
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache()
+    return _cache
@@ -0,0 +1,157 @@
+"""
+Persistent index of the files under images/sam_shapes.
+
+The pipeline calls `update_image` after it writes an image's masks and groups, so
+`/all_images` reads one SQLite table instead of walking the tree on every request.
+Each change bumps a version counter used for ETags and for pushing new entries
+over server-sent events. The database is shared by the web process and the job
+workers (WAL mode).
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import assets
+import mask_store
+
+ROOT = Path(__file__).resolve().parent
+IMAGES_DIR = ROOT / "images"
+SHAPES_DIR = IMAGES_DIR / "sam_shapes"
+INDEX_DB = Path(os.environ.get("IMAGE_INDEX_DB", ROOT / "cache" / "image_index.sqlite3"))
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif"}
+
+_init_lock = threading.Lock()
+_initialized = False
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL UNIQUE,
+    image TEXT NOT NULL,
+    grp TEXT,
+    v TEXT,
+    added_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_image ON files (image, grp);
+CREATE TABLE IF NOT EXISTS meta (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    version INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+@contextmanager
+def _connect():
+    INDEX_DB.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(INDEX_DB), timeout=30)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _ensure():
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+        with _connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            # several processes may open a fresh database at once; only the
+            # one whose insert lands rebuilds it
+            cur = conn.execute("INSERT OR IGNORE INTO meta (id, version, updated_at) VALUES (0, 0, ?)",
+                               (time.time(),))
+            fresh = cur.rowcount == 1
+        _initialized = True
+    if fresh:
+        rebuild()
+
+
+def scan_image(image_dir):
+    """(url, group, version token) for every listable file of one sam_shapes/<image> folder."""
+    image_dir = Path(image_dir)
+    rels = set()
+    for f in image_dir.rglob("*"):
+        if f.suffix.lower() in IMAGE_SUFFIXES and f.name != mask_store.SPRITE and f.is_file():
+            rels.add(f.relative_to(image_dir).as_posix())
+    rels.update(mask_store.virtual_files(image_dir))
+    base = image_dir.relative_to(IMAGES_DIR).as_posix()
+    out = []
+    for rel in sorted(rels):
+        parts = rel.split("/")
+        path = image_dir / rel
+        # sprite-only masks are versioned by the manifest they're rebuilt from
+        token = assets.version_token(path) if path.is_file() else assets.mask_token(image_dir, parts[-1])
+        out.append((f"/images/{base}/{rel}", parts[0] if len(parts) > 1 else None, token))
+    return out
+
+
+def _bump(conn):
+    conn.execute("UPDATE meta SET version = version + 1, updated_at = ? WHERE id = 0", (time.time(),))
+
+
+def update_image(image_dir):
+    """Replace the index entries of one image with what is on disk now."""
+    _ensure()
+    image_dir = Path(image_dir)
+    entries = scan_image(image_dir) if image_dir.is_dir() else []
+    now = time.time()
+    with _connect() as conn:
+        existing = dict(conn.execute("SELECT url, v FROM files WHERE image = ?", (image_dir.name,)))
+        current = {url: v for url, _, v in entries}
+        stale = existing.keys() - current.keys()
+        if stale:
+            conn.executemany("DELETE FROM files WHERE url = ?", [(u,) for u in stale])
+        changed = [(v, url) for url, v in current.items() if url in existing and existing[url] != v]
+        conn.executemany("UPDATE files SET v = ? WHERE url = ?", changed)
+        new = [(url, image_dir.name, grp, v, now) for url, grp, v in entries if url not in existing]
+        conn.executemany("INSERT INTO files (url, image, grp, v, added_at) VALUES (?, ?, ?, ?, ?)", new)
+        if stale or changed or new:
+            _bump(conn)
+    return len(entries)
+
+
+def rebuild():
+    """Re-index every image folder (first start, or after manual changes on disk)."""
+    with _connect() as conn:
+        conn.execute("DELETE FROM files")
+        _bump(conn)
+    if SHAPES_DIR.is_dir():
+        for d in sorted(SHAPES_DIR.iterdir()):
+            if d.is_dir():
+                update_image(d)
+
+
+def version():
+    """(version, updated_at) of the index."""
+    _ensure()
+    with _connect() as conn:
+        return conn.execute("SELECT version, updated_at FROM meta WHERE id = 0").fetchone()
+
+
+def list_files(image=None, group=None, after=0, limit=None):
+    """Rows (seq, url, image, group, version token) in insertion order, optionally
+    filtered and paged by seq."""
+    _ensure()
+    query = "SELECT seq, url, image, grp, v FROM files WHERE seq > ?"
+    args = [after]
+    if image:
+        query += " AND image = ?"
+        args.append(image)
+    if group:
+        query += " AND grp = ?"
+        args.append(group)
+    query += " ORDER BY seq"
+    if limit:
+        query += " LIMIT ?"
+        args.append(limit)
+    with _connect() as conn:
+        return conn.execute(query, args).fetchall()
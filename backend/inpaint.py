@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Crop-to-mask inpainting of stored SAM masks.
+
+Instead of the whole frame plus a full-size mask, each request carries only the
+padded bbox of the masks to fill, grown to a square and resized to the model's
+native resolution (INPAINT_SIZE). Masks whose padded boxes overlap are merged
+into one request. Results are scaled back and blended into the frame through a
+feathered copy of the mask, so seams fall inside the padding.
+
+Masks come from what `write_masks` stored (any layout) and groups from
+groups.json. The client is anything with `inpaint_many(items, prompt,
+with_stats=True)`: the Cloudflare worker client by default, or the in-process
+pipeline of local_inpaint.py with INPAINT_BACKEND=local.
+
+    python inpaint.py poster --group 383_546 --prompt "plain paper background"
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import mask_store
+
+ROOT = Path(__file__).resolve().parent
+DOWNSCALE_DIR = ROOT / "images" / "input" / "downscaled"
+SHAPES_DIR = ROOT / "images" / "sam_shapes"
+OUTPUT_DIR = ROOT / "images" / "inpainted"
+
+# cf (the Cloudflare worker) | local (local_inpaint.py)
+INPAINT_BACKEND = os.environ.get("INPAINT_BACKEND", "cf")
+INPAINT_URL = os.environ.get("INPAINT_URL", "https://hackharvard3.julian-beaudry.workers.dev")
+INPAINT_API_KEY = os.environ.get("INPAINT_API_KEY", "")
+# SD 1.5 inpainting works at 512x512; sides must be multiples of 8
+INPAINT_SIZE = int(os.environ.get("INPAINT_SIZE", "512"))
+# context around a mask bbox, as a fraction of its longer side (at least INPAINT_MIN_PAD px)
+INPAINT_PAD = float(os.environ.get("INPAINT_PAD", "0.25"))
+INPAINT_MIN_PAD = int(os.environ.get("INPAINT_MIN_PAD", "16"))
+# blend ramp width around the mask, in full-image pixels
+INPAINT_FEATHER = int(os.environ.get("INPAINT_FEATHER", "8"))
+
+
+def get_client(backend=None):
+    # the clients live at the repository root, next to the worker and diffusion scripts
+    if str(ROOT.parent) not in sys.path:
+        sys.path.append(str(ROOT.parent))
+    backend = backend or INPAINT_BACKEND
+    if backend == "local":
+        import local_inpaint
+        return local_inpaint.get_inpainter()
+    if backend != "cf":
+        raise ValueError(f"unknown inpainting backend {backend!r}")
+    import cf_client
+    return cf_client.get_client(INPAINT_URL, INPAINT_API_KEY)
+
+
+def _pad_box(box, shape):
+    x, y, w, h = box
+    H, W = shape[:2]
+    pad = max(INPAINT_MIN_PAD, int(INPAINT_PAD * max(w, h)))
+    return max(0, x - pad), max(0, y - pad), min(W, x + w + pad), min(H, y + h + pad)
+
+
+def _square(box, shape):
+    """Grow an (x0, y0, x1, y1) box to a square inside the image where it fits."""
+    x0, y0, x1, y1 = box
+    H, W = shape[:2]
+    side = min(max(x1 - x0, y1 - y0), W, H)
+    cx, cy = (x0 + x1) // 2, (y0 + y1) // 2
+    nx0 = min(max(0, cx - side // 2), W - side)
+    ny0 = min(max(0, cy - side // 2), H - side)
+    # never shrink below the original box
+    return min(nx0, x0), min(ny0, y0), max(nx0 + side, x1), max(ny0 + side, y1)
+
+
+def _overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def merge_regions(boxes):
+    """Merge overlapping (x0, y0, x1, y1) boxes; returns [(box, member indices)]."""
+    regions = [(b, [i]) for i, b in enumerate(boxes)]
+    merged = True
+    while merged:
+        merged = False
+        out = []
+        for box, members in regions:
+            for j, (obox, omembers) in enumerate(out):
+                if _overlaps(box, obox):
+                    out[j] = ((min(box[0], obox[0]), min(box[1], obox[1]),
+                               max(box[2], obox[2]), max(box[3], obox[3])), omembers + members)
+                    merged = True
+                    break
+            else:
+                out.append((box, members))
+        regions = out
+    return regions
+
+
+def model_size(w, h, size=INPAINT_SIZE):
+    """Target (w, h): longer side `size`, both multiples of 8."""
+    scale = size / max(w, h)
+    return max(8, int(round(w * scale / 8)) * 8), max(8, int(round(h * scale / 8)) * 8)
+
+
+def feather(mask, width=INPAINT_FEATHER):
+    """Float alpha in [0, 1]: 1 over the (dilated) mask, ramping to 0 over `width` px."""
+    alpha = mask.astype(np.uint8) * 255
+    if width > 0:
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * width + 1, 2 * width + 1))
+        alpha = cv2.dilate(alpha, kernel)
+        alpha = cv2.GaussianBlur(alpha, (0, 0), sigmaX=width / 2)
+    return alpha.astype(np.float32) / 255.0
+
+
+def plan(img_rgb, image_dir, names):
+    """Requests to send: [{"box", "masks", "mask_full", "image", "mask"}]; image/mask are
+    the crops at model resolution, mask_full the union mask at crop resolution."""
+    crops = []
+    for name in names:
+        box, rgba = mask_store.load_crop(image_dir, name)
+        if rgba is not None:
+            crops.append((name, box, rgba[..., 3] > 0))
+    padded = [_pad_box(box, img_rgb.shape) for _, box, _ in crops]
+    regions = []
+    for box, members in merge_regions(padded):
+        x0, y0, x1, y1 = _square(box, img_rgb.shape)
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        for i in members:
+            _, (mx, my, mw, mh), m = crops[i]
+            mask[my - y0:my - y0 + mh, mx - x0:mx - x0 + mw] |= m
+        tw, th = model_size(x1 - x0, y1 - y0)
+        regions.append({
+            "box": (x0, y0, x1, y1),
+            "masks": [crops[i][0] for i in members],
+            "mask_full": mask,
+            "image": Image.fromarray(img_rgb[y0:y1, x0:x1]).resize((tw, th), Image.LANCZOS),
+            # dilated a little so the model repaints the mask's antialiased rim too
+            "mask": Image.fromarray(feather(mask, 2) > 0).convert("L").resize((tw, th), Image.NEAREST),
+        })
+    return regions
+
+
+def inpaint_masks(img_rgb, image_dir, names, prompt, client=None, **params):
+    """Fill the given stored masks of an image. Returns (result RGB array, per-region stats)."""
+    client = client or get_client()
+    regions = plan(img_rgb, image_dir, names)
+    results = client.inpaint_many([(r["image"], r["mask"]) for r in regions], prompt,
+                                  with_stats=True, **params)
+    out = img_rgb.copy()
+    stats = []
+    for r, (filled, req_stats) in zip(regions, results):
+        t0 = time.perf_counter()
+        x0, y0, x1, y1 = r["box"]
+        filled = np.asarray(filled.convert("RGB").resize((x1 - x0, y1 - y0), Image.LANCZOS),
+                            dtype=np.float32)
+        alpha = feather(r["mask_full"])[..., None]
+        region = out[y0:y1, x0:x1].astype(np.float32)
+        out[y0:y1, x0:x1] = np.clip(alpha * filled + (1 - alpha) * region + 0.5, 0, 255).astype(np.uint8)
+        stats.append({
+            "box": [x0, y0, x1 - x0, y1 - y0],
+            "masks": r["masks"],
+            "model_size": list(r["image"].size),
+            **req_stats,
+            "blend_seconds": round(time.perf_counter() - t0, 3),
+        })
+    return out, stats
+
+
+def group_mask_names(image_dir, group):
+    """Mask names of one "{x}_{y}" group from groups.json."""
+    with open(Path(image_dir) / "groups.json") as f:
+        groups = json.load(f).get("groups", [])
+    for g in groups:
+        tb = g.get("text_box")
+        if tb and f"{tb[0]}_{tb[1]}" == group:
+            return [mask_store.mask_name(i) for i in g.get("mask_indices", [])]
+    raise KeyError(f"no group {group!r} in {image_dir}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("image", help="image stem under images/sam_shapes")
+    ap.add_argument("--group", help='"{x}_{y}" group to fill')
+    ap.add_argument("--masks", nargs="*", default=[], help="mask file names to fill")
+    ap.add_argument("--prompt", default="fill background naturally")
+    ap.add_argument("--steps", type=int, help="num_steps for the model")
+    ap.add_argument("--backend", choices=("cf", "local"), default=INPAINT_BACKEND)
+    args = ap.parse_args()
+
+    image_dir = SHAPES_DIR / args.image
+    names = list(args.masks)
+    if args.group:
+        names += group_mask_names(image_dir, args.group)
+    if not names:
+        ap.error("give --group and/or --masks")
+    src = next(DOWNSCALE_DIR.glob(f"{args.image}.*"))
+    img = np.array(Image.open(src).convert("RGB"))
+    params = {"num_steps": args.steps} if args.steps else {}
+
+    t0 = time.perf_counter()
+    out, stats = inpaint_masks(img, image_dir, names, args.prompt, client=get_client(args.backend),
+                               **params)
+    elapsed = time.perf_counter() - t0
+    for s in stats:
+        print(f"  region {s['box']} {len(s['masks'])} mask(s) -> {s['model_size']}: "
+              f"{s['bytes_sent']} B sent, {s['seconds']:.2f}s")
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    dst = OUTPUT_DIR / f"{args.image}.png"
+    Image.fromarray(out).save(dst)
+    print(f"{len(names)} mask(s) in {len(stats)} request(s), "
+          f"{sum(s['bytes_sent'] for s in stats)} B sent, {elapsed:.2f}s -> {dst}")
+
+
+if __name__ == "__main__":
+    main()
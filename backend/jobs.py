@@ -0,0 +1,476 @@
+"""
+Asynchronous segmentation jobs.
+
+`/upload` hands the uploaded bytes to a job here (`/bulk_upload` a staging
+directory of many images, run through bulk.ingest as one job); a pool of worker
+processes (each holding its own warm SAM model) runs the pipeline and reports
+progress per stage into a shared job table that `/jobs/<id>` reads.
+
+Under `serve.py` the queue lives in one inference process instead of in every
+HTTP worker: `serve()` exposes it over a local socket and the web workers reach
+it through `RemoteJobQueue`. With JOB_SHARE_WEIGHTS the model is loaded once in
+that process and the job workers are forked from it, sharing the weights
+copy-on-write instead of each loading their own.
+"""
+import multiprocessing as mp
+import os
+import shutil
+import signal
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.managers import BaseManager
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+DOWNSCALE_DIR = ROOT / "images" / "input" / "downscaled"
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "1"))
+JOB_QUEUE_DEPTH = int(os.environ.get("JOB_QUEUE_DEPTH", "8"))
+# finished jobs are kept around this long so clients can still poll them
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", "3600"))
+# straighten photographed posters (helper.affine_crop) before segmenting
+RECTIFY = os.environ.get("RECTIFY", "0") == "1"
+# load the model once and fork the job workers from it (serve.py only; fork is POSIX-only)
+JOB_SHARE_WEIGHTS = os.environ.get("JOB_SHARE_WEIGHTS", "1") == "1"
+
+STAGES = ("decode", "downscale", "rectify", "masks", "ocr", "grouping", "write")
+
+
+class QueueFull(Exception):
+    pass
+
+
+# set in each job worker: shared dict of worker pid -> its sam_pool.all_stats()
+_pool_stats = None
+
+
+def _report_pools():
+    # the models live in the workers, so they publish their pool stats for /model_status
+    if _pool_stats is not None:
+        from sam_pool import all_stats
+        _pool_stats[os.getpid()] = all_stats()
+
+
+def _init_worker(ready, pool_stats):
+    global _pool_stats
+    _pool_stats = pool_stats
+    # Ctrl-C reaches the whole process group; shutdown is driven by the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # warm the default model once per worker so the first job doesn't pay for it
+    # (a no-op when the worker was forked from an already warm parent)
+    if os.environ.get("SAM_PRELOAD", "1") == "1":
+        from sam_pool import get_pool
+        get_pool().warm()
+    _report_pools()
+    ready[os.getpid()] = time.time()
+
+
+def _ping():
+    return os.getpid()
+
+
+def _update(jobs, job_id, **fields):
+    # manager proxies only propagate assignment, not in-place mutation
+    rec = dict(jobs[job_id])
+    rec.update(fields)
+    rec["updated_at"] = time.time()
+    jobs[job_id] = rec
+
+
+def _run_job(jobs, job_id, file_bytes, filename, backend=None, overrides=None, profile=False):
+    import bg_writer
+    import metrics
+    import numpy as np
+    from embeddings import source_token
+    from process import MAX_DIM, decode_image, downscale_image, segment_image
+
+    stage_started = {}
+
+    def progress(stage, **info):
+        now = time.perf_counter()
+        rec = dict(jobs[job_id])
+        timings = dict(rec.get("stage_seconds", {}))
+        prev = rec.get("stage")
+        if prev in stage_started:
+            timings[prev] = round(now - stage_started[prev], 3)
+        stage_started[stage] = now
+        details = dict(rec.get("stage_info", {}))
+        details.update(info)
+        _update(jobs, job_id, stage=stage, stage_seconds=timings, stage_info=details)
+
+    _update(jobs, job_id, state="running", started_at=time.time())
+    t0 = time.perf_counter()
+    sampler = None
+    if profile:
+        from profiler import Sampler
+        sampler = Sampler().start()
+    state = "error"
+    try:
+        progress("decode")
+        img = decode_image(file_bytes, max_dim=MAX_DIM)
+        progress("downscale")
+        img_small = downscale_image(img)
+        del img
+        if RECTIFY:
+            from helper import affine_crop
+            progress("rectify")
+            img_small = np.ascontiguousarray(affine_crop(img_small, filename))
+        # the downscaled copy is written in the background; SAM works on the array
+        # directly. Prompts are decoded on the file, so its embedding records
+        # which version of the file it came from.
+        down_bytes = bg_writer.encode_rgb(DOWNSCALE_DIR / filename, img_small)
+        bg_writer.write_bytes(DOWNSCALE_DIR / filename, down_bytes)
+        groups = segment_image(img_small, filename, progress=progress, backend=backend,
+                               overrides=overrides, source=source_token(down_bytes))
+        progress("done")
+        state = "done"
+        _update(jobs, job_id, state="done", stage=None, finished_at=time.time(),
+                result={"groups": groups or []})
+    except Exception as e:
+        traceback.print_exc()
+        _update(jobs, job_id, state="error", error=str(e), finished_at=time.time())
+    finally:
+        seconds = time.perf_counter() - t0
+        metrics.inc("jobs_total", state=state)
+        metrics.observe("job_seconds", seconds)
+        metrics.log("job", id=job_id, filename=filename, state=state, seconds=round(seconds, 3),
+                    stages=jobs[job_id].get("stage_seconds"))
+        if sampler is not None:
+            _update(jobs, job_id, profile=sampler.stop().save(f"job-{filename}").name)
+        _report_pools()
+        # the web process reads our counters from the snapshot
+        metrics.flush()
+
+
+def _run_bulk_job(jobs, job_id, source, backend=None, overrides=None, force=False):
+    import bulk
+    import metrics
+
+    def progress(stats):
+        _update(jobs, job_id, stage="ingest", stage_info=stats)
+
+    _update(jobs, job_id, state="running", started_at=time.time())
+    try:
+        stats = bulk.ingest(source, backend=backend, overrides=overrides, force=force, progress=progress)
+        _update(jobs, job_id, state="done", stage=None, stage_info=stats, finished_at=time.time(),
+                result={"groups": [], "bulk": stats})
+        metrics.inc("jobs_total", state="done")
+    except Exception as e:
+        traceback.print_exc()
+        _update(jobs, job_id, state="error", error=str(e), finished_at=time.time())
+        metrics.inc("jobs_total", state="error")
+    finally:
+        # the originals were copied to images/input/original as they were read
+        shutil.rmtree(source, ignore_errors=True)
+        _report_pools()
+        metrics.flush()
+
+
+class JobQueue:
+    def __init__(self, workers=JOB_WORKERS, max_depth=JOB_QUEUE_DEPTH, share_weights=False):
+        self.workers = max(1, workers)
+        self.max_depth = max(1, max_depth)
+        self.share_weights = share_weights and "fork" in mp.get_all_start_methods()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._closing = False
+        self._manager = None
+        self._executor = None
+        self._broken = None
+        self._ready = None
+        self._pool_stats = None
+        self.jobs = None
+
+    def start(self):
+        if self._executor is not None:
+            return self
+        self._manager = mp.get_context("spawn").Manager()
+        self.jobs = self._manager.dict()
+        self._ready = self._manager.dict()
+        self._pool_stats = self._manager.dict()
+        if self.share_weights:
+            from sam_pool import get_pool
+            get_pool().warm()
+            ctx = mp.get_context("fork")
+        else:
+            ctx = mp.get_context("spawn")
+        self._executor = self._new_executor(ctx)
+        # start every worker now rather than on the first upload, so readiness
+        # means "can take a job"; forked workers must exist before any other
+        # thread of this process (e.g. the job server) starts
+        pings = [self._executor.submit(_ping) for _ in range(self.workers)]
+        if self.share_weights:
+            wait(pings)
+        return self
+
+    def _new_executor(self, ctx):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx,
+                                   initializer=_init_worker,
+                                   initargs=(self._ready, self._pool_stats))
+
+    def _recover(self):
+        """Replace the executor if a worker died: a ProcessPoolExecutor is broken
+        for good once one of its processes exits, failing every later submit.
+        The jobs that were in flight have already been failed by `_on_done`."""
+        with self._lock:
+            broken = self._broken
+            if broken is None or broken is not self._executor or self._closing:
+                return
+            self._broken = None
+            # the dead workers' pids must not count towards readiness
+            self._ready.clear()
+            self._pool_stats.clear()
+            # the job server's threads are running by now, so don't fork: the
+            # replacement workers load their own model
+            self._executor = self._new_executor(mp.get_context("spawn"))
+        broken.shutdown(wait=False)
+        print("Job worker died; restarted the worker pool")
+
+    def _submit(self, job_id, fn, *args):
+        """Hand a job made by `_new_job` to the executor, replacing the executor
+        once if it turns out to be broken."""
+        try:
+            for attempt in range(2):
+                executor = self._executor
+                try:
+                    fut = executor.submit(fn, self.jobs, job_id, *args)
+                    break
+                except BrokenProcessPool:
+                    if attempt:
+                        raise
+                    with self._lock:
+                        self._broken = executor
+                    self._recover()
+        except Exception:
+            self._abandon(job_id)
+            raise
+        fut.add_done_callback(lambda fut: self._on_done(fut, job_id, executor))
+        return job_id
+
+    def submit(self, file_bytes, filename, backend=None, overrides=None, profile=False):
+        """Enqueue a job and return its id; raise QueueFull when at capacity.
+
+        With `profile`, the job is run under the sampling profiler."""
+        job_id = self._new_job(filename, backend)
+        return self._submit(job_id, _run_job, file_bytes, filename, backend, overrides, profile)
+
+    def submit_bulk(self, source, backend=None, overrides=None, force=False):
+        """Enqueue ingestion of a staging directory (images and/or zips) as one job.
+        The directory is removed when the job ends."""
+        job_id = self._new_job(None, backend, kind="bulk")
+        return self._submit(job_id, _run_bulk_job, str(source), backend, overrides, force)
+
+    def prompt(self, src, points=None, labels=None, box=None, multimask=True):
+        """Decode point/box prompts on an image right here, in the process that
+        owns the queue (and, when sharing weights, the already loaded model)."""
+        import embeddings
+        return embeddings.prompt_masks(src, points, labels, box, multimask)
+
+    def _new_job(self, filename, backend, kind="image"):
+        self.start()
+        self._recover()
+        with self._lock:
+            if self._closing:
+                raise QueueFull("shutting down")
+            if self._pending >= self.max_depth:
+                raise QueueFull(f"{self._pending} jobs pending")
+            self._pending += 1
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        record = {
+            "id": job_id,
+            "kind": kind,
+            "filename": filename,
+            "backend": backend,
+            "state": "queued",
+            "stage": None,
+            "stage_seconds": {},
+            "stage_info": {},
+            "error": None,
+            "result": None,
+            "profile": None,
+            "submitted_at": now,
+            "updated_at": now,
+        }
+        try:
+            self._expire()
+            self.jobs[job_id] = record
+        except Exception:
+            # the slot was taken above; nothing will release it otherwise
+            self._on_done(None)
+            raise
+        return job_id
+
+    def _abandon(self, job_id):
+        """Undo `_new_job` for a job that never reached the executor."""
+        self._on_done(None)
+        self.jobs.pop(job_id, None)
+
+    def _on_done(self, fut, job_id=None, executor=None):
+        with self._lock:
+            self._pending -= 1
+            broken = fut is not None and not fut.cancelled() and isinstance(fut.exception(), BrokenProcessPool)
+            if broken:
+                self._broken = executor
+        if broken:
+            # the worker died mid-job, so it never recorded the outcome
+            try:
+                _update(self.jobs, job_id, state="error", error="job worker process died",
+                        finished_at=time.time())
+            except Exception:
+                traceback.print_exc()
+
+    def _expire(self):
+        cutoff = time.time() - JOB_TTL_SECONDS
+        for job_id, rec in list(self.jobs.items()):
+            if rec["state"] in ("done", "error") and rec["updated_at"] < cutoff:
+                self.jobs.pop(job_id, None)
+
+    def get(self, job_id):
+        if self.jobs is None:
+            return None
+        rec = self.jobs.get(job_id)
+        return dict(rec) if rec is not None else None
+
+    def depth(self):
+        with self._lock:
+            return self._pending
+
+    def status(self):
+        """Readiness of the worker pool: ready once at least one worker is warm."""
+        from sam_pool import get_pool
+        # /readyz polls this, so a crashed pool is replaced without waiting for an upload
+        self._recover()
+        warm = len(self._ready) if self._ready is not None else 0
+        # prompts are decoded in this process, on its own (or the shared) model
+        interactive = get_pool().stats()["loaded"]
+        with self._lock:
+            return {
+                "interactive_model": interactive,
+                "ready": warm > 0 and not self._closing,
+                "workers": self.workers,
+                "warm_workers": warm,
+                "share_weights": self.share_weights,
+                "pending": self._pending,
+                "max_depth": self.max_depth,
+                "closing": self._closing,
+            }
+
+    def pool_stats(self):
+        """Model pool stats where the models are: per job worker (by pid), and
+        for this process, which decodes the interactive prompts."""
+        from sam_pool import all_stats
+        workers = dict(self._pool_stats) if self._pool_stats is not None else {}
+        return {"workers": {str(pid): s for pid, s in sorted(workers.items())},
+                "prompts": all_stats()}
+
+    def shutdown(self, wait=True):
+        """Stop taking jobs; with `wait`, let queued and running jobs finish first."""
+        with self._lock:
+            self._closing = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+
+class RemoteJobQueue:
+    """JobQueue interface for HTTP workers, backed by the inference process of `serve()`.
+
+    Connects lazily and once per process, so it is safe to create before
+    gunicorn forks its workers.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._pid = None
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def _remote(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    manager = JobServer(address=self.address, authkey=self.authkey)
+                    manager.connect()
+                    self._queue = manager.queue()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def start(self):
+        return self
+
+    def submit(self, file_bytes, filename, backend=None, overrides=None, profile=False):
+        return self._remote().submit(file_bytes, filename, backend, overrides, profile)
+
+    def submit_bulk(self, source, backend=None, overrides=None, force=False):
+        return self._remote().submit_bulk(source, backend, overrides, force)
+
+    def prompt(self, src, points=None, labels=None, box=None, multimask=True):
+        return self._remote().prompt(src, points, labels, box, multimask)
+
+    def get(self, job_id):
+        return self._remote().get(job_id)
+
+    def depth(self):
+        return self._remote().depth()
+
+    def status(self):
+        return self._remote().status()
+
+    def pool_stats(self):
+        return self._remote().pool_stats()
+
+    def shutdown(self, wait=True):
+        # the inference process owns the workers; serve.py stops it
+        pass
+
+
+_served = None
+
+
+def _served_queue():
+    return _served
+
+
+class JobServer(BaseManager):
+    pass
+
+
+JobServer.register("queue", callable=_served_queue,
+                   exposed=("submit", "submit_bulk", "prompt", "get", "depth", "status", "pool_stats"))
+
+
+def parse_address(addr):
+    host, _, port = addr.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def serve(address, authkey):
+    """Run the job queue as a standalone inference process until SIGTERM/SIGINT.
+
+    On shutdown new submissions are refused and queued jobs are drained.
+    """
+    global _served
+    _served = JobQueue(share_weights=JOB_SHARE_WEIGHTS).start()
+    server = JobServer(address=address, authkey=authkey).get_server()
+
+    def stop(signum, frame):
+        print(f"job server: signal {signum}, draining {_served.depth()} job(s)")
+        server.stop_event.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"job server listening on {address[0]}:{address[1]} "
+          f"({_served.workers} worker(s), share_weights={_served.share_weights})")
+    try:
+        server.serve_forever()
+    finally:
+        _served.shutdown(wait=True)
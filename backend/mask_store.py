@@ -0,0 +1,356 @@
+"""
+On-disk storage for per-mask RGBA outputs.
+
+Three layouts are supported, selected with MASK_STORAGE:
+    - full:    mask_###_rgba.png is a full-frame RGBA image (the original layout)
+    - cropped: mask_###_rgba.png is cropped to the mask's bbox; offsets live in masks.json
+    - packed:  every crop is packed into one sprite.png; masks.json maps names to sprite rects
+
+For cropped/packed images `render_full` rebuilds the full-frame RGBA PNG, pixel for
+pixel what the full layout would have written, so the frontend sees no difference.
+"""
+import io
+import json
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+MASK_STORAGE = os.environ.get("MASK_STORAGE", "cropped")
+MODES = ("full", "cropped", "packed")
+# zlib level for mask PNGs; PIL's default of 6 keeps rebuilt masks byte-identical
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", "6"))
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", str(os.cpu_count() or 1)))
+# how group folders reference their masks: hardlink | symlink | copy | manifest
+GROUP_LINKS = os.environ.get("GROUP_LINKS", "hardlink")
+MANIFEST = "masks.json"
+SPRITE = "sprite.png"
+MASK_FILE = re.compile(r"mask_\d+_rgba\.png")
+GROUP_DIR = re.compile(r"\d+_\d+")
+
+
+def mask_name(i):
+    return f"mask_{i:03d}_rgba.png"
+
+
+# A mask's "segmentation" is either a full-frame bool array (SAM's output) or,
+# when the mask has a "crop_origin" (x, y), just its bbox crop placed there in
+# the frame (tiled segmentation, masks restored from the result cache).
+
+def mask_window(m, x0, y0, x1, y1):
+    """Bool pixels of a mask inside the frame window [y0:y1, x0:x1]."""
+    seg = m["segmentation"]
+    if "crop_origin" not in m:
+        return seg[y0:y1, x0:x1].astype(bool, copy=False)
+    ox, oy = m["crop_origin"]
+    h, w = seg.shape
+    out = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=bool)
+    cx0, cy0, cx1, cy1 = max(x0, ox), max(y0, oy), min(x1, ox + w), min(y1, oy + h)
+    if cx1 > cx0 and cy1 > cy0:
+        out[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = seg[cy0 - oy:cy1 - oy, cx0 - ox:cx1 - ox]
+    return out
+
+
+def tight_box(m):
+    """(x, y, w, h) of the True pixels of a mask, searching only inside its bbox hint."""
+    seg = m["segmentation"]
+    ox, oy = m.get("crop_origin", (0, 0))
+    H, W = seg.shape
+    x0, y0, x1, y1 = 0, 0, W, H
+    if "bbox" in m:
+        bx, by, bw, bh = m["bbox"]
+        x0, y0 = max(int(bx) - ox, 0), max(int(by) - oy, 0)
+        x1, y1 = min(int(bx + bw) + 1 - ox, W), min(int(by + bh) + 1 - oy, H)
+    window = seg[y0:y1, x0:x1]
+    ys = np.flatnonzero(window.any(axis=1))
+    xs = np.flatnonzero(window.any(axis=0))
+    if len(xs) == 0:
+        return 0, 0, 0, 0
+    return (ox + x0 + int(xs[0]), oy + y0 + int(ys[0]),
+            int(xs[-1] - xs[0]) + 1, int(ys[-1] - ys[0]) + 1)
+
+
+def crop_rgba(m, img_rgb):
+    """Return ((x, y, w, h), rgba crop) for one mask; the crop is None for empty masks."""
+    x, y, w, h = tight_box(m)
+    if w == 0:
+        return (0, 0, 0, 0), None
+    seg = mask_window(m, x, y, x + w, y + h)
+    rgba = np.zeros((h, w, 4), dtype=np.uint8)
+    rgba[seg, :3] = img_rgb[y:y+h, x:x+w][seg]
+    rgba[seg, 3] = 255
+    return (x, y, w, h), rgba
+
+
+def full_rgba(m, img_rgb):
+    h, w = img_rgb.shape[:2]
+    seg = mask_window(m, 0, 0, w, h)
+    rgba = np.zeros((h, w, 4), dtype=np.uint8)
+    rgba[seg, :3] = img_rgb[seg]
+    rgba[seg, 3] = 255
+    return rgba
+
+
+_encode_pool = None
+
+
+def _get_encode_pool():
+    # PIL releases the GIL while deflating, so threads scale with cores
+    global _encode_pool
+    if _encode_pool is None:
+        _encode_pool = ThreadPoolExecutor(max_workers=max(1, ENCODE_WORKERS),
+                                          thread_name_prefix="png-encode")
+    return _encode_pool
+
+
+def _save_png(rgba, path, compress_level):
+    t0 = time.perf_counter()
+    # write-then-rename: files may be hardlinked from group folders or the result
+    # cache, so never truncate an existing inode in place
+    tmp = path.with_name(f".{path.name}.tmp")
+    Image.fromarray(rgba).save(tmp, format="PNG", compress_level=compress_level)
+    os.replace(tmp, path)
+    return path.stat().st_size, time.perf_counter() - t0
+
+
+def _pack_shelves(sizes, min_width):
+    """Shelf-pack (w, h) rects, tallest first. Returns positions and sheet size."""
+    sheet_w = max([min_width] + [w for w, _ in sizes])
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i][1])
+    positions = [None] * len(sizes)
+    x = y = shelf_h = 0
+    for i in order:
+        w, h = sizes[i]
+        if x + w > sheet_w:
+            y += shelf_h
+            x = shelf_h = 0
+        positions[i] = (x, y)
+        x += w
+        shelf_h = max(shelf_h, h)
+    return positions, sheet_w, y + shelf_h
+
+
+def write_masks(masks, out_dir, img_rgb, mode=None, compress_level=None):
+    """Write mask outputs into out_dir using the given (or configured) storage mode.
+
+    Masks are cropped and PNG-encoded on a thread pool. Returns a stats dict with
+    the number of files, bytes written and encode wall/cpu seconds.
+    """
+    mode = mode or MASK_STORAGE
+    if mode not in MODES:
+        raise ValueError(f"unknown mask storage mode {mode!r}, expected one of {MODES}")
+    level = PNG_COMPRESS_LEVEL if compress_level is None else compress_level
+    out_dir.mkdir(parents=True, exist_ok=True)
+    H, W = img_rgb.shape[:2]
+    manifest = {"mode": mode, "width": W, "height": H, "masks": {}}
+    pool = _get_encode_pool()
+    t0 = time.perf_counter()
+
+    if mode == "full":
+        def task(i, m):
+            return _save_png(full_rgba(m, img_rgb), out_dir / mask_name(i), level)
+        written = list(pool.map(task, range(len(masks)), masks))
+        keep = {mask_name(i) for i in range(len(masks))}
+    elif mode == "cropped":
+        def task(i, m):
+            box, rgba = crop_rgba(m, img_rgb)
+            if rgba is None:
+                return box, (0, 0.0)
+            return box, _save_png(rgba, out_dir / mask_name(i), level)
+        results = list(pool.map(task, range(len(masks)), masks))
+        for i, (box, _) in enumerate(results):
+            manifest["masks"][mask_name(i)] = dict(zip("xywh", box))
+        written = [w for _, w in results if w[0]]
+        keep = {mask_name(i) for i, (box, _) in enumerate(results) if box[2]}
+    else:
+        crops = list(pool.map(lambda m: crop_rgba(m, img_rgb), masks))
+        sizes = [(box[2], box[3]) for box, _ in crops]
+        positions, sheet_w, sheet_h = _pack_shelves(sizes, W)
+        sheet = np.zeros((max(sheet_h, 1), sheet_w, 4), dtype=np.uint8)
+        for i, ((box, rgba), (sx, sy)) in enumerate(zip(crops, positions)):
+            if rgba is not None:
+                sheet[sy:sy+box[3], sx:sx+box[2]] = rgba
+            entry = dict(zip("xywh", box))
+            entry.update(sx=sx, sy=sy)
+            manifest["masks"][mask_name(i)] = entry
+        written = [_save_png(sheet, out_dir / SPRITE, level)]
+        keep = {SPRITE}
+
+    # the manifest goes last so readers never see it ahead of the files it describes
+    tmp = out_dir / f".{MANIFEST}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, out_dir / MANIFEST)
+    _remove_stale(out_dir, keep)
+    stats = {
+        "mode": mode,
+        "files": len(written),
+        "bytes_written": sum(b for b, _ in written) + (out_dir / MANIFEST).stat().st_size,
+        "encode_seconds": round(time.perf_counter() - t0, 3),
+        "encode_cpu_seconds": round(sum(t for _, t in written), 3),
+    }
+    print('saved outputs to ', out_dir, stats)
+    return stats
+
+
+def _remove_stale(out_dir, keep):
+    """Delete mask files of an earlier run that the new manifest doesn't
+    describe; served as-is they would be drawn in the wrong place."""
+    for p in out_dir.iterdir():
+        if (MASK_FILE.fullmatch(p.name) or p.name == SPRITE) and p.name not in keep and p.is_file():
+            p.unlink(missing_ok=True)
+
+
+def link_groups(out_dir, groups, how=None):
+    """Make each group folder ("{x}_{y}") reference its masks without copying bytes.
+
+    Hardlinks fall back to copies across filesystems; with "manifest" no files are
+    created and groups.json alone records membership. Returns the number of entries made.
+    """
+    how = how or GROUP_LINKS
+    members = {}
+    if how != "manifest":
+        for g in groups:
+            tb = g.get('text_box', None)
+            if tb:
+                members.setdefault(f"{tb[0]}_{tb[1]}", set()).update(
+                    mask_name(mi) for mi in g.get('mask_indices', []))
+    # folders and entries left by an earlier run with other groups
+    for d in Path(out_dir).iterdir():
+        if not (d.is_dir() and GROUP_DIR.fullmatch(d.name)):
+            continue
+        if d.name not in members:
+            shutil.rmtree(d, ignore_errors=True)
+            continue
+        for f in d.iterdir():
+            if f.name not in members[d.name] and (f.is_file() or f.is_symlink()):
+                f.unlink(missing_ok=True)
+    if how == "manifest":
+        return 0
+    made = 0
+    for g in groups:
+        tb = g.get('text_box', None)
+        if not tb:
+            continue
+        group_dir = out_dir / f"{tb[0]}_{tb[1]}"
+        group_dir.mkdir(parents=True, exist_ok=True)
+        for mi in g.get('mask_indices', []):
+            src = out_dir / mask_name(mi)
+            dst = group_dir / mask_name(mi)
+            if not src.exists():
+                continue
+            try:
+                # relink so a re-run never leaves a group pointing at stale output
+                if dst.exists() or dst.is_symlink():
+                    dst.unlink()
+                if how == "symlink":
+                    dst.symlink_to(Path("..") / src.name)
+                elif how == "hardlink":
+                    try:
+                        os.link(src, dst)
+                    except OSError:
+                        shutil.copy2(src, dst)
+                else:
+                    shutil.copy2(src, dst)
+                made += 1
+            except Exception as e:
+                print(f"Failed to link {src} -> {dst}: {e}")
+    return made
+
+
+@lru_cache(maxsize=64)
+def _load_manifest(path, mtime):
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_manifest(image_dir):
+    path = Path(image_dir) / MANIFEST
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _load_manifest(str(path), mtime)
+
+
+@lru_cache(maxsize=8)
+def _load_sprite(path, mtime):
+    return np.array(Image.open(path).convert("RGBA"))
+
+
+def load_crop(image_dir, name):
+    """((x, y, w, h), rgba crop) of a stored mask in any layout; the crop is None if empty."""
+    image_dir = Path(image_dir)
+    manifest = load_manifest(image_dir)
+    if manifest is None or manifest["mode"] == "full":
+        rgba = np.array(Image.open(image_dir / name).convert("RGBA"))
+        box = tight_box({"segmentation": rgba[..., 3] > 0})
+        x, y, w, h = box
+        return box, (rgba[y:y+h, x:x+w] if w else None)
+    entry = manifest["masks"][name]
+    x, y, w, h = entry["x"], entry["y"], entry["w"], entry["h"]
+    if not w:
+        return (0, 0, 0, 0), None
+    if manifest["mode"] == "packed":
+        sprite_path = image_dir / SPRITE
+        sprite = _load_sprite(str(sprite_path), sprite_path.stat().st_mtime_ns)
+        return (x, y, w, h), sprite[entry["sy"]:entry["sy"]+h, entry["sx"]:entry["sx"]+w]
+    return (x, y, w, h), np.array(Image.open(image_dir / name).convert("RGBA"))
+
+
+@lru_cache(maxsize=256)
+def _render_full(image_dir, name, mtime):
+    manifest = load_manifest(image_dir)
+    canvas = np.zeros((manifest["height"], manifest["width"], 4), dtype=np.uint8)
+    (x, y, w, h), crop = load_crop(image_dir, name)
+    if crop is not None:
+        canvas[y:y+h, x:x+w] = crop
+    buf = io.BytesIO()
+    Image.fromarray(canvas).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def is_rendered(image_dir, name):
+    """Whether `name` is a mask of a cropped/packed image, served through render_full."""
+    manifest = load_manifest(image_dir)
+    return manifest is not None and manifest["mode"] != "full" and name in manifest["masks"]
+
+
+def render_full(image_dir, name):
+    """Full-frame RGBA PNG bytes for a mask of a cropped/packed image, else None."""
+    if not is_rendered(image_dir, name):
+        return None
+    mtime = (Path(image_dir) / MANIFEST).stat().st_mtime_ns
+    return _render_full(str(image_dir), name, mtime)
+
+
+def virtual_files(image_dir):
+    """Relative paths of masks and group entries that have no file of their own:
+    masks inside a sprite, and group members when GROUP_LINKS is "manifest"."""
+    image_dir = Path(image_dir)
+    manifest = load_manifest(image_dir)
+    if manifest is None:
+        return []
+    if manifest["mode"] == "packed":
+        files = [n for n, e in manifest["masks"].items() if e["w"]]
+    else:
+        files = []
+    names = {n for n, e in manifest["masks"].items() if e["w"]} or {
+        p.name for p in image_dir.glob("mask_*_rgba.png")}
+    groups_path = image_dir / "groups.json"
+    if groups_path.exists():
+        with open(groups_path) as f:
+            groups = json.load(f).get("groups", [])
+        for g in groups:
+            x, y = g["text_box"][0], g["text_box"][1]
+            for mi in g.get("mask_indices", []):
+                rel = f"{x}_{y}/{mask_name(mi)}"
+                if mask_name(mi) in names and not (image_dir / rel).exists():
+                    files.append(rel)
+    return files
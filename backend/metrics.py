@@ -0,0 +1,207 @@
+"""
+Pipeline and request metrics with a Prometheus text exposition.
+
+Counters and histograms live in each process. Job workers and HTTP workers
+write snapshots to METRICS_DIR (one <pid>.json each, written then renamed) and
+`/metrics` merges them with its own live values, so a stage timed in a job
+worker shows up whichever process answers the scrape. With METRICS_LOG=1 every
+span and event is also printed to stderr as one JSON line.
+
+    with metrics.span("ocr", image=name):
+        ...
+    metrics.inc("masks_generated_total", len(masks))
+"""
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+METRICS_DIR = Path(os.environ.get("METRICS_DIR", ROOT / "cache" / "metrics"))
+METRICS_LOG = os.environ.get("METRICS_LOG", "0") == "1"
+# snapshots are rewritten at most this often outside of explicit flushes
+FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", "5"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# name -> (type, help, buckets)
+DEFS = {
+    "http_requests_total": ("counter", "HTTP requests by endpoint, method and status.", None),
+    "http_request_seconds": ("histogram", "HTTP request latency (up to the first byte of streamed bodies).",
+                             LATENCY_BUCKETS),
+    "pipeline_stage_seconds": ("histogram", "Time spent per pipeline stage.", STAGE_BUCKETS),
+    "jobs_total": ("counter", "Segmentation jobs finished, by state.", None),
+    "job_seconds": ("histogram", "Segmentation job duration from start to finish.", STAGE_BUCKETS),
+    "masks_generated_total": ("counter", "Masks produced by SAM.", None),
+    "text_boxes_total": ("counter", "OCR words kept as text boxes.", None),
+    "groups_total": ("counter", "Text groups written to groups.json.", None),
+    "mask_bytes_written_total": ("counter", "Bytes of mask PNGs and manifests written.", None),
+    "result_cache_lookups_total": ("counter", "Result cache lookups, by result.", None),
+}
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_last_flush = 0.0
+
+
+def _key(name, labels):
+    if name not in DEFS:
+        raise KeyError(f"undeclared metric {name!r}")
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _maybe_flush()
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    buckets = DEFS[name][2]
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+        for i, le in enumerate(buckets):
+            if value <= le:
+                h[i] += 1
+        h[len(buckets)] += 1
+        h[-1] += value
+    _maybe_flush()
+
+
+def log(event, **fields):
+    """One structured log line (METRICS_LOG=1 only)."""
+    if METRICS_LOG:
+        print(json.dumps({"ts": round(time.time(), 3), "pid": os.getpid(), "event": event, **fields},
+                         default=str), file=sys.stderr, flush=True)
+
+
+@contextmanager
+def span(stage, **fields):
+    """Time a pipeline stage into pipeline_stage_seconds; `fields` only go to the log line."""
+    t0 = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - t0
+        observe("pipeline_stage_seconds", seconds, stage=stage)
+        log("span", stage=stage, seconds=round(seconds, 4), error=error, **fields)
+
+
+def timed(stage):
+    """Decorator form of `span`."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def snapshot():
+    with _lock:
+        return {
+            "pid": os.getpid(),
+            "counters": [[n, dict(l), v] for (n, l), v in _counters.items()],
+            "histograms": [[n, dict(l), list(h)] for (n, l), h in _histograms.items()],
+        }
+
+
+def flush():
+    """Write this process's snapshot for the other processes' /metrics."""
+    global _last_flush
+    _last_flush = time.monotonic()
+    snap = snapshot()
+    if not snap["counters"] and not snap["histograms"]:
+        return
+    try:
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = METRICS_DIR / f".{os.getpid()}.json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(snap, f)
+        os.replace(tmp, METRICS_DIR / f"{os.getpid()}.json")
+    except OSError as e:
+        print(f"metrics: could not write snapshot: {e}")
+
+
+def _maybe_flush():
+    if time.monotonic() - _last_flush > FLUSH_SECONDS:
+        flush()
+
+
+def reset_dir():
+    """Drop snapshots of earlier runs; call once at startup, before workers start."""
+    if METRICS_DIR.is_dir():
+        for p in METRICS_DIR.glob("*.json"):
+            p.unlink(missing_ok=True)
+
+
+def _merged():
+    counters, histograms = {}, {}
+    snaps = [snapshot()]
+    if METRICS_DIR.is_dir():
+        for p in METRICS_DIR.glob("*.json"):
+            if p.stem == str(os.getpid()):
+                continue
+            try:
+                with open(p) as f:
+                    snaps.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    for snap in snaps:
+        for name, labels, value in snap["counters"]:
+            if name in DEFS:
+                key = _key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+        for name, labels, h in snap["histograms"]:
+            if name in DEFS and len(h) == len(DEFS[name][2]) + 2:
+                key = _key(name, labels)
+                prev = histograms.get(key)
+                histograms[key] = h if prev is None else [a + b for a, b in zip(prev, h)]
+    return counters, histograms
+
+
+def _fmt_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render(gauges=None):
+    """Prometheus text format of all processes' metrics, plus `gauges` {name: (help, value)}."""
+    counters, histograms = _merged()
+    lines = []
+    for name, (kind, help_text, buckets) in DEFS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        if kind == "counter":
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}{_fmt_labels(labels)} {value}")
+        else:
+            for (n, labels), h in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for le, count in zip(buckets, h):
+                    lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', str(le))])} {count}")
+                lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {h[len(buckets)]}")
+                lines.append(f"{name}_sum{_fmt_labels(labels)} {round(h[-1], 6)}")
+                lines.append(f"{name}_count{_fmt_labels(labels)} {h[len(buckets)]}")
+    for name, (help_text, value) in (gauges or {}).items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
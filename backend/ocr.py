@@ -0,0 +1,161 @@
+"""
+Tesseract OCR restricted to candidate text regions.
+
+Rather than one `image_to_data` call over the whole frame, small SAM masks (glyph
+sized) are merged into line-like candidate regions and only those crops are
+recognised, fanned out over OCR_WORKERS threads, with a persistent in-process
+tesserocr engine kept per thread. Words come back as (x, y, w, h, conf, text) in
+image coordinates.
+
+tesserocr is optional (`pip install tesserocr`, it builds against the installed
+Tesseract). Without it every call starts a tesseract process through pytesseract,
+so per-region OCR would cost one process per region; the default OCR_MODE is then
+"full", the single whole-image pass. OCR_MODE=regions or full forces either.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+import pytesseract
+
+OCR_MODE = os.environ.get("OCR_MODE", "regions" if tesserocr is not None else "full")
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", str(min(4, os.cpu_count() or 1))))
+MIN_CONF = 30
+# masks bigger than this share of the frame are backgrounds/shapes, not glyphs
+GLYPH_MAX_AREA_FRAC = 0.02
+# dilation used to chain neighbouring glyphs into one region, in pixels
+REGION_PAD = 12
+# past this many regions, or this much covered area, one full pass is cheaper
+MAX_REGIONS = 64
+MAX_COVERAGE = 0.6
+
+_local = threading.local()
+_pool = None
+
+
+def engine_name():
+    return "tesserocr" if tesserocr is not None else "pytesseract"
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=max(1, OCR_WORKERS), thread_name_prefix="ocr")
+    return _pool
+
+
+def _tess_api():
+    # one engine per thread; PyTessBaseAPI is not thread-safe but is reusable
+    api = getattr(_local, "api", None)
+    if api is None:
+        api = tesserocr.PyTessBaseAPI()
+        _local.api = api
+    return api
+
+
+def _ocr_crop(crop):
+    """Words in one RGB crop as (x, y, w, h, conf, text) relative to the crop."""
+    words = []
+    if tesserocr is not None:
+        api = _tess_api()
+        api.SetImage(Image.fromarray(crop))
+        api.Recognize()
+        level = tesserocr.RIL.WORD
+        it = api.GetIterator()
+        if it is not None:
+            for w in tesserocr.iterate_level(it, level):
+                text = (w.GetUTF8Text(level) or "").strip()
+                box = w.BoundingBox(level)
+                if text and box:
+                    x0, y0, x1, y1 = box
+                    words.append((x0, y0, x1 - x0, y1 - y0, float(w.Confidence(level)), text))
+        api.Clear()
+        return words
+    data = pytesseract.image_to_data(crop, output_type=pytesseract.Output.DICT)
+    for i in range(len(data['text'])):
+        text = data['text'][i].strip()
+        if text:
+            words.append((data['left'][i], data['top'][i], data['width'][i], data['height'][i],
+                          float(data['conf'][i]), text))
+    return words
+
+
+def candidate_regions(shape, masks, pad=REGION_PAD):
+    """Merge glyph-sized mask bboxes into (x0, y0, x1, y1) regions, top to bottom."""
+    H, W = shape[:2]
+    occupancy = np.zeros((H, W), dtype=np.uint8)
+    max_area = GLYPH_MAX_AREA_FRAC * H * W
+    for m in masks:
+        if m.get("area", 0) > max_area or "bbox" not in m:
+            continue
+        bx, by, bw, bh = (int(v) for v in m["bbox"])
+        occupancy[by:by+bh+1, bx:bx+bw+1] = 1
+    if not occupancy.any():
+        return []
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * pad + 1, 2 * pad + 1))
+    occupancy = cv2.dilate(occupancy, kernel)
+    n, _, stats, _ = cv2.connectedComponentsWithStats(occupancy, connectivity=8)
+    regions = [(int(x), int(y), int(x + w), int(y + h)) for x, y, w, h, _ in stats[1:n]]
+    return sorted(regions, key=lambda r: (r[1], r[0]))
+
+
+def _dedupe(words):
+    # neighbouring regions' bboxes can overlap; drop repeated words
+    kept = []
+    for w in words:
+        x, y, ww, hh, _, text = w
+        dup = False
+        for k in kept:
+            if k[5] != text:
+                continue
+            ix = max(0, min(x + ww, k[0] + k[2]) - max(x, k[0]))
+            iy = max(0, min(y + hh, k[1] + k[3]) - max(y, k[1]))
+            if ix * iy > 0.5 * min(ww * hh, k[2] * k[3]):
+                dup = True
+                break
+        if not dup:
+            kept.append(w)
+    return kept
+
+
+def detect_words(img_rgb, masks=None):
+    """Return (words, stats). words are (x, y, w, h, conf, text) with conf > MIN_CONF."""
+    t0 = time.perf_counter()
+    H, W = img_rgb.shape[:2]
+    regions = []
+    if OCR_MODE == "regions" and masks:
+        regions = candidate_regions(img_rgb.shape, masks)
+        covered = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions)
+        if len(regions) > MAX_REGIONS or covered > MAX_COVERAGE * H * W:
+            regions = []
+    if not regions:
+        regions = [(0, 0, W, H)]
+
+    def run(region):
+        x0, y0, x1, y1 = region
+        crop = np.ascontiguousarray(img_rgb[y0:y1, x0:x1])
+        return [(x + x0, y + y0, w, h, conf, text) for x, y, w, h, conf, text in _ocr_crop(crop)]
+
+    if len(regions) == 1:
+        found = [run(regions[0])]
+    else:
+        found = list(_get_pool().map(run, regions))
+    words = _dedupe([w for ws in found for w in ws if int(w[4]) > MIN_CONF])
+    stats = {
+        "engine": engine_name(),
+        "regions": len(regions),
+        "region_pixels": sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions),
+        "words": len(words),
+        "seconds": round(time.perf_counter() - t0, 3),
+    }
+    print(f"OCR: {stats}")
+    return words, stats
@@ -2,98 +2,141 @@
 """
 Run Segment Anything (SAM) on `polar_2.png` using the provided checkpoint `sam_vit_h_4b8939.pth`.
 """
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
 from pathlib import Path
+import io
 import json
+import math
+import os
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 import cv2
 from helper import affine_crop, portrait
-import shutil
+import mask_store
+import embeddings
+import image_index
+import metrics
+from result_cache import cache_key, get_cache
+import sam_pool
+import style
+import tiling
 
-#requires pytesseract installation through brew or similar package manager
-import pytesseract
+#requires tesseract installation through brew or similar package manager
+import ocr
 
 ROOT = Path(__file__).resolve().parent
-CKPT_FN = ROOT / "sam_vit_h_4b8939.pth"
 OUT_RGBA_DIR = ROOT / "images" / "sam_shapes"
+# tiled mode keeps more resolution for small text and segments it tile by tile
+MAX_DIM = tiling.TILED_MAX_DIM if tiling.TILED else 1600
+FAST_DECODE = os.environ.get("FAST_DECODE", "0") == "1"
 
-def get_masks(img):
-    sam_builder = sam_model_registry.get("vit_h")
-    model = sam_builder(checkpoint=str(CKPT_FN))
-    model.to("cpu")
-    mask_generator = SamAutomaticMaskGenerator(model)
+def get_masks(img, mask_generator=None, backend=None, overrides=None):
+    """Run automatic mask generation, borrowing a warm generator from the
+    backend's pool unless the caller already holds one."""
+    if mask_generator is None:
+        with sam_pool.get_pool(backend).borrow(overrides=overrides) as gen:
+            return get_masks(img, gen)
     print("Generating masks...")
     masks = mask_generator.generate(img)
     print(f"Generated {len(masks)} masks")
-    masks_arr = [m["segmentation"] for m in masks]
     return masks
 
-def write_masks(masks, out_dir, img_rgb):
+def write_masks(masks, out_dir, img_rgb, mode=None):
         """Write mask outputs into out_dir.
-        For each mask we write:
-            - mask_{i:03d}_rgba.png: RGBA image where pixels inside the mask keep the
-                original image RGB values and alpha=255; outside pixels are transparent.
-            - mask_{i:03d}_color.png: a colorful solid fill for the mask area (alpha=255)
+        For each mask we write mask_{i:03d}_rgba.png: RGBA image where pixels inside
+        the mask keep the original image RGB values and alpha=255; outside pixels are
+        transparent. With the default "cropped" storage the PNG only covers the mask's
+        bbox and masks.json records its offset; see mask_store for the layouts.
         """
-        out_dir.mkdir(parents=True, exist_ok=True)
-        for i, m in enumerate(masks):
-            seg = m["segmentation"].astype(bool)
-            h, w = seg.shape
-
-            # RGBA masked original: keep original colors where mask is True
-            rgba = np.zeros((h, w, 4), dtype=np.uint8)
-            # img_rgb is expected shape (H, W, 3) and RGB ordering
-            rgba[seg, :3] = img_rgb[seg]
-            rgba[seg, 3] = 255
-            Image.fromarray(rgba).save(out_dir / f"mask_{i:03d}_rgba.png")
-
-        print('saved outputs to ', out_dir)
+        return mask_store.write_masks(masks, out_dir, img_rgb, mode)
 
 #helper function for group masks_by_text
-def detect_text_boxes(img_rgb):
+def detect_text_boxes(img_rgb, masks=None, stats=None):
     """Return list of bounding boxes (x,y,w,h) for text regions.
+    With masks, OCR only looks at regions where glyph-sized masks cluster; see ocr.
+    If `stats` is a dict it is filled with the OCR engine, region count and timing.
     """
-    data = pytesseract.image_to_data(img_rgb, output_type=pytesseract.Output.DICT)
-    text_boxes = []
-    img_with_boxes = img_rgb.copy()
-    n_boxes = len(data['text'])
-    for i in range(n_boxes):
-        if int(data['conf'][i]) > 30:
-            text = data['text'][i].strip()
-            if text: 
-                x, y, w, h = data['left'][i], data['top'][i], data['width'][i], data['height'][i]
-                text_boxes.append((x, y, w, h))
-                cv2.rectangle(img_with_boxes, (x, y), (x + w, y + h), (0, 255, 0), 2)
-    return text_boxes
+    words, ocr_stats = ocr.detect_words(img_rgb, masks)
+    if stats is not None:
+        stats.update(ocr_stats)
+    return [tuple(int(v) for v in w[:4]) for w in words]
+
+def mask_extents(masks):
+    """Return per-mask bounding extents and areas.
+
+    extents is an (N, 4) int array of x0, y0, x1, y1 with exclusive ends; it may
+    be a pixel larger than the tight box but always contains the whole mask.
+    Uses SAM's precomputed bbox/area when present.
+    """
+    extents = np.zeros((len(masks), 4), dtype=np.int64)
+    areas = np.zeros(len(masks), dtype=np.int64)
+    for i, m in enumerate(masks):
+        if "bbox" in m and "area" in m:
+            bx, by, bw, bh = m["bbox"]
+            extents[i] = (int(bx), int(by), int(bx + bw) + 1, int(by + bh) + 1)
+            areas[i] = int(m["area"])
+            continue
+        x, y, w, h = mask_store.tight_box(m)
+        if w:
+            extents[i] = (x, y, x + w, y + h)
+        areas[i] = np.count_nonzero(m["segmentation"])
+    return extents, areas
 
 #Groups masks by their text bounding boxes.
-def group_masks_by_text(img, masks):
-    text_boxes = detect_text_boxes(img)
+def group_masks_by_text(img, masks, text_boxes=None):
+    """A mask joins a text box's group when more than half its area lies inside the box.
+
+    All (box, mask) pairs are prefiltered at once on bounding boxes: the overlap
+    can't exceed the box intersection, so pairs whose intersection is at most
+    half the mask area are dropped without touching pixels. Survivors are
+    counted exactly over the intersection window only.
+    """
+    if text_boxes is None:
+        text_boxes = detect_text_boxes(img)
     groups = []
     print('found text boxes:', len(text_boxes))
-    for text_box in text_boxes:
-        x, y, w, h = text_box
+    if not text_boxes or not masks:
+        return groups
+    extents, areas = mask_extents(masks)
+    tb = np.asarray(text_boxes, dtype=np.int64).reshape(-1, 4)
+    ix0 = np.maximum(tb[:, 0, None], extents[None, :, 0])
+    iy0 = np.maximum(tb[:, 1, None], extents[None, :, 1])
+    ix1 = np.minimum((tb[:, 0] + tb[:, 2])[:, None], extents[None, :, 2])
+    iy1 = np.minimum((tb[:, 1] + tb[:, 3])[:, None], extents[None, :, 3])
+    inter = np.clip(ix1 - ix0, 0, None) * np.clip(iy1 - iy0, 0, None)
+    candidates = (areas[None, :] > 0) & (2 * inter > areas[None, :])
+
+    for t, text_box in enumerate(text_boxes):
         group_masks = []
-        for i, mask in enumerate(masks):
-            seg = mask["segmentation"]
-            text_mask = np.zeros_like(seg, dtype=bool)
-            text_mask[y:y+h, x:x+w] = True
-            mask_in_text = np.logical_and(seg, text_mask)
-            mask_area = np.sum(seg)
-            overlap_area = np.sum(mask_in_text)
-
-            if mask_area > 0 and overlap_area / mask_area > 0.5:
-                group_masks.append(i)
-        
+        for i in np.flatnonzero(candidates[t]):
+            overlap_area = np.count_nonzero(
+                mask_store.mask_window(masks[i], ix0[t, i], iy0[t, i], ix1[t, i], iy1[t, i]))
+            if 2 * overlap_area > areas[i]:
+                group_masks.append(int(i))
+
         if group_masks:
             groups.append({
                 "text_box": text_box,
                 "mask_indices": group_masks
             })
     return groups
-    
-def downscale_image(img, max_dim=1600):
+
+def pipeline_params(backend=None, overrides=None):
+    """Everything besides the pixels that changes the outputs; part of the cache key."""
+    backend = backend or sam_pool.DEFAULT_BACKEND
+    return {
+        "backend": backend,
+        "model": sam_pool.BACKENDS[backend],
+        "generator": sam_pool.generator_kwargs(backend, overrides),
+        "max_dim": MAX_DIM,
+        "tiling": tiling.params() if tiling.TILED else None,
+        "mask_storage": mask_store.MASK_STORAGE,
+        "png_level": mask_store.PNG_COMPRESS_LEVEL,
+        # the text boxes, and so groups.json, depend on how OCR ran
+        "ocr": {"mode": ocr.OCR_MODE, "engine": ocr.engine_name(), "min_conf": ocr.MIN_CONF},
+    }
+
+@metrics.timed("downscale")
+def downscale_image(img, max_dim=MAX_DIM):
     height, width = img.shape[:2]
     if max(height, width) > max_dim:
         scale = max_dim / max(height, width)
@@ -102,45 +145,142 @@ def downscale_image(img, max_dim=1600):
     return img
 
 
-# For each group, create prefixed copies of mask files so it's easy to
-# identify which masks belong to which text box. Prefix uses the
-# text_box top-left coordinates: "{x}_{y}_mask_###_rgba.png".
-def save_masks_for_image(img_filename):
-    down_path = ROOT / "images" / "input" / "downscaled" / img_filename
-    load_path = down_path
-    print(f"Loading image from: {load_path}")
-    img_rgb = np.array(Image.open(load_path).convert("RGB"))
-    masks = get_masks(img_rgb)
+@metrics.timed("decode")
+def decode_image(data, max_dim=None):
+    """Decode encoded image bytes to an RGB array (EXIF orientation applied).
+
+    With FAST_DECODE=1 and a max_dim hint, JPEGs are decoded in draft mode at the
+    smallest DCT scale that still covers max_dim, so big phone photos are never
+    decoded at full resolution. Pass the result through downscale_image as usual.
+    """
+    if FAST_DECODE and max_dim:
+        pil = Image.open(io.BytesIO(data))
+        if pil.format == "JPEG":
+            w, h = pil.size
+            scale = min(1.0, max_dim / max(w, h))
+            pil.draft("RGB", (math.ceil(w * scale), math.ceil(h * scale)))
+            return np.array(ImageOps.exif_transpose(pil).convert("RGB"))
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("could not decode image")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def output_dir(img_filename):
     # use Path.stem to remove suffix safely (don't use str.rstrip which treats characters as a set)
-    out_dir = ROOT / "images" / "sam_shapes" / Path(img_filename).stem
+    return OUT_RGBA_DIR / Path(img_filename).stem
+
+def restore_cached(img_rgb, out_dir, backend=None, overrides=None):
+    """Look the image up in the result cache; returns (key, groups or None).
+    On a hit the outputs are restored into out_dir and published."""
+    key = cache_key(img_rgb, pipeline_params(backend, overrides))
+    with metrics.span("cache", image=out_dir.name):
+        hit = get_cache().restore(key, out_dir)
+    metrics.inc("result_cache_lookups_total", result="miss" if hit is None else "hit")
+    if hit is None:
+        return key, None
+    groups, _ = hit
+    print(f"Result cache hit {key[:12]}, restored outputs to {out_dir}")
+    if not (out_dir / style.STYLE_JSON).exists():
+        # entries cached before style extraction existed
+        masks = get_cache().load_masks(key)
+        if masks is not None:
+            with metrics.span("style", image=out_dir.name):
+                style.write_style(out_dir, style.extract_style(img_rgb, masks, groups, *mask_extents(masks)))
+    publish_groups(out_dir, groups)
+    return key, groups
+
+def finish_segmentation(img_rgb, masks, out_dir, key=None, progress=None):
+    """Everything after mask generation: OCR, grouping, style extraction, writing
+    the masks, storing the result under cache `key` and publishing groups.
+    Returns the groups."""
+    if progress is None:
+        progress = lambda stage, **info: None
+    metrics.inc("masks_generated_total", len(masks))
+    progress("ocr")
+    ocr_stats = {}
+    with metrics.span("ocr", image=out_dir.name):
+        text_boxes = detect_text_boxes(img_rgb, masks, ocr_stats)
+    metrics.inc("text_boxes_total", len(text_boxes))
+    progress("grouping", ocr=ocr_stats)
+    with metrics.span("grouping", image=out_dir.name):
+        groups = group_masks_by_text(img_rgb, masks, text_boxes)
+    with metrics.span("style", image=out_dir.name):
+        style_info = style.extract_style(img_rgb, masks, groups, *mask_extents(masks))
+    progress("write")
     print(f"Will write masks to: {out_dir}")
-    write_masks(masks, out_dir, img_rgb)
-    groups = group_masks_by_text(img_rgb, masks)
+    with metrics.span("write", image=out_dir.name):
+        write_stats = write_masks(masks, out_dir, img_rgb)
+        # before the cache entry is stored, so it holds style.json as well
+        style.write_style(out_dir, style_info)
+        if key is not None:
+            get_cache().put(key, out_dir, masks, text_boxes, groups, img_rgb.shape[:2])
+    metrics.inc("mask_bytes_written_total", write_stats["bytes_written"])
+    publish_groups(out_dir, groups)
+    return groups
+
+# For each group, link the mask files into a folder named after the text_box
+# top-left coordinates so it's easy to identify which masks belong to which
+# text box: "{x}_{y}/mask_###_rgba.png".
+def publish_groups(out_dir, groups):
+    """Write groups.json, link the group folders and update the image index."""
     print("writing group_masks to out_dir:", out_dir)
     if groups:
-        out_dir.mkdir(parents=True, exist_ok=True)
-        with open(out_dir / "groups.json", "w") as f:
-            json.dump({"groups": groups}, f, indent=2)
-        print(f"Wrote groups.json with {len(groups)} groups")
-        for g in groups:
-            tb = g.get('text_box', None)
-            if not tb:
-                continue
-            x, y = tb[0], tb[1]
-            prefix = f"{x}_{y}"
-            group_dir = out_dir / prefix
-            group_dir.mkdir(parents=True, exist_ok=True)
-            for mi in g.get('mask_indices', []):
-                src = out_dir / f"mask_{mi:03d}_rgba.png"
-                if src.exists():
-                    dst = group_dir / f"mask_{mi:03d}_rgba.png"
-                    # avoid overwriting existing file
-                    if not dst.exists():
-                        try:
-                            shutil.copy2(src, dst)
-                        except Exception as e:
-                            print(f"Failed to copy {src} -> {dst}: {e}")
-        
+        with metrics.span("group_links", image=out_dir.name):
+            out_dir.mkdir(parents=True, exist_ok=True)
+            with open(out_dir / "groups.json", "w") as f:
+                json.dump({"groups": groups}, f, indent=2)
+            print(f"Wrote groups.json with {len(groups)} groups")
+            linked = mask_store.link_groups(out_dir, groups)
+            print(f"Linked {linked} group entries ({mask_store.GROUP_LINKS})")
+        metrics.inc("groups_total", len(groups))
+    with metrics.span("index", image=out_dir.name):
+        image_index.update_image(out_dir)
+
+def segment_image(img_rgb, img_filename, progress=None, backend=None, overrides=None, source=None):
+    """Segment an in-memory RGB image and write its masks and groups.json
+    under images/sam_shapes/<stem of img_filename>.
+
+    `progress`, if given, is called with the name of each stage as it starts
+    (plus keyword details about finished stages, e.g. ocr=<region stats>)
+    ("masks", "ocr", "grouping", "write", or just "cache" when the result cache
+    already holds this image). `backend` names an entry of sam_pool.BACKENDS
+    (default SAM_BACKEND) and `overrides` its tunable generator settings.
+    `source` is the embeddings.source_token of the downscaled file, recorded
+    with the image embedding. Returns the list of groups.
+    """
+    if progress is None:
+        progress = lambda stage, **info: None
+    out_dir = output_dir(img_filename)
+    key, groups = restore_cached(img_rgb, out_dir, backend, overrides)
+    if groups is not None:
+        progress("cache")
+        return groups
+    progress("masks")
+    pool = sam_pool.get_pool(backend)
+    with metrics.span("masks", image=out_dir.name, backend=pool.backend):
+        if tiling.TILED:
+            masks = tiling.generate_tiled(img_rgb, pool, overrides)
+        else:
+            with pool.borrow(overrides=overrides) as mask_generator, \
+                    embeddings.capture(mask_generator) as captured:
+                masks = get_masks(img_rgb, mask_generator)
+            # keep the encoder output for interactive re-segmentation; prompts
+            # are decoded with the default backend, so only its embeddings fit
+            if captured and pool.backend == sam_pool.DEFAULT_BACKEND:
+                captured[0].source = source
+                embeddings.get_cache().put(out_dir.name, captured[0])
+    return finish_segmentation(img_rgb, masks, out_dir, key, progress)
+
+def save_masks_for_image(img_filename, progress=None, backend=None, overrides=None):
+    """File-based entry point: segment images/input/downscaled/<img_filename>."""
+    down_path = ROOT / "images" / "input" / "downscaled" / img_filename
+    print(f"Loading image from: {down_path}")
+    data = down_path.read_bytes()
+    img_rgb = np.array(Image.open(io.BytesIO(data)).convert("RGB"))
+    return segment_image(img_rgb, Path(img_filename).name, progress, backend, overrides,
+                         embeddings.source_token(data))
+
 def main():
     INPUT_DIR = ROOT / "images" / "input"
     OUT_RGBA_DIR.mkdir(exist_ok=True)
@@ -0,0 +1,86 @@
+"""
+Opt-in sampling profiler for single requests.
+
+With PROFILING=1, a request carrying `X-Profile: 1` (or `?profile=1`) is sampled
+every PROFILE_INTERVAL seconds by a background thread that walks
+`sys._current_frames()`. Stacks are written in collapsed ("folded") format,
+which flamegraph.pl and speedscope load directly, to PROFILE_DIR. An upload
+profiles its job instead: every thread of the job worker is sampled (SAM, the
+OCR and PNG encode pools) and the job record names the file.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+PROFILING = os.environ.get("PROFILING", "0") == "1"
+PROFILE_DIR = Path(os.environ.get("PROFILE_DIR", ROOT / "cache" / "profiles"))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))
+
+
+def requested(req):
+    """Whether a Flask request asks to be profiled (and profiling is enabled)."""
+    return PROFILING and (req.headers.get("X-Profile") == "1" or req.args.get("profile") == "1")
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """Samples the stacks of one thread (`thread_id`) or of every thread (None)."""
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        names = {}
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if self.thread_id is None:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in frames.items():
+                if tid == me or (self.thread_id is not None and tid != self.thread_id):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                if self.thread_id is None:
+                    stack.append(names.get(tid, str(tid)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def save(self, label):
+        """Write the folded stacks; returns the file path."""
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in label)[:80]
+        path = PROFILE_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{safe}.folded"
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"profile: {self.samples} samples over {time.perf_counter() - self.started:.2f}s -> {path}")
+        return path
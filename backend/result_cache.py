@@ -0,0 +1,260 @@
+"""
+Content-addressed cache of segmentation results.
+
+Entries are keyed by a hash of the downscaled RGB pixels plus the pipeline
+parameters (model, max_dim, generator and storage settings), so re-uploading the
+same photo under any filename skips SAM and Tesseract. Each entry holds the
+written mask files (hardlinked, so they cost no extra disk on the same volume),
+the OCR boxes, groups.json and a compact bbox-cropped mask bundle.
+
+The cache is bounded by CACHE_MAX_BYTES and evicts least recently used entries;
+recency is the entry directory's mtime so it is shared between worker processes.
+Eviction rescans the cache directory under a file lock, so entries stored by
+other workers count toward the limit too.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+import mask_store
+import style
+
+ROOT = Path(__file__).resolve().parent
+CACHE_DIR = Path(os.environ.get("RESULT_CACHE_DIR", ROOT / "cache" / "results"))
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+CACHE_ENABLED = os.environ.get("RESULT_CACHE", "1") == "1"
+
+FILES_DIR = "files"
+MASKS_NPZ = "masks.npz"
+TEXT_BOXES = "text_boxes.json"
+GROUPS = "groups.json"
+
+
+def cache_key(img_rgb, params):
+    """sha256 over the pixel buffer, its shape and the JSON-encoded params."""
+    h = hashlib.sha256()
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    h.update(repr(img_rgb.shape).encode())
+    h.update(np.ascontiguousarray(img_rgb).data)
+    return h.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _is_output(name):
+    """Whether a file of an image's output directory is part of a cached result
+    (not groups.json, which is stored separately, or derived files like fonts.json)."""
+    return bool(mask_store.MASK_FILE.fullmatch(name)) or name in (
+        mask_store.MANIFEST, mask_store.SPRITE, style.STYLE_JSON)
+
+
+def _dir_size(path):
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def pack_masks(masks, shape):
+    """Pack masks of a `shape` (H, W) frame into bbox-cropped bits: boxes (N, 4)
+    x, y, w, h, plus one bit buffer."""
+    boxes = np.zeros((len(masks), 4), dtype=np.int32)
+    chunks, offsets = [], [0]
+    for i, m in enumerate(masks):
+        x, y, w, h = mask_store.tight_box(m)
+        if w:
+            boxes[i] = (x, y, w, h)
+            chunks.append(np.packbits(mask_store.mask_window(m, x, y, x + w, y + h)))
+        else:
+            chunks.append(np.zeros(0, dtype=np.uint8))
+        offsets.append(offsets[-1] + len(chunks[-1]))
+    return {
+        "shape": np.array(shape[:2], dtype=np.int32),
+        "boxes": boxes,
+        "offsets": np.array(offsets, dtype=np.int64),
+        "bits": np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint8),
+    }
+
+
+def unpack_masks(packed):
+    """Inverse of pack_masks; returns SAM-style dicts whose segmentation is the
+    bbox crop at "crop_origin" (see mask_store), with bbox and area."""
+    masks = []
+    for i, (x, y, w, h) in enumerate(packed["boxes"]):
+        w, h = int(w), int(h)
+        seg = np.zeros((h, w), dtype=bool)
+        if w:
+            bits = packed["bits"][packed["offsets"][i]:packed["offsets"][i + 1]]
+            seg = np.unpackbits(bits, count=w * h).reshape(h, w).astype(bool)
+        masks.append({
+            "segmentation": seg,
+            "crop_origin": (int(x), int(y)),
+            "bbox": [int(x), int(y), w - 1 if w else 0, h - 1 if h else 0],
+            "area": int(seg.sum()),
+        })
+    return masks
+
+
+class ResultCache:
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None  # key -> size in bytes, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def _load_index(self):
+        if self._index is None:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self._scan()
+
+    def _scan(self):
+        """Rebuild the index from the cache directory, oldest mtime first. Entries
+        never change once stored, so known sizes are reused."""
+        known = self._index or {}
+        entries = []
+        for d in self.root.iterdir():
+            if d.is_dir() and not d.name.startswith("."):
+                try:
+                    entries.append((d.stat().st_mtime, d.name, known.get(d.name) or _dir_size(d)))
+                except FileNotFoundError:  # evicted by another worker meanwhile
+                    continue
+        self._index = OrderedDict((name, size) for _, name, size in sorted(entries))
+
+    def _entry(self, key):
+        return self.root / key
+
+    def contains(self, key):
+        with self._lock:
+            self._load_index()
+            if key in self._index and self._entry(key).is_dir():
+                return True
+            # another worker may have added it since the index was built
+            if self._entry(key).is_dir():
+                self._index[key] = _dir_size(self._entry(key))
+                return True
+            self._index.pop(key, None)
+            return False
+
+    def _touch(self, key):
+        self._index.move_to_end(key)
+        os.utime(self._entry(key))
+
+    def restore(self, key, out_dir):
+        """Link a cached entry's files into out_dir and return (groups, text_boxes), or None."""
+        if not CACHE_ENABLED or not self.contains(key):
+            with self._lock:
+                self.misses += 1
+            return None
+        entry = self._entry(key)
+        try:
+            with open(entry / GROUPS) as fh:
+                groups = json.load(fh)["groups"]
+            with open(entry / TEXT_BOXES) as fh:
+                text_boxes = [tuple(b) for b in json.load(fh)]
+            out_dir.mkdir(parents=True, exist_ok=True)
+            names = set()
+            for f in (entry / FILES_DIR).iterdir():
+                dst = out_dir / f.name
+                if dst.exists() or dst.is_symlink():
+                    dst.unlink()
+                _link_or_copy(f, dst)
+                names.add(f.name)
+        except (FileNotFoundError, KeyError, ValueError):
+            # evicted underneath us, or a half-written entry
+            with self._lock:
+                self.misses += 1
+            return None
+        # output of an earlier run of this image (e.g. other generator settings);
+        # stale group folders are dropped when the groups are linked again
+        for p in out_dir.iterdir():
+            if _is_output(p.name) and p.name not in names and p.is_file():
+                p.unlink(missing_ok=True)
+        with self._lock:
+            self._touch(key)
+            self.hits += 1
+        return groups, text_boxes
+
+    def load_masks(self, key):
+        path = self._entry(key) / MASKS_NPZ
+        if not path.exists():
+            return None
+        with np.load(path) as packed:
+            return unpack_masks(packed)
+
+    def put(self, key, out_dir, masks, text_boxes, groups, shape):
+        """Store the files written to out_dir plus the pipeline results under key;
+        `shape` is the (H, W) of the image the masks belong to."""
+        if not CACHE_ENABLED:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.root / f".tmp-{uuid.uuid4().hex}"
+        (tmp / FILES_DIR).mkdir(parents=True)
+        try:
+            for f in out_dir.iterdir():
+                if _is_output(f.name) and f.is_file() and not f.is_symlink():
+                    _link_or_copy(f, tmp / FILES_DIR / f.name)
+            with open(tmp / GROUPS, "w") as fh:
+                json.dump({"groups": groups}, fh)
+            with open(tmp / TEXT_BOXES, "w") as fh:
+                json.dump([list(map(int, b)) for b in text_boxes], fh)
+            np.savez(tmp / MASKS_NPZ, **pack_masks(masks, shape))
+            size = _dir_size(tmp)
+            try:
+                tmp.rename(self._entry(key))
+            except OSError:
+                # someone else stored the same key first
+                shutil.rmtree(tmp, ignore_errors=True)
+                return
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        with self._lock:
+            self._load_index()
+            self._index[key] = size
+            self._index.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        # one evicting worker at a time, each seeing every worker's entries and touches
+        with open(self.root / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._scan()
+            total = sum(self._index.values())
+            while total > self.max_bytes and len(self._index) > 1:
+                key, size = self._index.popitem(last=False)
+                shutil.rmtree(self._entry(key), ignore_errors=True)
+                total -= size
+
+    def stats(self):
+        with self._lock:
+            self._load_index()
+            return {
+                "entries": len(self._index),
+                "bytes": sum(self._index.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ResultCache()
+    return _cache
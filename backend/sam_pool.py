@@ -0,0 +1,195 @@
+"""
+Long-lived SAM model registry.
+
+Each segmentation backend's checkpoint is loaded once per process (on first use,
+or eagerly via `warm()`) and shared by a small pool of `SamAutomaticMaskGenerator`
+instances that callers borrow for the duration of one `generate` call.
+
+Backends are named entries in BACKENDS: a SAM variant plus optional encoder
+optimizations (dynamic int8 quantization, TorchScript tracing) and generator
+settings. SAM_BACKEND picks the deployment default; callers may pick another
+backend and override the TUNABLE generator settings per request.
+"""
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+CKPT_FN = ROOT / "sam_vit_h_4b8939.pth"
+
+MODEL_TYPE = os.environ.get("SAM_MODEL_TYPE", "vit_h")
+DEVICE = os.environ.get("SAM_DEVICE", "cpu")
+POOL_SIZE = int(os.environ.get("SAM_POOL_SIZE", "1"))
+# deployment-wide SamAutomaticMaskGenerator arguments, e.g. '{"points_per_side": 16}'
+GENERATOR_KWARGS = json.loads(os.environ.get("SAM_GENERATOR_KWARGS", "{}"))
+# generator settings a single request may override
+TUNABLE = ("points_per_side", "points_per_batch", "crop_n_layers", "pred_iou_thresh",
+           "stability_score_thresh", "crop_n_points_downscale_factor", "min_mask_region_area")
+
+CHECKPOINTS = {
+    "vit_h": CKPT_FN,
+    "vit_l": ROOT / "sam_vit_l_0b3195.pth",
+    "vit_b": ROOT / "sam_vit_b_01ec64.pth",
+}
+
+BACKENDS = {
+    "vit_h": {"model_type": "vit_h"},
+    "vit_l": {"model_type": "vit_l"},
+    "vit_b": {"model_type": "vit_b"},
+    "vit_b_int8": {"model_type": "vit_b", "quantize": "int8"},
+    "vit_h_int8": {"model_type": "vit_h", "quantize": "int8"},
+    "vit_b_ts": {"model_type": "vit_b", "torchscript": True},
+    # coarser point grid and bigger decoder batches: a quick preview on CPU
+    "vit_b_fast": {"model_type": "vit_b", "quantize": "int8",
+                   "generator": {"points_per_side": 16, "points_per_batch": 128}},
+}
+DEFAULT_BACKEND = os.environ.get("SAM_BACKEND", MODEL_TYPE)
+
+
+def generator_kwargs(backend=None, overrides=None):
+    """Effective generator arguments for a backend plus per-request overrides."""
+    spec = BACKENDS[backend or DEFAULT_BACKEND]
+    kwargs = {**spec.get("generator", {}), **GENERATOR_KWARGS}
+    for k, v in (overrides or {}).items():
+        if k not in TUNABLE:
+            raise ValueError(f"generator setting {k!r} is not tunable")
+        kwargs[k] = v
+    return kwargs
+
+
+class _TracedEncoder:
+    """Stands in for model.image_encoder: SamPredictor only needs img_size and a call."""
+
+    def __init__(self, traced, img_size):
+        self.traced = traced
+        self.img_size = img_size
+
+    def __call__(self, x):
+        return self.traced(x)
+
+
+def _optimize(model, spec, device):
+    import torch
+
+    if spec.get("quantize") == "int8":
+        if device != "cpu":
+            print(f"int8 quantization is CPU-only, skipping on {device}")
+        else:
+            model.image_encoder = torch.quantization.quantize_dynamic(
+                model.image_encoder, {torch.nn.Linear}, dtype=torch.qint8)
+    if spec.get("torchscript"):
+        enc = model.image_encoder
+        example = torch.zeros(1, 3, enc.img_size, enc.img_size, device=device)
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(enc.eval(), example))
+        # bypass nn.Module attribute checks; the encoder is only ever called
+        del model._modules["image_encoder"]
+        object.__setattr__(model, "image_encoder", _TracedEncoder(traced, enc.img_size))
+    return model
+
+
+class SamPool:
+    def __init__(self, backend=None, device=DEVICE, size=POOL_SIZE):
+        self.backend = backend or DEFAULT_BACKEND
+        spec = BACKENDS[self.backend]
+        self.spec = spec
+        self.model_type = spec["model_type"]
+        self.checkpoint = Path(spec.get("checkpoint", CHECKPOINTS[self.model_type]))
+        self.device = device
+        self.size = max(1, int(size))
+        self.generator_kwargs = generator_kwargs(self.backend)
+        self.model = None
+        self._free = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {
+            "backend": self.backend,
+            "model_type": self.model_type,
+            "device": device,
+            "pool_size": self.size,
+            "loaded": False,
+            "load_seconds": None,
+            "loaded_at": None,
+            "borrows": 0,
+            "in_use": 0,
+            "wait_seconds_total": 0.0,
+        }
+
+    def warm(self):
+        """Load the checkpoint and build the generators if not done yet."""
+        if self.model is not None:
+            return self
+        with self._lock:
+            if self.model is not None:
+                return self
+            from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
+
+            t0 = time.perf_counter()
+            print(f"Loading SAM {self.backend} from {self.checkpoint} on {self.device}...")
+            model = sam_model_registry[self.model_type](checkpoint=str(self.checkpoint))
+            model.to(self.device)
+            model.eval()
+            model = _optimize(model, self.spec, self.device)
+            # Generators keep per-image state in their predictor, but share weights.
+            for _ in range(self.size):
+                self._free.put(SamAutomaticMaskGenerator(model, **self.generator_kwargs))
+            self.model = model
+            elapsed = time.perf_counter() - t0
+            self._stats.update(loaded=True, load_seconds=round(elapsed, 3), loaded_at=time.time())
+            print(f"SAM loaded in {elapsed:.2f}s ({self.size} generator(s))")
+        return self
+
+    @contextmanager
+    def borrow(self, timeout=None, overrides=None):
+        """Borrow a warm mask generator; blocks while all are in use.
+
+        With `overrides`, a throwaway generator with those settings is built on the
+        shared model (cheap), still counting against the pool's concurrency.
+        """
+        self.warm()
+        t0 = time.perf_counter()
+        gen = self._free.get(timeout=timeout)
+        with self._lock:
+            self._stats["borrows"] += 1
+            self._stats["in_use"] += 1
+            self._stats["wait_seconds_total"] += time.perf_counter() - t0
+        try:
+            if overrides:
+                from segment_anything import SamAutomaticMaskGenerator
+                yield SamAutomaticMaskGenerator(self.model, **generator_kwargs(self.backend, overrides))
+            else:
+                yield gen
+        finally:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._free.put(gen)
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+        out["wait_seconds_total"] = round(out["wait_seconds_total"], 3)
+        out["available"] = self._free.qsize()
+        return out
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def get_pool(backend=None):
+    """Return the process-wide pool for a backend, creating it (unloaded) on first call."""
+    backend = backend or DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown segmentation backend {backend!r}")
+    if backend not in _pools:
+        with _pool_lock:
+            if backend not in _pools:
+                _pools[backend] = SamPool(backend)
+    return _pools[backend]
+
+
+def all_stats():
+    return {name: pool.stats() for name, pool in list(_pools.items())}
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Production entry point for the backend.
+
+`python app.py` is the single-process debug server. This runs the same Flask app
+under gunicorn instead, with the model kept out of the HTTP workers:
+
+  * one inference process (`jobs.serve`) owns the job queue. With
+    JOB_SHARE_WEIGHTS=1 (default) it loads SAM once and forks JOB_WORKERS
+    segmentation workers from it, which share the weights copy-on-write;
+  * WEB_WORKERS gunicorn workers with WEB_THREADS threads each handle HTTP and
+    talk to the inference process over a local socket (JOB_SERVER). They never
+    load SAM: interactive `/segment` prompts are decoded in the inference
+    process too, on its already loaded model.
+
+SIGTERM/SIGINT stop gunicorn gracefully (in-flight requests get
+GRACEFUL_TIMEOUT seconds), then the inference process drains its queue for up
+to JOB_DRAIN_SECONDS. `/healthz` is liveness, `/readyz` turns 200 once a
+segmentation worker is warm. A missing font index is built by a separate
+process meanwhile; `/fonts` answers 503 until it is ready.
+
+    WEB_WORKERS=4 WEB_THREADS=8 JOB_WORKERS=2 python serve.py
+"""
+import multiprocessing as mp
+import os
+import secrets
+import sys
+import time
+
+import font_recognizer
+import jobs
+import metrics
+
+BIND = os.environ.get("BIND", "0.0.0.0:5054")
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", "2"))
+WEB_THREADS = int(os.environ.get("WEB_THREADS", "4"))
+GRACEFUL_TIMEOUT = int(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+# a /segment call waits for the inference process to encode/decode
+REQUEST_TIMEOUT = int(os.environ.get("REQUEST_TIMEOUT", "120"))
+JOB_SERVER = os.environ.get("JOB_SERVER", "127.0.0.1:5055")
+JOB_DRAIN_SECONDS = int(os.environ.get("JOB_DRAIN_SECONDS", "300"))
+
+
+def start_job_server(address, authkey):
+    proc = mp.get_context("spawn").Process(target=jobs.serve, args=(address, authkey),
+                                           name="job-server")
+    proc.start()
+    # wait for the socket, not the model; /readyz reports when that is warm
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            manager = jobs.JobServer(address=address, authkey=authkey)
+            manager.connect()
+            return proc
+        except OSError:
+            if not proc.is_alive():
+                raise SystemExit(f"job server exited with code {proc.exitcode}")
+            if time.monotonic() > deadline:
+                proc.terminate()
+                raise SystemExit(f"job server did not come up on {address[0]}:{address[1]}")
+            time.sleep(0.2)
+
+
+def stop_job_server(proc):
+    if not proc.is_alive():
+        return
+    proc.terminate()  # SIGTERM: refuse new jobs, finish queued ones
+    proc.join(JOB_DRAIN_SECONDS)
+    if proc.is_alive():
+        print(f"job server still busy after {JOB_DRAIN_SECONDS}s, killing it")
+        proc.kill()
+        proc.join()
+
+
+def main():
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("serve.py needs gunicorn (pip install gunicorn); "
+                         "use `python app.py` for the development server")
+
+    authkey = os.environ.get("JOB_SERVER_AUTHKEY") or secrets.token_hex(16)
+    # inherited by the gunicorn workers, which import app.py and connect with these
+    os.environ["JOB_SERVER"] = JOB_SERVER
+    os.environ["JOB_SERVER_AUTHKEY"] = authkey
+    metrics.reset_dir()
+    job_server = start_job_server(jobs.parse_address(JOB_SERVER), authkey.encode())
+    if font_recognizer.FONT_INDEX_AUTOBUILD:
+        # its own process: gunicorn forks from this one, which should not be mid-build
+        mp.get_context("spawn").Process(target=font_recognizer.ensure_index, name="font-index",
+                                        daemon=True).start()
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in {
+                "bind": BIND,
+                "workers": WEB_WORKERS,
+                "threads": WEB_THREADS,
+                "worker_class": "gthread",
+                "timeout": REQUEST_TIMEOUT,
+                "graceful_timeout": GRACEFUL_TIMEOUT,
+                # import the app once, before forking
+                "preload_app": True,
+                "on_exit": lambda arbiter: stop_job_server(job_server),
+            }.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from app import app
+            return app
+
+    try:
+        Server().run()
+    finally:
+        stop_job_server(job_server)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
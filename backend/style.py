@@ -0,0 +1,193 @@
+"""
+Style extraction: palettes, dominant colours, geometry and spacing.
+
+Runs after grouping on the masks that are still in memory and writes a compact
+style.json next to groups.json:
+
+  * every mask contributes at most STYLE_SAMPLES pixels, spread evenly over it
+    and read inside its bounding box only, so a mask costs the same whether it
+    is a glyph or the background;
+  * colours are quantized to 4 bits per channel and counted with np.bincount
+    (no k-means); the palette is the most frequent cells, with cells closer
+    than MERGE_DISTANCE folded into their neighbour, each reported as the mean
+    of its actual pixels;
+  * group palettes reuse their masks' samples, weighted by mask area; the image
+    palette comes from a strided sample of the whole frame;
+  * geometry is bounding boxes, areas and centroids; spacing is the median gap
+    between the masks of a group (letter spacing) and the nearest group below
+    and to the right of each group, with the alignment to the one below.
+"""
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+import mask_store
+
+STYLE_SAMPLES = int(os.environ.get("STYLE_SAMPLES", "2048"))
+STYLE_IMAGE_SAMPLES = int(os.environ.get("STYLE_IMAGE_SAMPLES", "65536"))
+STYLE_PALETTE = int(os.environ.get("STYLE_PALETTE", "5"))
+IMAGE_PALETTE = 8
+# RGB distance under which two quantization cells are one palette colour
+MERGE_DISTANCE = 28
+# most frequent cells looked at per palette; the long tail only holds noise
+MAX_CELLS = 32
+BITS = 4
+STYLE_JSON = "style.json"
+
+
+def _codes(rgb):
+    q = (rgb >> (8 - BITS)).astype(np.intp)
+    return (q[..., 0] << (2 * BITS)) | (q[..., 1] << BITS) | q[..., 2]
+
+
+def _hex(c):
+    return "#{:02x}{:02x}{:02x}".format(*(int(round(v)) for v in c))
+
+
+def palette(rgb, weights=None, k=STYLE_PALETTE):
+    """[{"color": "#rrggbb", "fraction": f}, ...] of (N, 3) uint8 pixels, most common first."""
+    if len(rgb) == 0:
+        return []
+    cells = 1 << (3 * BITS)
+    codes = _codes(rgb)
+    counts = np.bincount(codes, weights=weights, minlength=cells)
+    w = np.ones(len(rgb)) if weights is None else weights
+    sums = np.stack([np.bincount(codes, weights=rgb[:, c] * w, minlength=cells) for c in range(3)], axis=1)
+    total = counts.sum()
+    order = np.argsort(-counts)[:MAX_CELLS]
+    order = order[counts[order] > 0]
+    colours, amounts = [], []
+    for j in order:
+        c = sums[j] / counts[j]
+        if colours:
+            d = np.linalg.norm(np.asarray(colours) - c, axis=1)
+            near = int(np.argmin(d))
+            if d[near] <= MERGE_DISTANCE:
+                n = amounts[near] + counts[j]
+                colours[near] = (colours[near] * amounts[near] + c * counts[j]) / n
+                amounts[near] = n
+                continue
+        colours.append(c)
+        amounts.append(counts[j])
+    top = np.argsort(-np.asarray(amounts))[:k]
+    return [{"color": _hex(colours[t]), "fraction": round(float(amounts[t] / total), 3)} for t in top]
+
+
+def sample_mask(m, extent, limit=STYLE_SAMPLES):
+    """(ys, xs) of up to `limit` pixels spread evenly over a mask, read within its extent."""
+    x0, y0, x1, y1 = (int(v) for v in extent)
+    ys, xs = np.nonzero(mask_store.mask_window(m, x0, y0, x1, y1))
+    if len(ys) > limit:
+        pick = np.linspace(0, len(ys) - 1, limit).astype(np.intp)
+        ys, xs = ys[pick], xs[pick]
+    return ys + y0, xs + x0
+
+
+def _spacing(boxes, width):
+    """Nearest group below and to the right of each box (x0, y0, x1, y1), with
+    the gap in pixels and, for the one below, the shared alignment."""
+    n = len(boxes)
+    if n == 0:
+        return [], []
+    x0, y0, x1, y1 = (boxes[:, i] for i in range(4))
+    other = ~np.eye(n, dtype=bool)
+    h_overlap = np.minimum(x1[:, None], x1[None]) > np.maximum(x0[:, None], x0[None])
+    v_overlap = np.minimum(y1[:, None], y1[None]) > np.maximum(y0[:, None], y0[None])
+    gap_v = y0[None, :] - y1[:, None]
+    gap_h = x0[None, :] - x1[:, None]
+    gap_v = np.where(other & h_overlap & (gap_v >= 0), gap_v, np.iinfo(np.int64).max)
+    gap_h = np.where(other & v_overlap & (gap_h >= 0), gap_h, np.iinfo(np.int64).max)
+    below, right = gap_v.argmin(axis=1), gap_h.argmin(axis=1)
+    tol = max(4, round(0.005 * width))
+    out_below, out_right = [], []
+    for i in range(n):
+        j = int(below[i])
+        if gap_v[i, j] == np.iinfo(np.int64).max:
+            out_below.append(None)
+        else:
+            align = None
+            if abs(x0[i] - x0[j]) <= tol:
+                align = "left"
+            elif abs((x0[i] + x1[i]) - (x0[j] + x1[j])) <= 2 * tol:
+                align = "center"
+            elif abs(x1[i] - x1[j]) <= tol:
+                align = "right"
+            out_below.append({"group": j, "gap": int(gap_v[i, j]), "align": align})
+        j = int(right[i])
+        out_right.append(None if gap_h[i, j] == np.iinfo(np.int64).max
+                         else {"group": j, "gap": int(gap_h[i, j])})
+    return out_below, out_right
+
+
+def extract_style(img_rgb, masks, groups, extents, areas):
+    """style.json content for an image, its masks and its groups; `extents` and
+    `areas` are process.mask_extents(masks)."""
+    H, W = img_rgb.shape[:2]
+    samples, mask_styles = [], []
+    for i, m in enumerate(masks):
+        ys, xs = sample_mask(m, extents[i])
+        rgb = img_rgb[ys, xs]
+        # each sample stands for this many pixels of the mask
+        weight = float(areas[i]) / len(ys) if len(ys) else 0.0
+        samples.append((rgb, weight))
+        x0, y0, x1, y1 = (int(v) for v in extents[i])
+        pal = palette(rgb)
+        mask_styles.append({
+            "bbox": [x0, y0, x1 - x0, y1 - y0],
+            "area": int(areas[i]),
+            "centroid": [round(float(xs.mean()), 1), round(float(ys.mean()), 1)] if len(xs) else None,
+            "dominant": pal[0]["color"] if pal else None,
+            "palette": pal,
+        })
+
+    step = max(1, int(np.sqrt(H * W / max(1, STYLE_IMAGE_SAMPLES))))
+    image_palette = palette(img_rgb[::step, ::step].reshape(-1, 3), k=IMAGE_PALETTE)
+
+    group_styles, boxes = [], []
+    for g in groups:
+        idx = list(g.get("mask_indices", []))
+        rgb = np.concatenate([samples[i][0] for i in idx]) if idx else np.zeros((0, 3), np.uint8)
+        weights = np.concatenate([np.full(len(samples[i][0]), samples[i][1]) for i in idx]) if idx else None
+        pal = palette(rgb, weights)
+        ext = extents[idx] if idx else np.zeros((0, 4), np.int64)
+        # letter spacing: gaps between consecutive members, left to right
+        letter_spacing = None
+        if len(ext) > 1:
+            ext_sorted = ext[np.argsort(ext[:, 0], kind="stable")]
+            gaps = ext_sorted[1:, 0] - ext_sorted[:-1, 2]
+            gaps = gaps[gaps >= 0]
+            letter_spacing = float(np.median(gaps)) if len(gaps) else None
+        x, y, w, h = (int(v) for v in g["text_box"])
+        boxes.append((x, y, x + w, y + h))
+        group_styles.append({
+            "text_box": [x, y, w, h],
+            "bbox": ([int(ext[:, 0].min()), int(ext[:, 1].min()),
+                      int(ext[:, 2].max() - ext[:, 0].min()), int(ext[:, 3].max() - ext[:, 1].min())]
+                     if len(ext) else None),
+            "dominant": pal[0]["color"] if pal else None,
+            "palette": pal,
+            "glyph_height": float(np.median(ext[:, 3] - ext[:, 1])) if len(ext) else None,
+            "letter_spacing": letter_spacing,
+        })
+    below, right = _spacing(np.asarray(boxes, dtype=np.int64).reshape(-1, 4), W)
+    for s, b, r in zip(group_styles, below, right):
+        s["below"] = b
+        s["right"] = r
+
+    return {
+        "size": [W, H],
+        "palette": image_palette,
+        "masks": mask_styles,
+        "groups": group_styles,
+    }
+
+
+def write_style(out_dir, style):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tmp = out_dir / f".{STYLE_JSON}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(style, f, separators=(",", ":"))
+    os.replace(tmp, out_dir / STYLE_JSON)
@@ -0,0 +1,190 @@
+"""
+Tiled / multi-scale automatic mask generation for large posters and billboards.
+
+Instead of shrinking everything to 1600px, the image is kept at up to
+TILED_MAX_DIM and cut into overlapping TILE_SIZE tiles. An optional coarse pass
+over a downscaled copy finds the large elements and, via edge density, which
+tiles have enough detail to be worth a fine pass. Tiles are encoded TILE_BATCH
+at a time in one image-encoder pass (embeddings.generate_batch) and batches run
+concurrently on the SAM generator pool. A mask cut by an inner tile edge is
+dropped only when another pass finds it whole (see _covered_elsewhere); with
+COARSE_PASS=0, regions larger than the overlap are kept as cut and merged by
+the cross-tile NMS.
+
+Masks are reduced to bbox crops as soon as a tile's masks are decoded and stay
+crops after the cross-tile NMS: the returned masks carry a "crop_origin" (see
+mask_store), so peak memory scales with the kept masks' areas, never with
+masks x frame size.
+
+Enable with SEGMENT_MODE=tiled.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import embeddings
+import sam_pool
+
+TILED = os.environ.get("SEGMENT_MODE", "full") == "tiled"
+TILED_MAX_DIM = int(os.environ.get("TILED_MAX_DIM", "4096"))
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "1024"))
+TILE_OVERLAP = int(os.environ.get("TILE_OVERLAP", "256"))
+COARSE_DIM = int(os.environ.get("COARSE_DIM", "1600"))
+COARSE_PASS = os.environ.get("COARSE_PASS", "1") == "1"
+# tiles whose share of edge pixels (in the coarse image) is below this are skipped
+DETAIL_EDGE_DENSITY = float(os.environ.get("DETAIL_EDGE_DENSITY", "0.02"))
+NMS_IOU = float(os.environ.get("TILE_NMS_IOU", "0.7"))
+TILE_BATCH = int(os.environ.get("TILE_BATCH", "4"))
+
+
+def params():
+    return {
+        "tile": TILE_SIZE, "overlap": TILE_OVERLAP, "coarse": COARSE_PASS,
+        "coarse_dim": COARSE_DIM, "detail": DETAIL_EDGE_DENSITY, "nms": NMS_IOU,
+    }
+
+
+def _starts(length, tile, stride):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def tile_grid(height, width, tile=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Overlapping (x0, y0, x1, y1) tiles covering the image."""
+    stride = max(1, tile - overlap)
+    return [(x, y, min(x + tile, width), min(y + tile, height))
+            for y in _starts(height, tile, stride)
+            for x in _starts(width, tile, stride)]
+
+
+def select_tiles(img, tiles, coarse_dim=COARSE_DIM, threshold=DETAIL_EDGE_DENSITY):
+    """Keep tiles with enough edge detail to need a fine pass."""
+    H, W = img.shape[:2]
+    scale = min(1.0, coarse_dim / max(H, W))
+    small = cv2.resize(img, (max(1, int(W * scale)), max(1, int(H * scale))), interpolation=cv2.INTER_AREA)
+    edges = cv2.Canny(cv2.cvtColor(small, cv2.COLOR_RGB2GRAY), 50, 150) > 0
+    keep = []
+    for x0, y0, x1, y1 in tiles:
+        region = edges[int(y0 * scale):max(int(y1 * scale), int(y0 * scale) + 1),
+                       int(x0 * scale):max(int(x1 * scale), int(x0 * scale) + 1)]
+        if region.size and region.mean() >= threshold:
+            keep.append((x0, y0, x1, y1))
+    return keep
+
+
+def _crop_record(m, ox, oy, scale=1.0):
+    """Reduce a SAM mask dict to its bbox crop placed at (ox, oy) in the full frame."""
+    bx, by, bw, bh = (int(v) for v in m["bbox"])
+    crop = m["segmentation"][by:by+bh+1, bx:bx+bw+1]
+    if scale != 1.0:
+        w, h = max(1, round(crop.shape[1] * scale)), max(1, round(crop.shape[0] * scale))
+        crop = cv2.resize(crop.astype(np.uint8), (w, h), interpolation=cv2.INTER_NEAREST).astype(bool)
+    x, y = ox + round(bx * scale), oy + round(by * scale)
+    return {
+        "crop": crop,
+        "box": (x, y, x + crop.shape[1], y + crop.shape[0]),
+        "predicted_iou": float(m.get("predicted_iou", 0.0)),
+        "stability_score": float(m.get("stability_score", 0.0)),
+    }
+
+
+def _covered_elsewhere(m, tile, width, height, coarse, overlap=TILE_OVERLAP, margin=1):
+    """Whether a mask cut by an interior tile edge is found whole by another pass:
+    the coarse pass, when it ran, sees the large elements; otherwise only a mask
+    narrower than the overlap lies whole inside the neighbouring tile. Larger
+    cut masks are kept (nothing else would cover the region) and box_nms
+    merges the duplicates."""
+    x0, y0, x1, y1 = tile
+    bx, by, bw, bh = m["bbox"]
+    cut_x = (bx <= margin and x0 > 0) or (bx + bw >= (x1 - x0) - 1 - margin and x1 < width)
+    cut_y = (by <= margin and y0 > 0) or (by + bh >= (y1 - y0) - 1 - margin and y1 < height)
+    if not (cut_x or cut_y):
+        return False
+    if coarse:
+        return True
+    return (not cut_x or bw < overlap - 2 * margin) and (not cut_y or bh < overlap - 2 * margin)
+
+
+def box_nms(boxes, scores, iou_threshold=NMS_IOU):
+    """Greedy NMS over (N, 4) xyxy boxes; returns kept indices, best score first."""
+    if len(boxes) == 0:
+        return []
+    boxes = np.asarray(boxes, dtype=np.float64)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    keep = []
+    while len(order):
+        i = order[0]
+        keep.append(int(i))
+        rest = order[1:]
+        xx0 = np.maximum(boxes[i, 0], boxes[rest, 0])
+        yy0 = np.maximum(boxes[i, 1], boxes[rest, 1])
+        xx1 = np.minimum(boxes[i, 2], boxes[rest, 2])
+        yy1 = np.minimum(boxes[i, 3], boxes[rest, 3])
+        inter = np.clip(xx1 - xx0, 0, None) * np.clip(yy1 - yy0, 0, None)
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-9)
+        order = rest[iou <= iou_threshold]
+    return keep
+
+
+def generate_tiled(img, pool=None, overrides=None):
+    """SAM-style mask dicts for a large RGB image, merged across tiles."""
+    pool = pool or sam_pool.get_pool()
+    H, W = img.shape[:2]
+    records = []
+
+    if COARSE_PASS:
+        scale = min(1.0, COARSE_DIM / max(H, W))
+        small = cv2.resize(img, (max(1, int(W * scale)), max(1, int(H * scale))), interpolation=cv2.INTER_AREA)
+        with pool.borrow(overrides=overrides) as gen:
+            coarse = gen.generate(small)
+        records.extend(_crop_record(m, 0, 0, 1.0 / scale) for m in coarse)
+        del coarse
+        tiles = select_tiles(img, tile_grid(H, W))
+    else:
+        tiles = tile_grid(H, W)
+    print(f"Tiled segmentation: {W}x{H}, {len(tiles)} tile(s), {len(records)} coarse mask(s)")
+
+    def run_batch(batch):
+        crops = [np.ascontiguousarray(img[y0:y1, x0:x1]) for x0, y0, x1, y1 in batch]
+        recs = []
+        with pool.borrow(overrides=overrides) as gen:
+            for tile, (masks, _) in zip(batch, embeddings.generate_batch(gen, crops)):
+                recs.extend(_crop_record(m, tile[0], tile[1]) for m in masks
+                            if not _covered_elsewhere(m, tile, W, H, COARSE_PASS))
+                del masks
+        return recs
+
+    # at most pool.size batches are in flight, and only one tile's full-tile
+    # masks per batch at a time, which bounds peak memory
+    step = max(1, TILE_BATCH)
+    batches = [tiles[i:i + step] for i in range(0, len(tiles), step)]
+    with ThreadPoolExecutor(max_workers=pool.size) as ex:
+        for recs in ex.map(run_batch, batches):
+            records.extend(recs)
+
+    keep = box_nms([r["box"] for r in records], [r["predicted_iou"] for r in records])
+    masks = []
+    for i in keep:
+        r = records[i]
+        x0, y0, x1, y1 = r["box"]
+        x1, y1 = min(x1, W), min(y1, H)
+        crop = r["crop"][:y1 - y0, :x1 - x0]
+        area = int(crop.sum())
+        if area == 0:
+            continue
+        masks.append({
+            "segmentation": crop,
+            "crop_origin": (x0, y0),
+            "bbox": [x0, y0, x1 - x0 - 1, y1 - y0 - 1],
+            "area": area,
+            "predicted_iou": r["predicted_iou"],
+            "stability_score": r["stability_score"],
+        })
+    print(f"Merged {len(records)} tile masks into {len(masks)}")
+    return masks
@@ -0,0 +1,59 @@
+"""
+Names of uploaded originals.
+
+A name is reserved on disk, synchronously, before its job is queued: the
+original itself is written by bg_writer, so its absence on disk says nothing
+about whether the name is free (the write may still be queued, or queued in
+another gunicorn worker). Names are claimed per stem, since the stem is what
+names an image's outputs (sam_shapes/<stem>, the embedding and font caches):
+IMG_1.jpg and IMG_1.png may not both exist. A claim is a small file in
+CLAIM_DIR holding the content hash of the image that owns the stem. It is
+written to a temp file and hard-linked into place, which fails if the stem is
+already claimed, so two uploads racing for one stem can't both get it. A
+different image under a taken stem gets a content-hash suffix; the same image
+gets its name back.
+"""
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+from werkzeug.utils import secure_filename
+
+ROOT = Path(__file__).resolve().parent
+ORIGINAL_DIR = ROOT / "images" / "input" / "original"
+CLAIM_DIR = ORIGINAL_DIR / ".claims"
+
+
+def _owner(key, digest, existing):
+    """Content hash that owns the stem `key`, claiming it for `digest` if free.
+    `existing` is an original from before claims were kept, if there is one."""
+    path = CLAIM_DIR / key
+    try:
+        return path.read_text()
+    except FileNotFoundError:
+        pass
+    if existing is not None:
+        digest = hashlib.sha256(existing.read_bytes()).hexdigest()
+    tmp = CLAIM_DIR / f".{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+    tmp.write_text(digest)
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    finally:
+        tmp.unlink()
+    return path.read_text()
+
+
+def claim_name(filename, data):
+    """Final file name for an uploaded image with content `data`, reserved for it."""
+    filename = secure_filename(filename)
+    digest = hashlib.sha256(data).hexdigest()
+    stem, suffix = Path(filename).stem, Path(filename).suffix
+    CLAIM_DIR.mkdir(parents=True, exist_ok=True)
+    for key in (stem, f"{stem}-{digest[:8]}", f"{stem}-{digest}"):
+        existing = next((p for p in ORIGINAL_DIR.glob(f"{key}.*") if p.stem == key and p.is_file()), None)
+        if _owner(key, digest, existing) == digest:
+            return f"{key}{suffix}"
+    raise RuntimeError(f"no free name for {filename}")
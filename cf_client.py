@@ -1,39 +1,169 @@
+"""
+Client for the Cloudflare inpainting worker (worker/worker.js).
+
+Requests go out as multipart/form-data with raw PNG parts and the worker answers
+with the image bytes, so nothing is base64-inflated in either direction. An
+`InpaintClient` keeps one pooled keep-alive `requests.Session` and retries
+429/5xx responses with exponential backoff. `inpaint_many` / `ainpaint_many`
+fill many masks (e.g. every SAM mask of a group) concurrently, at most
+`concurrency` requests in flight.
+
+    python cf_client.py           # inpaint input.png with mask.png via the worker
+"""
+import argparse
+import asyncio
 import base64
-import json
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 from PIL import Image
-import io
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def img_to_b64_png(img: Image.Image) -> str:
+DEFAULT_TIMEOUT = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def img_to_png(img: Image.Image, compress_level: int = 1) -> bytes:
+    # the model re-encodes anyway; fast compression keeps encode time off the request path
     buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode()
+    img.save(buf, format="PNG", compress_level=compress_level)
+    return buf.getvalue()
+
+
+def img_to_b64_png(img: Image.Image) -> str:
+    return base64.b64encode(img_to_png(img)).decode()
+
 
 def b64_to_image(b64: str) -> Image.Image:
     data = base64.b64decode(b64)
     return Image.open(io.BytesIO(data))
 
+
+class InpaintClient:
+    def __init__(self, worker_url: str, api_key: str, concurrency: int = 4, retries: int = 3,
+                 backoff: float = 0.5, timeout: float = DEFAULT_TIMEOUT):
+        self.worker_url = worker_url
+        self.timeout = timeout
+        self.concurrency = max(1, concurrency)
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset({"POST"}), respect_retry_after_header=True,
+                      raise_on_status=False)
+        self.session = requests.Session()
+        # one host; enough pooled connections that every concurrent request keeps its own
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Authorization": f"Bearer {api_key}", "Accept": "image/png"})
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def inpaint(self, image: Image.Image, mask: Image.Image, prompt: str, **params) -> Image.Image:
+        """Fill the white area of `mask` in `image`. Extra params (e.g. num_steps) go to the model."""
+        return self.inpaint_with_stats(image, mask, prompt, **params)[0]
+
+    def inpaint_with_stats(self, image: Image.Image, mask: Image.Image, prompt: str, **params):
+        """`inpaint` plus {"bytes_sent", "bytes_received", "seconds"} for the request."""
+        t0 = time.perf_counter()
+        files = {
+            "image": ("image.png", img_to_png(image.convert("RGB")), "image/png"),
+            "mask": ("mask.png", img_to_png(mask.convert("L")), "image/png"),
+        }
+        data = {"prompt": prompt, **{k: str(v) for k, v in params.items()}}
+        resp = self.session.post(self.worker_url, files=files, data=data, timeout=self.timeout)
+        resp.raise_for_status()
+        if resp.headers.get("Content-Type", "").startswith("application/json"):
+            # older worker deployments still answer with base64 JSON
+            out_b64 = resp.json().get("output_image")
+            if not out_b64:
+                raise RuntimeError("No output_image in response JSON")
+            out = b64_to_image(out_b64)
+        else:
+            out = Image.open(io.BytesIO(resp.content))
+        stats = {
+            "bytes_sent": len(resp.request.body or b""),
+            "bytes_received": len(resp.content),
+            "seconds": round(time.perf_counter() - t0, 3),
+        }
+        return out, stats
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                    thread_name_prefix="inpaint")
+            return self._executor
+
+    def inpaint_many(self, items, prompt: str = "", return_exceptions: bool = False,
+                     with_stats: bool = False, **params):
+        """Inpaint (image, mask) or (image, mask, prompt) items concurrently; results in order.
+
+        With `return_exceptions`, a failed item yields its exception instead of
+        aborting the whole batch; with `with_stats`, results are (image, stats).
+        """
+        call = self.inpaint_with_stats if with_stats else self.inpaint
+
+        def run(item):
+            image, mask, *rest = item
+            try:
+                return call(image, mask, rest[0] if rest else prompt, **params)
+            except Exception as e:
+                if return_exceptions:
+                    return e
+                raise
+
+        return list(self._pool().map(run, items))
+
+    async def ainpaint(self, image: Image.Image, mask: Image.Image, prompt: str, **params) -> Image.Image:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool(), lambda: self.inpaint(image, mask, prompt, **params))
+
+    async def ainpaint_many(self, items, prompt: str = "", return_exceptions: bool = False, **params):
+        """asyncio counterpart of `inpaint_many`; the same concurrency limit applies."""
+        tasks = [self.ainpaint(image, mask, rest[0] if rest else prompt, **params)
+                 for image, mask, *rest in items]
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(worker_url: str, api_key: str) -> InpaintClient:
+    """Process-wide client per (url, key), so repeated calls reuse pooled connections."""
+    key = (worker_url, api_key)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = InpaintClient(worker_url, api_key)
+        return _clients[key]
+
+
 def call_cf_inpaint(worker_url: str, api_key: str, image: Image.Image, mask: Image.Image, prompt: str) -> Image.Image:
-    img_b64 = img_to_b64_png(image)
-    mask_b64 = img_to_b64_png(mask)
-    payload = {
-        "image": img_b64,
-        "mask": mask_b64,
-        "prompt": prompt
-    }
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-    resp = requests.post(worker_url, json=payload, headers=headers, timeout=60)
-    resp.raise_for_status()
-    resp_json = resp.json()
-    out_b64 = resp_json.get("output_image")
-    if not out_b64:
-        raise RuntimeError("No output_image in response JSON")
-    return b64_to_image(out_b64)
+    return get_client(worker_url, api_key).inpaint(image, mask, prompt)
+
 
 if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=1, help="send the request N times concurrently")
+    ap.add_argument("--concurrency", type=int, default=4)
+    args = ap.parse_args()
+
     # Example usage
     worker_url = "https://hackharvard3.julian-beaudry.workers.dev"
     api_key = "newnewTok"  # route this in Cloudflare so Worker only accepts valid requests
@@ -44,6 +174,9 @@ if __name__ == "__main__":
     mask = Image.open("mask.png").convert("L")
     prompt = "fill background naturally"  # prompt guidance
 
-    out_img = call_cf_inpaint(worker_url, api_key, image, mask, prompt)
-    out_img.save("cf_output.png")
-    print("Saved output to cf_output.png")
+    with InpaintClient(worker_url, api_key, concurrency=args.concurrency) as client:
+        t0 = time.perf_counter()
+        outputs = client.inpaint_many([(image, mask)] * args.repeat, prompt)
+        elapsed = time.perf_counter() - t0
+    outputs[0].save("cf_output.png")
+    print(f"Saved output to cf_output.png ({args.repeat} request(s) in {elapsed:.2f}s)")
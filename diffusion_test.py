@@ -1,21 +1,27 @@
-import torch
+import os
+from pathlib import Path
+
 from PIL import Image, ImageDraw
 import numpy as np
-from diffusers import StableDiffusionInpaintPipeline
-from diffusers.utils import load_image
+import pytest
+
+from local_inpaint import STUB, get_inpainter
+
+INPUT = Path(__file__).resolve().parent / "input.png"
 
-def test_diffusion_inpaint():
+
+def run_inpaint(model, out_path):
+    """Inpaint a square in the middle of input.png; returns (input, output, mean
+    absolute change inside the square)."""
     print("== Starting diffusion inpaint test ==")
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print("Using device:", device)
+    inpainter = get_inpainter(model)
+    print("Using device:", inpainter.device)
 
     # Load a simple example image (you can replace with your own)
-    # We'll use load_image from diffusers utils (if available), or fallback
-    try:
-        img = load_image("https://huggingface.co/datasets/huggingface/documentation-images/resolve/main/diffusers/inpaint.png")
-        print("Loaded example image via load_image")
-    except Exception as e:
-        print("Could not load via load_image:", e)
+    if INPUT.exists():
+        img = Image.open(INPUT).convert("RGB")
+        print("Loaded input.png")
+    else:
         # fallback: create a simple image
         img = Image.new("RGB", (256, 256), color=(128, 128, 128))
         print("Created dummy image (256x256 gray)")
@@ -32,24 +38,20 @@ def test_diffusion_inpaint():
     draw.rectangle([left, top, right, bottom], fill=255)
     print("Mask created: a square in the center to inpaint")
 
-    # Load the inpainting pipeline
-    print("Loading StableDiffusionInpaintPipeline (this may take some time)...")
-    pipe = StableDiffusionInpaintPipeline.from_pretrained(
-        "runwayml/stable-diffusion-inpainting"
-    ).to(device)
+    # Load the inpainting pipeline (once; it stays resident in the process)
+    print("Loading inpainting pipeline from", inpainter.model_dir)
+    inpainter.warm()
 
     print("Pipeline loaded successfully")
 
     # Run the inpainting
     prompt = "a nice background fill"  # fallback prompt
     print("Running inpainting with prompt:", prompt)
-    result = pipe(prompt=prompt, image=img, mask_image=mask, num_inference_steps=20)
-    out_img = result.images[0]
+    out_img = inpainter.inpaint(img, mask, prompt)
     print("Inference done; got output image")
 
-    # Optionally save or show
-    out_img.save("test_inpaint_output.png")
-    print("Saved output as test_inpaint_output.png")
+    out_img.save(out_path)
+    print(f"Saved output as {out_path}")
 
     # Extra: check that mask region was changed (rough check)
     out_arr = np.array(out_img)
@@ -61,7 +63,20 @@ def test_diffusion_inpaint():
     print(f"Mean absolute difference in masked region: {diff:.2f}")
 
     print("== Test complete ==")
+    return img, out_img, diff
+
+
+def test_diffusion_inpaint(tmp_path):
+    # the weight-free stub unless a real pipeline is asked for
+    model = os.environ.get("INPAINT_LOCAL_MODEL", STUB)
+    if model != STUB:
+        pytest.importorskip("torch")
+        pytest.importorskip("diffusers")
+    img, out_img, diff = run_inpaint(model, tmp_path / "test_inpaint_output.png")
+    assert out_img.size == img.size
+    assert (tmp_path / "test_inpaint_output.png").exists()
+    assert diff > 0
 
 
 if __name__ == "__main__":
-    test_diffusion_inpaint()
+    run_inpaint(os.environ.get("INPAINT_LOCAL_MODEL", "stable-diffusion-inpainting"), "test_inpaint_output.png")
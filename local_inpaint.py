@@ -0,0 +1,204 @@
+"""
+In-process inpainting backend, a drop-in for the Cloudflare worker client.
+
+`LocalInpainter` offers the same `inpaint` / `inpaint_with_stats` / `inpaint_many`
+interface as `cf_client.InpaintClient`, but runs StableDiffusionInpaintPipeline
+itself. The pipeline is loaded once from a local directory (no network access)
+and kept resident; `inpaint_many` fills several masks per forward pass.
+
+On CPU it defaults to a reduced mode: attention slicing, fewer inference steps
+and a lower working resolution (INPAINT_CPU_STEPS, INPAINT_CPU_SIZE).
+INPAINT_LOCAL_MODEL=stub swaps the diffusion model for OpenCV's Telea inpainting,
+which is deterministic and needs no weights, for offline runs.
+
+    python local_inpaint.py --model ./stable-diffusion-inpainting
+    python local_inpaint.py --model stub
+"""
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+INPAINT_LOCAL_MODEL = os.environ.get("INPAINT_LOCAL_MODEL", "stable-diffusion-inpainting")
+INPAINT_DEVICE = os.environ.get("INPAINT_DEVICE", "")
+INPAINT_STEPS = int(os.environ.get("INPAINT_STEPS", "20"))
+INPAINT_CPU_STEPS = int(os.environ.get("INPAINT_CPU_STEPS", "8"))
+INPAINT_CPU_SIZE = int(os.environ.get("INPAINT_CPU_SIZE", "384"))
+INPAINT_BATCH = int(os.environ.get("INPAINT_BATCH", "4"))
+INPAINT_SEED = int(os.environ.get("INPAINT_SEED", "0"))
+STUB = "stub"
+
+
+def _snap8(w, h, size):
+    """(w, h) scaled so the longer side is `size`, both multiples of 8."""
+    scale = size / max(w, h)
+    return max(8, int(round(w * scale / 8)) * 8), max(8, int(round(h * scale / 8)) * 8)
+
+
+class _StubPipeline:
+    """Deterministic stand-in for the diffusion pipeline (OpenCV Telea inpainting)."""
+
+    def __call__(self, prompt, image, mask_image, **kwargs):
+        import cv2
+
+        out = []
+        for img, mask in zip(image, mask_image):
+            arr = np.asarray(img.convert("RGB"))
+            m = (np.asarray(mask.convert("L")) > 127).astype(np.uint8)
+            out.append(Image.fromarray(cv2.inpaint(arr, m, 3, cv2.INPAINT_TELEA)))
+        return type("Output", (), {"images": out})()
+
+
+class LocalInpainter:
+    def __init__(self, model_dir=INPAINT_LOCAL_MODEL, device=None, steps=None, size=None,
+                 batch_size=INPAINT_BATCH, low_memory=None):
+        self.model_dir = str(model_dir)
+        self.stub = self.model_dir == STUB
+        self.device = device or INPAINT_DEVICE or self._default_device()
+        cpu = self.device == "cpu"
+        self.steps = steps or (INPAINT_CPU_STEPS if cpu else INPAINT_STEPS)
+        # working resolution (longer side); None means the model's native 512
+        self.size = size or (INPAINT_CPU_SIZE if cpu else None)
+        self.batch_size = max(1, batch_size)
+        self.low_memory = cpu if low_memory is None else low_memory
+        self.pipe = None
+        self.load_seconds = None
+        # one forward pass at a time; the pipeline is not re-entrant
+        self._lock = threading.Lock()
+
+    def _default_device(self):
+        if self.stub:
+            return "cpu"
+        import torch
+        if torch.cuda.is_available():
+            return "cuda"
+        if torch.backends.mps.is_available():
+            return "mps"
+        return "cpu"
+
+    def warm(self):
+        """Load the pipeline if not loaded yet."""
+        if self.pipe is not None:
+            return self
+        with self._lock:
+            if self.pipe is not None:
+                return self
+            t0 = time.perf_counter()
+            if self.stub:
+                pipe = _StubPipeline()
+            else:
+                import torch
+                from diffusers import StableDiffusionInpaintPipeline
+
+                print(f"Loading inpainting pipeline from {self.model_dir} on {self.device}...")
+                dtype = torch.float16 if self.device == "cuda" else torch.float32
+                pipe = StableDiffusionInpaintPipeline.from_pretrained(
+                    self.model_dir, torch_dtype=dtype, local_files_only=True).to(self.device)
+                pipe.set_progress_bar_config(disable=True)
+                if self.low_memory:
+                    pipe.enable_attention_slicing()
+            self.pipe = pipe
+            self.load_seconds = round(time.perf_counter() - t0, 3)
+            print(f"Inpainting pipeline ready in {self.load_seconds:.2f}s "
+                  f"({self.steps} steps, size {self.size or 'native'})")
+        return self
+
+    def _run(self, images, masks, prompts, **params):
+        """One forward pass over same-size inputs; returns images at the input size."""
+        w, h = images[0].size
+        tw, th = _snap8(w, h, self.size or 512)
+        kwargs = {"num_inference_steps": int(params.pop("num_steps", self.steps)),
+                  "height": th, "width": tw, **params}
+        if not self.stub:
+            import torch
+            # seeded per call so the same inputs always give the same fill
+            kwargs["generator"] = torch.Generator("cpu").manual_seed(INPAINT_SEED)
+        with self._lock:
+            out = self.pipe(prompt=prompts,
+                            image=[im.convert("RGB").resize((tw, th), Image.LANCZOS) for im in images],
+                            mask_image=[m.convert("L").resize((tw, th), Image.NEAREST) for m in masks],
+                            **kwargs).images
+        return [o.resize((w, h), Image.LANCZOS) for o in out]
+
+    def inpaint(self, image: Image.Image, mask: Image.Image, prompt: str, **params) -> Image.Image:
+        return self.inpaint_with_stats(image, mask, prompt, **params)[0]
+
+    def inpaint_with_stats(self, image: Image.Image, mask: Image.Image, prompt: str, **params):
+        self.warm()
+        t0 = time.perf_counter()
+        out = self._run([image], [mask], [prompt], **params)[0]
+        return out, {"bytes_sent": 0, "bytes_received": 0, "batch": 1,
+                     "seconds": round(time.perf_counter() - t0, 3)}
+
+    def inpaint_many(self, items, prompt: str = "", return_exceptions: bool = False,
+                     with_stats: bool = False, **params):
+        """Same contract as `InpaintClient.inpaint_many`; same-size items share a forward pass."""
+        self.warm()
+        items = [(image, mask, rest[0] if rest else prompt) for image, mask, *rest in items]
+        results = [None] * len(items)
+        by_size = {}
+        for i, (image, _, _) in enumerate(items):
+            by_size.setdefault(image.size, []).append(i)
+        for idxs in by_size.values():
+            for start in range(0, len(idxs), self.batch_size):
+                batch = idxs[start:start + self.batch_size]
+                t0 = time.perf_counter()
+                try:
+                    outs = self._run([items[i][0] for i in batch], [items[i][1] for i in batch],
+                                     [items[i][2] for i in batch], **dict(params))
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    outs = [e] * len(batch)
+                stats = {"bytes_sent": 0, "bytes_received": 0, "batch": len(batch),
+                         "seconds": round(time.perf_counter() - t0, 3)}
+                for i, out in zip(batch, outs):
+                    results[i] = (out, stats) if with_stats and not isinstance(out, Exception) else out
+        return results
+
+    def close(self):
+        self.pipe = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_inpainters = {}
+_inpainters_lock = threading.Lock()
+
+
+def get_inpainter(model_dir: str = INPAINT_LOCAL_MODEL) -> LocalInpainter:
+    """Process-wide resident pipeline per model directory."""
+    with _inpainters_lock:
+        if model_dir not in _inpainters:
+            _inpainters[model_dir] = LocalInpainter(model_dir)
+        return _inpainters[model_dir]
+
+
+def call_local_inpaint(model_dir: str, image: Image.Image, mask: Image.Image, prompt: str) -> Image.Image:
+    return get_inpainter(model_dir).inpaint(image, mask, prompt)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", default=INPAINT_LOCAL_MODEL, help=f"pipeline directory, or '{STUB}'")
+    ap.add_argument("--repeat", type=int, default=1, help="inpaint N copies in batches")
+    args = ap.parse_args()
+
+    image = Image.open("input.png").convert("RGB")
+    mask = Image.open("mask.png").convert("L")
+    prompt = "fill background naturally"
+
+    inpainter = get_inpainter(args.model).warm()
+    t0 = time.perf_counter()
+    outputs = inpainter.inpaint_many([(image, mask)] * args.repeat, prompt)
+    elapsed = time.perf_counter() - t0
+    outputs[0].save("local_output.png")
+    print(f"Saved output to local_output.png ({args.repeat} image(s) in {elapsed:.2f}s, "
+          f"load {inpainter.load_seconds:.2f}s)")
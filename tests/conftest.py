@@ -0,0 +1,114 @@
+import base64
+import io
+import json
+import sys
+import threading
+import time
+from email import message_from_bytes
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parent.parent
+# cf_client.py lives at the repository root, the server modules in backend/
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "backend"))
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Stands in for worker.js: paints the masked area flat grey and echoes the image.
+
+    Speaks both request formats. `server.fail_first` makes the first N
+    requests answer 503 so retries can be exercised, `server.json_response`
+    answers base64 JSON like older deployments, and `server.delay` holds every
+    request that long (`server.max_in_flight` records the peak concurrency).
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytes_received += len(body)
+            failing = self.server.requests <= self.server.fail_first
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            time.sleep(self.server.delay)
+            self._answer(body, failing)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def _answer(self, body, failing):
+        if failing:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        ctype = self.headers.get("Content-Type", "")
+        if ctype.startswith("multipart/form-data"):
+            msg = message_from_bytes(f"Content-Type: {ctype}\r\n\r\n".encode() + body, policy=HTTP)
+            parts = {p.get_param("name", header="content-disposition"): p.get_payload(decode=True)
+                     for p in msg.iter_parts()}
+            image_bytes, mask_bytes = parts["image"], parts["mask"]
+        else:
+            payload = json.loads(body)
+            image_bytes = base64.b64decode(payload["image"])
+            mask_bytes = base64.b64decode(payload["mask"])
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        mask = Image.open(io.BytesIO(mask_bytes)).convert("L").resize(image.size)
+        image.paste((128, 128, 128), mask=mask)
+        buf = io.BytesIO()
+        image.save(buf, format="PNG")
+        out = buf.getvalue()
+        if ctype.startswith("multipart/form-data") and not self.server.json_response:
+            self._send(200, "image/png", out)
+        else:
+            self._send(200, "application/json",
+                       json.dumps({"output_image": base64.b64encode(out).decode()}).encode())
+
+    def _send(self, status, ctype, data):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def start_stub_worker(port=0, fail_first=0, json_response=False, delay=0.0):
+    """Run the stub worker on localhost in a background thread; `server.url` is its address."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), _StubHandler)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.bytes_received = 0
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.fail_first = fail_first
+    server.json_response = json_response
+    server.delay = delay
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def stub_worker():
+    """Factory for stub workers (`start_stub_worker` arguments); all are shut down afterwards."""
+    servers = []
+
+    def start(**kwargs):
+        server = start_stub_worker(**kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
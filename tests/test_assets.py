@@ -0,0 +1,32 @@
+"""assets: content-hashed versions and conditional asset responses."""
+import os
+
+from flask import Flask
+
+import assets
+
+
+def test_version_follows_content(tmp_path):
+    a, b = tmp_path / "a.png", tmp_path / "b.png"
+    a.write_bytes(b"same")
+    b.write_bytes(b"same")
+    assert assets.version_token(a) == assets.version_token(b)
+    st = a.stat()
+    a.write_bytes(b"diff")
+    os.utime(a, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert assets.version_token(a) != assets.version_token(b)
+
+
+def test_send_asset_caching(tmp_path):
+    (tmp_path / "m.png").write_bytes(b"png bytes")
+    token = assets.version_token(tmp_path / "m.png")
+    app = Flask(__name__)
+    app.add_url_rule("/a/<path:name>", "a", lambda name: assets.send_asset(tmp_path, name))
+    client = app.test_client()
+
+    resp = client.get(f"/a/m.png?v={token}")
+    assert resp.status_code == 200 and resp.data == b"png bytes"
+    assert resp.headers["Cache-Control"] == assets.IMMUTABLE
+    assert client.get("/a/m.png?v=old").headers["Cache-Control"] == assets.REVALIDATE
+    assert client.get("/a/m.png", headers={"If-None-Match": resp.headers["ETag"]}).status_code == 304
+    assert client.get("/a/missing.png").status_code == 404
@@ -0,0 +1,94 @@
+"""bulk.ingest hands each image's masks to post-processing as they are generated."""
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+import pytest
+
+import bulk
+import embeddings
+import process
+import sam_pool
+import tiling
+import uploads
+
+
+class FakePool:
+    backend = "fake"
+
+    def warm(self):
+        return self
+
+    @contextmanager
+    def borrow(self, overrides=None):
+        yield None
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    events, lock = [], threading.Lock()
+
+    def record(event):
+        with lock:
+            events.append(event)
+
+    def generate_batch(mask_generator, images):
+        for i, img in enumerate(images):
+            if img[0, 0, 0] == 255:
+                raise RuntimeError("encoder failed")
+            record(f"gen:{int(img[0, 0, 1])}")
+            yield [{"segmentation": np.ones(img.shape[:2], bool)}], None
+
+    def finish_segmentation(img, masks, out_dir, key, progress=None):
+        record(f"finish:{int(img[0, 0, 1])}")
+
+    monkeypatch.setattr(uploads, "ORIGINAL_DIR", tmp_path / "original")
+    monkeypatch.setattr(uploads, "CLAIM_DIR", tmp_path / "original" / ".claims")
+    monkeypatch.setattr(bulk, "DOWNSCALE_DIR", tmp_path / "downscaled")
+    monkeypatch.setattr(embeddings, "generate_batch", generate_batch)
+    monkeypatch.setattr(tiling, "TILED", False)
+    monkeypatch.setattr(process, "output_dir", lambda name: tmp_path / "out" / name)
+    monkeypatch.setattr(process, "restore_cached", lambda img, out_dir, backend, overrides: ("key", None))
+    monkeypatch.setattr(process, "finish_segmentation", finish_segmentation)
+    monkeypatch.setattr(sam_pool, "get_pool", lambda backend=None: FakePool())
+    take_batch = bulk._take_batch
+
+    first = []
+
+    def whole_batch(q, size):
+        # let the producer queue every image (and its end marker) first, so the
+        # images form one batch however the threads are scheduled
+        deadline = time.monotonic() + 5
+        while not first and q.qsize() < size + 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        first.append(True)
+        return take_batch(q, size)
+
+    monkeypatch.setattr(bulk, "_take_batch", whole_batch)
+    return events
+
+
+def write_images(d, firsts):
+    d.mkdir()
+    for i, first in enumerate(firsts):
+        img = np.zeros((16, 16, 3), np.uint8)
+        img[0, 0] = (i, i, first)  # BGR: red channel marks a failing image
+        cv2.imwrite(str(d / f"img{i}.png"), img)
+
+
+def test_masks_are_post_processed_as_they_are_generated(tmp_path, pipeline):
+    write_images(tmp_path / "src", [0, 0, 0, 0])
+    stats = bulk.ingest(tmp_path / "src", batch=4)
+    assert stats["done"] == 4 and stats["failed"] == 0
+    assert sorted(pipeline) == sorted([f"gen:{i}" for i in range(4)] + [f"finish:{i}" for i in range(4)])
+    # image 0 is finished before image 2's masks exist: at most one image lags behind
+    assert pipeline.index("finish:0") < pipeline.index("gen:2")
+
+
+def test_failure_mid_batch_fails_only_the_rest(tmp_path, pipeline):
+    write_images(tmp_path / "src", [0, 0, 255, 0])
+    stats = bulk.ingest(tmp_path / "src", batch=4)
+    assert stats["done"] == 2 and stats["failed"] == 2
+    assert {e["image"] for e in stats["errors"]} == {"img2.png", "img3.png"}
@@ -0,0 +1,86 @@
+"""cf_client.InpaintClient against a local stub of worker.js (the stub_worker fixture)."""
+import asyncio
+
+import pytest
+import requests
+from PIL import Image
+
+import cf_client
+
+GREY = (128, 128, 128)
+
+
+def pair(colour, size=(32, 24)):
+    """A flat image and a mask covering its left half."""
+    image = Image.new("RGB", size, colour)
+    mask = Image.new("L", size, 0)
+    mask.paste(255, (0, 0, size[0] // 2, size[1]))
+    return image, mask
+
+
+def check_filled(out, colour):
+    out = out.convert("RGB")
+    assert out.getpixel((0, 0)) == GREY
+    assert out.getpixel((out.width - 1, out.height - 1)) == colour
+
+
+def test_multipart_round_trip(stub_worker):
+    server = stub_worker()
+    image, mask = pair((200, 10, 10))
+    with cf_client.InpaintClient(server.url, "key") as client:
+        out, stats = client.inpaint_with_stats(image, mask, "a wall", num_steps=4)
+    assert out.size == image.size
+    check_filled(out, (200, 10, 10))
+    assert stats["bytes_sent"] == server.bytes_received > 0
+    assert stats["bytes_received"] > 0
+    assert server.requests == 1
+
+
+def test_json_fallback(stub_worker):
+    server = stub_worker(json_response=True)
+    image, mask = pair((10, 200, 10))
+    with cf_client.InpaintClient(server.url, "key") as client:
+        out = client.inpaint(image, mask, "")
+    check_filled(out, (10, 200, 10))
+
+
+def test_retries_503(stub_worker):
+    server = stub_worker(fail_first=2)
+    image, mask = pair((10, 10, 200))
+    with cf_client.InpaintClient(server.url, "key", retries=3, backoff=0) as client:
+        out = client.inpaint(image, mask, "")
+    check_filled(out, (10, 10, 200))
+    assert server.requests == 3
+
+
+def test_gives_up_after_retries(stub_worker):
+    server = stub_worker(fail_first=10)
+    image, mask = pair((10, 10, 200))
+    with cf_client.InpaintClient(server.url, "key", retries=2, backoff=0) as client:
+        with pytest.raises(requests.HTTPError):
+            client.inpaint(image, mask, "")
+        assert client.inpaint_many([(image, mask)], return_exceptions=True)[0].response.status_code == 503
+    assert server.requests == 6
+
+
+COLOURS = [(i * 20, 255 - i * 20, 7 * i) for i in range(10)]
+
+
+def test_inpaint_many_order_and_concurrency(stub_worker):
+    server = stub_worker(delay=0.05)
+    with cf_client.InpaintClient(server.url, "key", concurrency=3) as client:
+        outs = client.inpaint_many([pair(c) for c in COLOURS], prompt="p")
+    assert len(outs) == len(COLOURS)
+    for out, colour in zip(outs, COLOURS):
+        check_filled(out, colour)
+    assert 1 < server.max_in_flight <= 3
+
+
+def test_ainpaint_many_order_and_concurrency(stub_worker):
+    server = stub_worker(delay=0.05)
+    with cf_client.InpaintClient(server.url, "key", concurrency=2) as client:
+        outs = asyncio.run(client.ainpaint_many([(*pair(c), "p") for c in COLOURS]))
+    assert len(outs) == len(COLOURS)
+    for out, colour in zip(outs, COLOURS):
+        check_filled(out, colour)
+    assert server.max_in_flight == 2
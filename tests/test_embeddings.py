@@ -0,0 +1,30 @@
+"""embeddings.EmbeddingCache: staleness by source token, bounded spill."""
+import numpy as np
+
+import embeddings
+
+
+def emb(source):
+    return embeddings.Embedding(np.zeros((1, 2, 4, 4), np.float32), (30, 40), (768, 1024), source)
+
+
+def test_embedding_of_another_file_version_is_stale(tmp_path):
+    cache = embeddings.EmbeddingCache(tmp_path)
+    token = embeddings.source_token(b"jpeg bytes")
+    cache.put("poster", emb(token))
+    assert cache.get("poster", token) is not None
+    assert cache.get("poster", embeddings.source_token(b"other bytes")) is None
+    # a fresh process reads the spilled copy
+    cold = embeddings.EmbeddingCache(tmp_path)
+    hit = cold.get("poster", token)
+    assert hit.source == token and hit.original_size == (30, 40)
+    assert cold.get("poster", embeddings.source_token(b"other bytes")) is None
+
+
+def test_spill_is_bounded(tmp_path):
+    cache = embeddings.EmbeddingCache(tmp_path, capacity=1, disk_capacity=3)
+    for i in range(5):
+        cache.put(f"img{i}", emb(str(i)))
+    assert sorted(p.name for p in tmp_path.glob("*.npy")) == ["img2.npy", "img3.npy", "img4.npy"]
+    assert sorted(p.name for p in tmp_path.glob("*.json")) == ["img2.json", "img3.json", "img4.json"]
+    assert not list(tmp_path.glob(".*.tmp"))
@@ -0,0 +1,20 @@
+"""group_masks_by_text matches the original full-frame implementation."""
+import pytest
+
+from bench_grouping import group_masks_by_text_reference, synthetic_masks
+from process import group_masks_by_text
+
+
+def _as_crop(m):
+    # the bbox-crop form tiled segmentation returns (see mask_store)
+    x, y, w, h = m["bbox"]
+    return dict(m, segmentation=m["segmentation"][y:y + h + 1, x:x + w + 1], crop_origin=(x, y))
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_matches_reference(seed):
+    masks, text_boxes = synthetic_masks(400, 600, 60, 25, seed=seed)
+    expected = group_masks_by_text_reference(masks, text_boxes)
+    assert expected
+    assert group_masks_by_text(None, masks, text_boxes) == expected
+    assert group_masks_by_text(None, [_as_crop(m) for m in masks], text_boxes) == expected
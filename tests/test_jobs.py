@@ -0,0 +1,47 @@
+"""A job worker dying fails only its job; the queue replaces the broken pool."""
+import os
+import time
+
+import pytest
+
+import jobs
+
+
+def _crash(jobs_table, job_id):
+    os._exit(1)
+
+
+def _finish(jobs_table, job_id):
+    jobs._update(jobs_table, job_id, state="done")
+
+
+def _wait_state(queue, job_id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        rec = queue.get(job_id)
+        if rec["state"] in ("done", "error"):
+            return rec
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} still {rec['state']}")
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    # workers are spawned and inherit the environment
+    monkeypatch.setenv("SAM_PRELOAD", "0")
+    q = jobs.JobQueue(workers=1, max_depth=4).start()
+    yield q
+    q.shutdown(wait=False)
+
+
+def test_worker_crash_fails_only_its_job(queue):
+    crashed = queue._submit(queue._new_job("a.png", None), _crash)
+    rec = _wait_state(queue, crashed)
+    assert rec["state"] == "error"
+    assert "died" in rec["error"]
+    assert queue.depth() == 0
+
+    assert queue.status()["closing"] is False
+    job_id = queue._submit(queue._new_job("b.png", None), _finish)
+    assert _wait_state(queue, job_id)["state"] == "done"
+    assert queue.status()["ready"]
@@ -0,0 +1,40 @@
+"""result_cache.ResultCache: the byte limit holds across worker processes."""
+import os
+
+import numpy as np
+
+import result_cache
+
+
+def store(cache, tmp_path, key, size):
+    out = tmp_path / f"out-{key}"
+    out.mkdir()
+    (out / "mask_000_rgba.png").write_bytes(os.urandom(size))
+    mask = np.zeros((8, 8), bool)
+    mask[2:5, 3:6] = True
+    cache.put(key, out, [{"segmentation": mask}], [(1, 2, 3, 4)], [], (8, 8))
+
+
+def test_limit_counts_entries_of_other_workers(tmp_path):
+    root = tmp_path / "cache"
+    # two workers, each with its own in-memory index of the same directory
+    a = result_cache.ResultCache(root, max_bytes=50_000)
+    b = result_cache.ResultCache(root, max_bytes=50_000)
+    a.stats(), b.stats()
+    for i in range(4):
+        store(a if i % 2 else b, tmp_path, f"k{i}", 20_000)
+    entries = [d for d in root.iterdir() if d.is_dir()]
+    assert sum(result_cache._dir_size(d) for d in entries) <= 50_000
+    # the newest entries survive
+    assert {d.name for d in entries} == {"k2", "k3"}
+
+
+def test_restore_round_trip(tmp_path):
+    cache = result_cache.ResultCache(tmp_path / "cache")
+    store(cache, tmp_path, "k", 100)
+    out = tmp_path / "restored"
+    groups, text_boxes = cache.restore("k", out)
+    assert groups == [] and text_boxes == [(1, 2, 3, 4)]
+    assert (out / "mask_000_rgba.png").read_bytes() == (tmp_path / "out-k" / "mask_000_rgba.png").read_bytes()
+    (mask,) = cache.load_masks("k")
+    assert mask["crop_origin"] == (3, 2) and mask["segmentation"].all() and mask["area"] == 9
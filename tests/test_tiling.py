@@ -0,0 +1,46 @@
+"""Tiled segmentation keeps regions larger than a tile when there is no coarse pass."""
+from contextlib import contextmanager
+
+import numpy as np
+
+import embeddings
+import tiling
+
+
+class FakePool:
+    size = 1
+
+    @contextmanager
+    def borrow(self, overrides=None):
+        yield None
+
+
+def _mask(shape, x0, x1):
+    seg = np.zeros(shape, bool)
+    seg[:, x0:x1] = True
+    return {"segmentation": seg, "bbox": [x0, 0, x1 - x0 - 1, shape[0] - 1],
+            "predicted_iou": 0.9, "stability_score": 0.9}
+
+
+def test_large_region_survives_without_coarse_pass(monkeypatch):
+    def generate_batch(mask_generator, images):
+        for img in images:
+            h, w = img.shape[:2]
+            # the whole tile, and a sliver cut by the tile's right edge
+            yield [_mask((h, w), 0, w), _mask((h, w), w - 10, w)], None
+
+    monkeypatch.setattr(embeddings, "generate_batch", generate_batch)
+    monkeypatch.setattr(tiling, "COARSE_PASS", False)
+    img = np.zeros((1024, 2048, 3), np.uint8)
+    masks = tiling.generate_tiled(img, pool=FakePool())
+
+    covered = np.zeros(img.shape[:2], bool)
+    for m in masks:
+        x0, y0 = m["crop_origin"]
+        h, w = m["segmentation"].shape
+        covered[y0:y0 + h, x0:x0 + w] |= m["segmentation"]
+    assert covered.all()
+    # slivers cut by an inner seam are narrower than the overlap: the
+    # neighbouring tile sees them whole, so only the one at the image edge stays
+    slivers = [m["crop_origin"][0] for m in masks if m["segmentation"].shape[1] == 10]
+    assert slivers == [2038]
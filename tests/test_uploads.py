@@ -0,0 +1,41 @@
+"""uploads.claim_name: names are reserved on disk, per content."""
+import pytest
+
+import uploads
+
+
+@pytest.fixture(autouse=True)
+def dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "ORIGINAL_DIR", tmp_path / "original")
+    monkeypatch.setattr(uploads, "CLAIM_DIR", tmp_path / "original" / ".claims")
+    return tmp_path
+
+
+def test_same_image_keeps_its_name():
+    assert uploads.claim_name("poster.jpg", b"a") == "poster.jpg"
+    assert uploads.claim_name("poster.jpg", b"a") == "poster.jpg"
+
+
+def test_other_image_under_a_claimed_name_is_renamed():
+    # nothing is on disk yet: the first original may still be queued for writing
+    assert uploads.claim_name("poster.jpg", b"a") == "poster.jpg"
+    second = uploads.claim_name("poster.jpg", b"b")
+    assert second != "poster.jpg" and second.startswith("poster-") and second.endswith(".jpg")
+    assert uploads.claim_name("poster.jpg", b"b") == second
+
+
+def test_originals_from_before_claims_count():
+    uploads.ORIGINAL_DIR.mkdir(parents=True)
+    (uploads.ORIGINAL_DIR / "old.png").write_bytes(b"old")
+    assert uploads.claim_name("old.png", b"old") == "old.png"
+    assert uploads.claim_name("old.png", b"new") != "old.png"
+
+
+def test_names_are_unique_per_stem():
+    # both would write images/sam_shapes/IMG_1
+    assert uploads.claim_name("IMG_1.jpg", b"a") == "IMG_1.jpg"
+    other = uploads.claim_name("IMG_1.png", b"b")
+    assert other.endswith(".png") and other.startswith("IMG_1-")
+    # secure_filename maps both to the same stem
+    assert uploads.claim_name("my poster.jpg", b"c") == "my_poster.jpg"
+    assert uploads.claim_name("my_poster.jpg", b"d") != "my_poster.jpg"
@@ -18,6 +18,10 @@ export default defineConfig({
         target: 'http://localhost:5054',
         changeOrigin: true,
       },
+      '/bulk_upload': {
+        target: 'http://localhost:5054',
+        changeOrigin: true,
+      },
       '/all_images': {
         target: 'http://localhost:5054',
         changeOrigin: true,
@@ -26,6 +30,22 @@ export default defineConfig({
         target: 'http://localhost:5054',
         changeOrigin: true,
       },
+      '/jobs': {
+        target: 'http://localhost:5054',
+        changeOrigin: true,
+      },
+      '/segment': {
+        target: 'http://localhost:5054',
+        changeOrigin: true,
+      },
+      '/bundle': {
+        target: 'http://localhost:5054',
+        changeOrigin: true,
+      },
+      '/fonts': {
+        target: 'http://localhost:5054',
+        changeOrigin: true,
+      },
       '/rgba': {
         target: 'http://localhost:5054',
         changeOrigin: true,
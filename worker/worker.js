@@ -1,28 +1,70 @@
+// Accepts multipart/form-data (image, mask: PNG files; prompt, num_steps: fields)
+// and answers with the raw image bytes. The original JSON/base64 format is still
+// understood and answered in kind for older clients.
+const DEFAULT_STEPS = 20;
+
+function b64ToBytes(b64) {
+  return Uint8Array.from(atob(b64), c => c.charCodeAt(0));
+}
+
+function bytesToB64(bytes) {
+  // spreading a large array into fromCharCode overflows the call stack
+  let bin = "";
+  const chunk = 0x8000;
+  for (let i = 0; i < bytes.length; i += chunk) {
+    bin += String.fromCharCode(...bytes.subarray(i, i + chunk));
+  }
+  return btoa(bin);
+}
+
+async function readRequest(request) {
+  const ctype = request.headers.get("Content-Type") || "";
+  if (ctype.startsWith("multipart/form-data")) {
+    const form = await request.formData();
+    const image = form.get("image");
+    const mask = form.get("mask");
+    if (!image || !mask) {
+      throw new Error("multipart body needs 'image' and 'mask' parts");
+    }
+    return {
+      binary: true,
+      imageBytes: new Uint8Array(await image.arrayBuffer()),
+      maskBytes: new Uint8Array(await mask.arrayBuffer()),
+      prompt: form.get("prompt") || "",
+      numSteps: parseInt(form.get("num_steps") || DEFAULT_STEPS, 10),
+    };
+  }
+  const { image, mask, prompt, num_steps } = await request.json();
+  return {
+    binary: false,
+    imageBytes: b64ToBytes(image),
+    maskBytes: b64ToBytes(mask),
+    prompt,
+    numSteps: num_steps || DEFAULT_STEPS,
+  };
+}
+
 export default {
   async fetch(request, env) {
     try {
-      const reqJson = await request.json();
-      const { image: imgB64, mask: maskB64, prompt } = reqJson;
-
-      // Decode base64 → bytes
-      const imageBytes = Uint8Array.from(atob(imgB64), c => c.charCodeAt(0));
-      const maskBytes = Uint8Array.from(atob(maskB64), c => c.charCodeAt(0));
+      const req = await readRequest(request);
 
       // Call the Workers AI inpainting model
       const aiResponse = await env.AI.run("@cf/runwayml/stable-diffusion-v1-5-inpainting", {
-        prompt,
-        image: { body: imageBytes, contentType: "image/png" },
-        mask: { body: maskBytes, contentType: "image/png" },
-        num_steps: 20
+        prompt: req.prompt,
+        image: { body: req.imageBytes, contentType: "image/png" },
+        mask: { body: req.maskBytes, contentType: "image/png" },
+        num_steps: req.numSteps
       });
 
       // aiResponse.image is the result image (PNG or JPEG)
-      const arrBuf = await aiResponse.image.arrayBuffer();
-      const outBytes = new Uint8Array(arrBuf);
-      // Encode back to base64
-      const outB64 = btoa(String.fromCharCode(...outBytes));
-
-      return new Response(JSON.stringify({ output_image: outB64 }), {
+      const outBytes = new Uint8Array(await aiResponse.image.arrayBuffer());
+      if (req.binary) {
+        return new Response(outBytes, {
+          headers: { "Content-Type": aiResponse.image.type || "image/png" }
+        });
+      }
+      return new Response(JSON.stringify({ output_image: bytesToB64(outBytes) }), {
         headers: { "Content-Type": "application/json" }
       });
 